@@ -15,5 +15,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'anser.settings')
+os.environ.setdefault('ANSER_URLCONF', 'anser.asgi_urls')
 
 application = get_asgi_application()
@@ -0,0 +1,23 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+anser URL Configuration for ASGI
+
+Same as anser.urls but using async views where available.
+Used by anser/asgi.py.
+"""
+
+from django.urls import path
+
+import goose.views
+
+urlpatterns = [
+    path('', goose.views.index, name='index'),
+    path('stats.json', goose.views.stats_json_async, name='stats_json'),
+    path('stats/<str:name>.json', goose.views.class_stats_json,
+         name='class_stats_json'),
+    path('submit', goose.views.submit_async, name='submit'),
+    path('submit/bulk', goose.views.submit_bulk, name='submit_bulk'),
+    path('metrics', goose.views.prometheus_metrics, name='metrics'),
+]
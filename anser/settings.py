@@ -15,6 +15,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import datetime
 import os
+import typing
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -45,7 +46,15 @@ INSTALLED_APPS = [
     'goose.apps.GooseConfig',
 ]
 
-ROOT_URLCONF = 'anser.urls'
+MIDDLEWARE = [
+    # unused unless GOOSE_PROFILE_DIR is set
+    'goose.profiling.ProfilingMiddleware',
+    # unused unless GOOSE_METRICS_DIR is set
+    'goose.metrics.MetricsMiddleware',
+]
+
+# anser/asgi.py switches to the URL configuration using async views
+ROOT_URLCONF = os.environ.get('ANSER_URLCONF', 'anser.urls')
 
 TEMPLATES = [
     {
@@ -69,8 +78,15 @@ WSGI_APPLICATION = 'anser.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # WAL journal, BEGIN IMMEDIATE; see goose/backends/sqlite3/base.py
+        # note that every atomic() block takes the write lock then,
+        # including read-only ones
+        'ENGINE': 'goose.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'OPTIONS': {
+            # time to wait for the write lock (in seconds)
+            'timeout': 20,
+        },
     }
 }
 
@@ -107,5 +123,123 @@ GOOSE_MAX_PERIODS = 7
 GOOSE_MIN_UPDATE_DELAY = datetime.timedelta(hours=23)
 
 # Max number of submissions from one IPv4 address (or /64 IPv6 network)
-# per one period.
+# per GOOSE_RATE_LIMIT_WINDOW (sliding).  None disables the limit.
+# The address is taken from REMOTE_ADDR, so the server needs to be
+# configured to pass the real client address when behind a proxy.
 GOOSE_MAX_SUBMISSIONS_PER_IP = 10
+
+# Length of the rate limiting window, usually the same as the interval
+# between 'shiftdata' calls.
+GOOSE_RATE_LIMIT_WINDOW = datetime.timedelta(days=1)
+
+# Backend keeping the rate limiting counters.  It needs to be shared
+# by all worker processes.  The limit is best-effort, as concurrent
+# submissions are counted only after they are stored.
+GOOSE_RATE_LIMIT_BACKEND = 'goose.ratelimit.DatabaseBackend'
+
+# Max size (in bytes) of a single report (after decompressing).
+# Larger submissions are rejected before being parsed.
+GOOSE_MAX_REPORT_SIZE = 1048576
+
+# Max ratio of decompressed to compressed submission size.
+# Decompression is aborted as soon as it is exceeded.
+GOOSE_MAX_COMPRESSION_RATIO = 100
+
+# Max number of values in a single list (e.g. world) and max length
+# of a single value, in characters.  The latter must not exceed
+# max_length of Value.value, as SQLite does not enforce it.
+GOOSE_MAX_LIST_LENGTH = 10000
+GOOSE_MAX_VALUE_LENGTH = 256
+
+# Interval (in seconds) at which every worker process checks whether
+# the data classes were changed by another process, at the start
+# of a request.  0 checks on every request.
+GOOSE_REGISTRY_TTL = 10
+
+# Max number of (data class, value) -> value id mappings cached
+# by every worker process.  0 disables the cache.
+GOOSE_VALUE_CACHE_SIZE = 65536
+
+# Number of shards the counts of the current period are split into.
+# Concurrent submissions update different rows if they fall into
+# different shards, reducing lock contention on popular values.
+# Useful only on databases with row-level locking (PostgreSQL, MySQL).
+# The shards are merged by 'shiftdata'.
+GOOSE_COUNT_SHARDS = 1
+
+# Number of times a transaction is retried if it fails due to lock
+# contention ('database is locked', serialization failures
+# and deadlocks), and the initial delay (in seconds) between retries.
+# The delay is doubled after every retry.
+GOOSE_DB_LOCK_RETRIES = 5
+GOOSE_DB_LOCK_RETRY_DELAY = 0.05
+
+# Directory to spool submissions in.  If set, submissions are only
+# validated and appended to the spool, and merged into the database
+# by 'flushsubmissions' command (and prior to 'shiftdata').  If None,
+# submissions are added to the database immediately.
+GOOSE_SPOOL_DIR = None
+
+# Path to write the public stats snapshot to.  If set, 'shiftdata'
+# renders stats.json (plus precompressed variants) once, and the view
+# serves the file instead of computing the stats on every request.
+GOOSE_STATS_SNAPSHOT = None
+
+# Max time (in seconds) the public stats can be cached by clients
+# and proxies.  They change only when 'shiftdata' is called.
+GOOSE_STATS_MAX_AGE = 3600
+
+# Max (and default) number of values returned by /stats/<class>.json
+# in a single page.
+GOOSE_STATS_PAGE_SIZE = 1000
+
+# Max number of outdated partial counts removed by 'shiftdata'
+# in a single transaction, and the delay (in seconds) between
+# successive batches.  Keeps the locks short on large databases.
+GOOSE_SHIFT_BATCH_SIZE = 10000
+GOOSE_SHIFT_BATCH_PAUSE = 0
+
+# Networks of trusted relays (e.g. ['192.0.2.0/24', '2001:db8::/32'])
+# that are permitted to use the bulk submission endpoint.  Bulk
+# submissions are not subject to GOOSE_MAX_SUBMISSIONS_PER_IP.
+GOOSE_RELAY_NETWORKS: typing.List[str] = []
+
+# Max number of reports from a bulk submission that are added
+# in a single transaction.
+GOOSE_BULK_BATCH_SIZE = 1000
+
+# Max size (in bytes) of a bulk submission sent as a JSON array.
+# The array is decoded at once, so larger batches need to be sent
+# as NDJSON, which is read line by line and has no total limit.
+# This limit replaces DATA_UPLOAD_MAX_MEMORY_SIZE for bulk arrays.
+GOOSE_MAX_BULK_ARRAY_SIZE = 16777216
+
+# Directory for Prometheus metrics, shared by all worker processes
+# and 'shiftdata'.  The files of finished worker processes are kept,
+# so the process-*.json files should be removed when the server
+# is restarted.
+# If None, metrics are not collected and /metrics returns 404.
+GOOSE_METRICS_DIR = None
+
+# Min interval (in seconds) between dumps of the metrics collected
+# by a single worker process.
+GOOSE_METRICS_FLUSH_INTERVAL = 1.0
+
+# Directory to write request profiles to.  If None, requests are not
+# profiled.  Wall time, SQL count and SQL time of sampled requests
+# are appended to samples.ndjson there.
+GOOSE_PROFILE_DIR = None
+
+# Fraction of requests that are sampled (0 to 1).
+GOOSE_PROFILE_SAMPLE_RATE = 0.01
+
+# Min wall time (in seconds) of a sampled request for its profile
+# and the query plan of its slowest query to be dumped.
+GOOSE_PROFILE_SLOW_THRESHOLD = 0.5
+
+# Profile to dump for slow requests: 'cprofile' (CPU time per function,
+# for pstats) or 'tracemalloc' (memory allocations).
+GOOSE_PROFILE_MODE = 'cprofile'
+
+# Max number of slow request dumps kept.  The oldest are removed.
+GOOSE_PROFILE_MAX_DUMPS = 100
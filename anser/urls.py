@@ -24,5 +24,9 @@ import goose.views
 urlpatterns = [
     path('', goose.views.index, name='index'),
     path('stats.json', goose.views.stats_json, name='stats_json'),
+    path('stats/<str:name>.json', goose.views.class_stats_json,
+         name='class_stats_json'),
     path('submit', goose.views.submit, name='submit'),
+    path('submit/bulk', goose.views.submit_bulk, name='submit_bulk'),
+    path('metrics', goose.views.prometheus_metrics, name='metrics'),
 ]
@@ -2,7 +2,22 @@
 # 2-clause BSD license
 
 from django.apps import AppConfig
+from django.core.signals import request_started
+from django.db.models import signals
 
 
 class GooseConfig(AppConfig):
     name = 'goose'
+
+    def ready(self) -> None:
+        from goose import registry
+        from goose.models import DataClass
+
+        signals.post_save.connect(registry.invalidate,
+                                  sender=DataClass)
+        signals.post_delete.connect(registry.invalidate,
+                                    sender=DataClass)
+        signals.post_migrate.connect(registry.invalidate,
+                                     sender=self)
+        # pick up changes made by other processes
+        request_started.connect(registry.check)
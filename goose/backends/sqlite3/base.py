@@ -0,0 +1,64 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+SQLite backend suitable for concurrent submissions
+
+Every connection is switched into WAL journal mode, so that readers
+do not block the writer, with synchronous=NORMAL (which is safe
+in WAL mode).  Transactions are started using BEGIN IMMEDIATE,
+so that the write lock is acquired upfront, subject to the busy
+timeout.  With plain BEGIN, a transaction that reads first fails
+immediately with 'database is locked' if another connection writes
+in the meantime.
+
+This applies to every atomic() block, including the read-only ones:
+they wait for (and block) the writers too.  Queries run in autocommit
+mode outside atomic(), e.g. the stats views, are not affected.
+
+The busy timeout is set via 'timeout' option (in seconds).
+The remaining settings can be overriden via 'journal_mode',
+'synchronous' and 'transaction_mode' options.
+"""
+
+import typing
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+
+OPTIONS = {
+    'journal_mode': ('WAL', ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY',
+                             'WAL', 'OFF')),
+    'synchronous': ('NORMAL', ('OFF', 'NORMAL', 'FULL', 'EXTRA')),
+    'transaction_mode': ('IMMEDIATE', ('DEFERRED', 'IMMEDIATE',
+                                       'EXCLUSIVE')),
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def option(self, name: str) -> str:
+        """Get the value of backend-specific option `name`"""
+        default, allowed = OPTIONS[name]
+        value = self.settings_dict['OPTIONS'].get(name, default).upper()
+        if value not in allowed:
+            raise ImproperlyConfigured(
+                f'Invalid SQLite {name} option: {value}')
+        return value
+
+    def get_connection_params(self) -> typing.Dict[str, typing.Any]:
+        params = super().get_connection_params()
+        for name in OPTIONS:
+            params.pop(name, None)
+        return params
+
+    def get_new_connection(self,
+                           conn_params: typing.Dict[str, typing.Any]
+                           ) -> typing.Any:
+        conn = super().get_new_connection(conn_params)
+        conn.execute(f'PRAGMA journal_mode = {self.option("journal_mode")}')
+        conn.execute(f'PRAGMA synchronous = {self.option("synchronous")}')
+        return conn
+
+    def _start_transaction_under_autocommit(self) -> None:
+        self.cursor().execute(f'BEGIN {self.option("transaction_mode")}')
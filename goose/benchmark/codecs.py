@@ -0,0 +1,61 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Comparison of JSON codec backends on synthetic reports
+
+Every available backend decodes and encodes the same reports.
+The best of `repeat` runs is reported, as the timings do not involve
+any I/O and are affected mostly by the noise.
+"""
+
+import math
+import time
+import typing
+
+from goose import jsoncodec
+from goose.benchmark.workload import Workload
+
+
+def best_time(func: typing.Callable[[typing.Any], typing.Any],
+              args: typing.Sequence[typing.Any],
+              repeat: int
+              ) -> float:
+    """Return the best total time of calling `func` on all `args`"""
+    best = math.inf
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        for x in args:
+            func(x)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(values: int,
+        reports: int,
+        repeat: int,
+        seed: int = 0
+        ) -> typing.Dict[str, typing.Any]:
+    """Benchmark all codec backends, return the results"""
+    workload = Workload(values, seed)
+    docs = [workload.report() for _ in range(reports)]
+    encoded = [jsoncodec.STDLIB.dumps(x) for x in docs]
+    size = sum(len(x) for x in encoded)
+
+    results = {}
+    for backend in jsoncodec.BACKENDS:
+        loads = best_time(backend.loads, encoded, repeat)
+        dumps = best_time(backend.dumps, docs, repeat)
+        results[backend.name] = {
+            'loads_us': loads / len(docs) * 1000000 if docs else 0.0,
+            'dumps_us': dumps / len(docs) * 1000000 if docs else 0.0,
+            'loads_mb_s': size / loads / 1000000 if loads else 0.0,
+            'dumps_mb_s': size / dumps / 1000000 if dumps else 0.0,
+        }
+    return {
+        'values': values,
+        'reports': len(docs),
+        'bytes': size,
+        'default': jsoncodec.backend.name,
+        'backends': results,
+    }
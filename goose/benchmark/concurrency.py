@@ -0,0 +1,105 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Throughput of concurrent submissions
+
+Every run starts `writers` processes that submit reports at the same
+time, with settings.GOOSE_COUNT_SHARDS set to `shards`, and measures
+the total throughput.  The values are preloaded, so that the writers
+contend mostly for the counts of popular values.
+
+The processes need to share the database, so it can not be
+an in-memory SQLite database.  SQLite serializes all writes anyway,
+so sharding can make a difference only on databases with row-level
+locking.
+"""
+
+import logging
+import multiprocessing
+import time
+import typing
+
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from goose.benchmark import runner
+from goose.benchmark.workload import Workload
+
+
+def writer(reports: typing.List[typing.Dict[str, typing.Any]],
+           shards: int
+           ) -> typing.Tuple[int, int]:
+    """Submit `reports`, return (accepted, failed) counts"""
+    # failures are counted, not logged
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    accepted = 0
+    failed = 0
+    with override_settings(GOOSE_COUNT_SHARDS=shards,
+                           GOOSE_MAX_SUBMISSIONS_PER_IP=None):
+        client = Client(raise_request_exception=False)
+        for report in reports:
+            resp = client.put(reverse('submit'),
+                              content_type='application/json',
+                              data=report)
+            if resp.status_code == 200:
+                accepted += 1
+            else:
+                failed += 1
+    return (accepted, failed)
+
+
+def run_once(values: int,
+             writers: int,
+             reports: int,
+             shards: int,
+             seed: int = 0
+             ) -> typing.Dict[str, typing.Any]:
+    """Run a single benchmark with `writers` processes"""
+    runner.reset()
+    workload = Workload(values, seed)
+    runner.preload(workload, 1, reports)
+    batches = [[workload.report() for _ in range(reports)]
+               for _ in range(writers)]
+
+    # the connection must not be shared with the forked processes
+    connections.close_all()
+    pool = multiprocessing.get_context('fork').Pool(writers)
+    try:
+        start = time.perf_counter()
+        results = pool.starmap(writer,
+                               [(x, shards) for x in batches],
+                               chunksize=1)
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.close()
+        pool.join()
+
+    accepted = sum(x[0] for x in results)
+    return {
+        'writers': writers,
+        'shards': shards,
+        'accepted': accepted,
+        'failed': sum(x[1] for x in results),
+        'seconds': elapsed,
+        'reports_per_s': accepted / elapsed if elapsed else 0.0,
+    }
+
+
+def run(values: int,
+        writers: typing.Iterable[int],
+        reports: int,
+        shards: typing.Iterable[int],
+        seed: int = 0
+        ) -> typing.Dict[str, typing.Any]:
+    """Run benchmarks for all combinations of `writers` and `shards`"""
+    shards = list(shards)
+    return {
+        'database': connection.vendor,
+        'values': values,
+        'reports_per_writer': reports,
+        'runs': [run_once(values, w, reports, s, seed)
+                 for w in writers
+                 for s in shards],
+    }
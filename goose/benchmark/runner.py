@@ -0,0 +1,244 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+In-process benchmark of submit, shiftdata and stats.json
+
+Every scenario starts with a database prefilled with `periods` periods
+of synthetic counts for `values` distinct values, then times
+the submissions, stats.json requests and a single shiftdata call.
+The views are called via Django test client, so the timings include
+the complete request handling except for the network.
+
+Calls that exceed the query budgets are reported as violations,
+so that a change adding per-value queries is caught.
+
+The JSON codec backends are compared separately, see `codecs`.
+"""
+
+import datetime
+import math
+import time
+import tracemalloc
+import typing
+
+from django.conf import settings
+from django.core import management
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from goose import registry, stats
+from goose.benchmark import codecs
+from goose.benchmark.workload import Workload
+from goose.ingest import batch_size, chunks, value_cache
+from goose.models import (
+    Count,
+    Epoch,
+    RateLimitCounter,
+    SpoolSegment,
+    SubmitterId,
+    Total,
+    Value,
+    )
+
+
+# max queries per call, independent of the report and database size
+QUERY_BUDGETS = {
+    'submit': 16,
+    'stats_json': 2,
+}
+# max queries per shiftdata call, plus per batch of removed rows
+SHIFTDATA_BUDGET = 24
+SHIFTDATA_BATCH_BUDGET = 10
+
+BASE_TIME = datetime.datetime(2020, 1, 1)
+
+
+def percentile(data: typing.Sequence[float], pct: float) -> float:
+    """Get `pct`-th percentile of sorted `data` (nearest-rank)"""
+    if not data:
+        return 0.0
+    return data[max(0, math.ceil(pct / 100 * len(data)) - 1)]
+
+
+class Measurement(object):
+    """Latency, query and memory measurements of an operation"""
+
+    def __init__(self, trace_memory: bool = True) -> None:
+        self.trace_memory = trace_memory
+        self.latencies: typing.List[float] = []
+        self.queries: typing.List[int] = []
+        self.peak_memory = 0
+
+    def measure(self, func: typing.Callable[[], typing.Any]) -> typing.Any:
+        """Call `func` and record its measurements"""
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                ret = func()
+                self.latencies.append(time.perf_counter() - start)
+            if self.trace_memory:
+                self.peak_memory = max(self.peak_memory,
+                                       tracemalloc.get_traced_memory()[1])
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+        self.queries.append(len(ctx.captured_queries))
+        return ret
+
+    def summary(self) -> typing.Dict[str, typing.Any]:
+        latencies = sorted(x * 1000 for x in self.latencies)
+        return {
+            'calls': len(latencies),
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else 0.0,
+                'mean': (sum(latencies) / len(latencies)
+                         if latencies else 0.0),
+            },
+            'queries': {
+                'mean': (sum(self.queries) / len(self.queries)
+                         if self.queries else 0.0),
+                'max': max(self.queries, default=0),
+            },
+            'peak_memory_bytes': (self.peak_memory
+                                  if self.trace_memory else None),
+        }
+
+
+def reset() -> None:
+    """Remove all the data from the database"""
+    with transaction.atomic():
+        for model in (Total, Count, Value, SubmitterId, RateLimitCounter,
+                      SpoolSegment):
+            model.objects.all().delete()
+        Epoch.objects.update(current=0, expired=None)
+    value_cache.clear()
+
+
+def preload(workload: Workload, periods: int, reports: int) -> None:
+    """Fill the database with `periods` periods of published data"""
+    classes = registry.data_classes()
+    counts = list(workload.period_counts(reports))
+    with transaction.atomic():
+        for batch in chunks(counts, batch_size(2)):
+            Value.objects.bulk_create(
+                Value(data_class=classes[cls], value=value)
+                for cls, value, _ in batch)
+        value_ids = dict(((cls_id, value), pk) for pk, cls_id, value
+                         in Value.objects.values_list(
+                             'id', 'data_class_id', 'value')
+                         .iterator())
+        for epoch in range(periods):
+            Count.objects.bulk_create(
+                (Count(value_id=value_ids[(classes[cls].id, value)],
+                       count=count,
+                       epoch=epoch)
+                 for cls, value, count in counts),
+                batch_size=batch_size(3))
+        Count.objects.create(
+            value=Value.objects.create(
+                data_class=classes['stamp'],
+                value=(BASE_TIME
+                       + datetime.timedelta(days=periods)).isoformat()),
+            epoch=periods - 1)
+        Epoch.objects.update(current=periods)
+    stats.rebuild_totals()
+
+
+def run_scenario(values: int,
+                 periods: int,
+                 reports: int,
+                 repeat: int,
+                 seed: int = 0,
+                 trace_memory: bool = True
+                 ) -> typing.Dict[str, typing.Any]:
+    """Run a single benchmark scenario, return the results"""
+    reset()
+    workload = Workload(values, seed)
+    preload(workload, periods, reports)
+    client = Client()
+
+    submit = Measurement(trace_memory)
+    for _ in range(reports):
+        report = workload.report()
+        resp = submit.measure(lambda: client.put(
+            reverse('submit'),
+            content_type='application/json',
+            data=report,
+            REMOTE_ADDR=workload.address()))
+        assert resp.status_code == 200, resp.content
+
+    stats_json = Measurement(trace_memory)
+    for _ in range(repeat):
+        stats_json.measure(lambda: b''.join(
+            client.get(reverse('stats_json')).streaming_content))
+
+    shiftdata = Measurement(trace_memory)
+    counts_before = Count.objects.count()
+    ids_before = SubmitterId.objects.count()
+    shiftdata.measure(lambda: management.call_command(
+        'shiftdata',
+        timestamp=BASE_TIME + datetime.timedelta(days=periods + 1),
+        verbosity=0))
+    # one stamp count is added
+    removed = (counts_before + 1 - Count.objects.count(),
+               ids_before - SubmitterId.objects.count())
+    batches = sum(x // settings.GOOSE_SHIFT_BATCH_SIZE + 1
+                  for x in removed)
+
+    budgets = dict(QUERY_BUDGETS,
+                   shiftdata=(SHIFTDATA_BUDGET
+                              + batches * SHIFTDATA_BATCH_BUDGET))
+    results = {
+        'submit': submit,
+        'stats_json': stats_json,
+        'shiftdata': shiftdata,
+    }
+    violations = [
+        f'{name}: {max(measurement.queries)} queries '
+        f'(budget: {budgets[name]})'
+        for name, measurement in results.items()
+        if max(measurement.queries, default=0) > budgets[name]
+    ]
+
+    return {
+        'values': values,
+        'periods': periods,
+        'reports': reports,
+        'operations': dict((name, x.summary())
+                           for name, x in results.items()),
+        'query_budgets': budgets,
+        'budget_violations': violations,
+    }
+
+
+def run(values: typing.Iterable[int],
+        periods: typing.Iterable[int],
+        reports: int,
+        repeat: int,
+        seed: int = 0,
+        trace_memory: bool = True
+        ) -> typing.Dict[str, typing.Any]:
+    """
+    Run scenarios for all combinations of `values` and `periods`
+
+    The codecs are compared on reports using the largest `values`.
+    """
+
+    values = list(values)
+    return {
+        'database': connection.vendor,
+        'memory_traced': trace_memory,
+        'scenarios': [run_scenario(v, p, reports, repeat, seed,
+                                   trace_memory)
+                      for v in values
+                      for p in periods],
+        'codecs': codecs.run(max(values), reports, repeat, seed),
+    }
@@ -0,0 +1,138 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Synthetic Gentoo-like workloads for benchmarking
+
+Package and profile popularity follows a Zipf distribution: a few
+packages are installed almost everywhere, while most of them are used
+by a handful of systems.  The number of packages in the world set
+follows a log-normal distribution.  The generator is deterministic
+for a given seed.
+"""
+
+import itertools
+import math
+import random
+import typing
+
+
+CATEGORIES = [
+    'app-admin', 'app-arch', 'app-editors', 'app-misc', 'app-shells',
+    'app-text', 'dev-db', 'dev-lang', 'dev-libs', 'dev-perl',
+    'dev-python', 'dev-ruby', 'dev-util', 'dev-vcs', 'games-action',
+    'kde-apps', 'kde-frameworks', 'mail-client', 'media-gfx',
+    'media-libs', 'media-sound', 'media-video', 'net-im', 'net-libs',
+    'net-misc', 'sci-libs', 'sys-apps', 'sys-devel', 'sys-fs',
+    'sys-kernel', 'sys-libs', 'sys-process', 'www-client',
+    'x11-base', 'x11-libs', 'x11-misc', 'x11-wm',
+]
+
+ARCHES = ['amd64', 'arm64', 'x86', 'arm', 'ppc64', 'riscv', 'sparc']
+PROFILE_VERSIONS = ['23.0', '17.1', '17.0']
+PROFILE_VARIANTS = ['', '/desktop', '/desktop/plasma', '/desktop/gnome',
+                    '/systemd', '/no-multilib', '/hardened', '/musl']
+
+# Zipf exponent for package and profile popularity
+ZIPF_EXPONENT = 1.1
+# median world set size and its log-normal spread
+WORLD_MEDIAN = 60
+WORLD_SIGMA = 0.8
+
+
+def zipf_cum_weights(n: int,
+                     exponent: float = ZIPF_EXPONENT
+                     ) -> typing.List[float]:
+    """Return cumulative Zipf weights for ranks 1..`n`"""
+    return list(itertools.accumulate(1 / (k ** exponent)
+                                     for k in range(1, n + 1)))
+
+
+def package_name(rank: int) -> str:
+    """Get synthetic package name for popularity `rank`"""
+    return (f'{CATEGORIES[rank % len(CATEGORIES)]}/'
+            f'pkg{rank // len(CATEGORIES)}')
+
+
+def profile_names() -> typing.List[str]:
+    """Get synthetic profile names, most popular first"""
+    return [f'default/linux/{arch}/{version}{variant}'
+            for arch in ARCHES
+            for version in PROFILE_VERSIONS
+            for variant in PROFILE_VARIANTS]
+
+
+class Workload(object):
+    """
+    Generator of synthetic reports
+
+    `values` is the number of distinct packages that can appear
+    in world sets.
+    """
+
+    def __init__(self, values: int, seed: int = 0) -> None:
+        self.values = values
+        self.random = random.Random(seed)
+        self.profiles = profile_names()
+        self._package_weights = zipf_cum_weights(values)
+        self._profile_weights = zipf_cum_weights(len(self.profiles))
+        self._serial = 0
+
+    def packages(self, count: int) -> typing.List[str]:
+        """Pick `count` distinct packages"""
+        count = min(count, self.values)
+        ranks: typing.Set[int] = set()
+        while len(ranks) < count:
+            ranks.update(self.random.choices(
+                range(self.values),
+                cum_weights=self._package_weights,
+                k=count - len(ranks)))
+        return [package_name(x) for x in sorted(ranks)]
+
+    def profile(self) -> str:
+        """Pick a profile"""
+        return self.random.choices(self.profiles,
+                                   cum_weights=self._profile_weights)[0]
+
+    def world_size(self) -> int:
+        """Pick a world set size"""
+        return max(1, int(self.random.lognormvariate(
+            math.log(WORLD_MEDIAN), WORLD_SIGMA)))
+
+    def address(self) -> str:
+        """Pick a random client IPv4 address"""
+        return '.'.join(str(self.random.randrange(1, 255))
+                        for _ in range(4))
+
+    def report(self) -> typing.Dict[str, typing.Any]:
+        """Generate a single report"""
+        self._serial += 1
+        return {
+            'goose-version': 1,
+            'id': f'bench-{self._serial}-{self.random.getrandbits(64):x}',
+            'profile': self.profile(),
+            'world': self.packages(self.world_size()),
+        }
+
+    def period_counts(self,
+                      reports: int
+                      ) -> typing.Iterator[typing.Tuple[str, str, int]]:
+        """
+        Generate aggregate counts of `reports` reports in one period
+
+        Yields (data class name, value, count) tuples for every
+        package and profile, with counts following the distribution
+        of the generated reports.  Used to fill the database quickly.
+        """
+
+        total = self._package_weights[-1]
+        scale = reports * WORLD_MEDIAN / total
+        for rank in range(self.values):
+            weight = 1 / ((rank + 1) ** ZIPF_EXPONENT)
+            count = int(weight * scale * self.random.uniform(0.5, 1.5))
+            yield ('world', package_name(rank), max(1, count))
+        total = self._profile_weights[-1]
+        for rank, profile in enumerate(self.profiles):
+            weight = 1 / ((rank + 1) ** ZIPF_EXPONENT)
+            yield ('profile', profile,
+                   max(1, int(weight * reports / total)))
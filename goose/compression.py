@@ -0,0 +1,135 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Content encodings supported for request and response bodies
+
+gzip is always supported, zstd only if zstandard module is installed,
+and brotli (responses only) if brotli module is installed.
+"""
+
+import gzip
+import io
+import typing
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class DecompressedTooLarge(ValueError):
+    pass
+
+
+# size of chunks read from the decompressor
+READ_CHUNK = 65536
+
+# functions opening a decompressing reader on top of a file object
+Reader = typing.Callable[[typing.BinaryIO], typing.Any]
+
+DECODERS: typing.Dict[str, Reader] = {
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='rb'),
+}
+DECODE_ERRORS: typing.Tuple[typing.Type[Exception], ...] = (
+    EOFError,
+    OSError,
+    zlib.error,
+)
+
+if zstandard is not None:
+    DECODERS['zstd'] = (
+        lambda f: zstandard.ZstdDecompressor().stream_reader(f))
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+# brotli quality used for documents compressed on request; quality 11
+# (the default) is several times slower, so it is used only
+# for the snapshots written by shiftdata
+LIVE_BROTLI_QUALITY = 5
+
+
+class BrotliWriter(object):
+    """Writer compressing data with brotli into file object `f`"""
+
+    def __init__(self, f: typing.Any, quality: int = 11) -> None:
+        self.f = f
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def write(self, data: bytes) -> None:
+        self.f.write(self.compressor.process(data))
+
+    def close(self) -> None:
+        self.f.write(self.compressor.finish())
+
+
+# functions opening a compressing writer on top of a file object;
+# closing the writer must not close the file
+Writer = typing.Callable[[typing.Any], typing.Any]
+
+# response encodings in order of preference: (encoding, suffix, writer);
+# the writers compress best, for the snapshots
+ENCODERS: typing.List[typing.Tuple[str, str, Writer]] = []
+
+if brotli is not None:
+    ENCODERS.append(('br', '.br', BrotliWriter))
+if zstandard is not None:
+    ENCODERS.append(
+        ('zstd', '.zst',
+         lambda f: zstandard.ZstdCompressor().stream_writer(
+             f, closefd=False)))
+ENCODERS.append(
+    ('gzip', '.gz',
+     lambda f: gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)))
+
+
+# writers overriding ENCODERS for compress()
+LIVE_WRITERS: typing.Dict[str, Writer] = {
+    'br': lambda f: BrotliWriter(f, quality=LIVE_BROTLI_QUALITY),
+}
+
+
+def compress(chunks: typing.Iterable[bytes], encoding: str) -> bytes:
+    """Compress data from `chunks` using `encoding`, on request"""
+    f = io.BytesIO()
+    make_writer = LIVE_WRITERS.get(encoding)
+    if make_writer is None:
+        make_writer = dict((x[0], x[2]) for x in ENCODERS)[encoding]
+    writer = make_writer(f)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return f.getvalue()
+
+
+def decompress(data: bytes, encoding: str, limit: int) -> bytes:
+    """
+    Decompress `data` using `encoding`
+
+    The data is decompressed in chunks, and decompression is aborted
+    as soon as the output exceeds `limit` bytes.  Raises
+    DecompressedTooLarge if it does, and ValueError if the data
+    is malformed.
+    """
+
+    out = []
+    size = 0
+    try:
+        with DECODERS[encoding](io.BytesIO(data)) as f:
+            while True:
+                chunk = f.read(min(READ_CHUNK, limit + 1 - size))
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise DecompressedTooLarge('Decompressed data too large')
+                out.append(chunk)
+    except DECODE_ERRORS as e:
+        raise ValueError(f'Malformed {encoding} data: {e}')
+    return b''.join(out)
@@ -0,0 +1,474 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""Batched ingestion of submitted reports"""
+
+import collections
+import functools
+import operator
+import threading
+import typing
+
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
+
+from goose.models import Count, DataClass, SubmitterId, Value
+
+
+T = typing.TypeVar('T')
+
+# counts of values submitted, per data class
+ReportCounts = typing.Dict[DataClass, typing.Counter[str]]
+# (data class id, value) -> Value.id
+ValueIds = typing.Dict[typing.Tuple[int, str], int]
+# validates report data and returns its counts
+Validator = typing.Callable[[typing.Dict[str, typing.Any]], ReportCounts]
+
+
+class GooseDataError(Exception):
+    pass
+
+
+class GooseLimitError(Exception):
+    pass
+
+
+class GooseTooLargeError(GooseDataError):
+    pass
+
+
+class ValueCache(object):
+    """
+    LRU cache mapping (data class id, value) to `Value` ids
+
+    The cache is local to the process.  Its size is controlled
+    by settings.GOOSE_VALUE_CACHE_SIZE, 0 disables it.  `hits`
+    and `misses` count the lookups.
+
+    Since shiftdata can remove orphaned values, the cache is tagged
+    with the epoch and flushed whenever it changes.  Values cached
+    within an epoch have counts in that epoch, so they can not become
+    orphaned before the next switch.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.generation: typing.Optional[int] = None
+        self._data: typing.MutableMapping[typing.Tuple[int, str], int] = (
+            collections.OrderedDict())
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        return settings.GOOSE_VALUE_CACHE_SIZE
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def validate(self, generation: typing.Optional[int]) -> None:
+        """Flush the cache if `generation` does not match"""
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
+
+    def get_many(self,
+                 keys: typing.Iterable[typing.Tuple[int, str]]
+                 ) -> ValueIds:
+        """Return cached ids for `keys`, skipping missing keys"""
+        ret: ValueIds = {}
+        with self._lock:
+            for key in keys:
+                try:
+                    ret[key] = self._data[key]
+                except KeyError:
+                    self.misses += 1
+                else:
+                    self._data.move_to_end(key)  # type: ignore
+                    self.hits += 1
+        return ret
+
+    def update(self,
+               value_ids: ValueIds,
+               generation: typing.Optional[int]
+               ) -> None:
+        """Add `value_ids` to the cache, if `generation` matches"""
+        max_size = self.max_size
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data.update(value_ids)
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)  # type: ignore
+
+
+value_cache = ValueCache()
+
+
+def chunks(seq: typing.Sequence[T],
+           size: int
+           ) -> typing.Iterator[typing.Sequence[T]]:
+    """Split `seq` into chunks of at most `size` items"""
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+
+def batch_size(params_per_row: int = 1) -> int:
+    """Return max number of rows that can be passed to one query"""
+    max_params = connection.features.max_query_params or 2000
+    return max(1, (max_params - 16) // params_per_row)
+
+
+def compile_validator(classes: typing.Iterable[DataClass]) -> Validator:
+    """
+    Compile a validator of reports for data `classes`
+
+    The returned function validates report `data` and folds it into
+    value counts.  It returns a dict mapping data classes to Counters
+    of submitted values.  Duplicate values within a single report
+    are collapsed into a single entry with an increased count.
+    Raises GooseDataError if the report does not match the data types,
+    or exceeds settings.GOOSE_MAX_LIST_LENGTH
+    or settings.GOOSE_MAX_VALUE_LENGTH.
+    """
+
+    fields = []
+    for cls in classes:
+        if cls.data_type == DataClass.DataClassType.STRING:
+            fields.append((cls.name, cls, False))
+        elif cls.data_type == DataClass.DataClassType.STRING_ARRAY:
+            fields.append((cls.name, cls, True))
+        else:
+            assert False, 'incorrect data_type'
+
+    def validate(data: typing.Dict[str, typing.Any]) -> ReportCounts:
+        max_items = settings.GOOSE_MAX_LIST_LENGTH
+        max_length = settings.GOOSE_MAX_VALUE_LENGTH
+        ret: ReportCounts = {}
+        for name, cls, is_list in fields:
+            if name in data:
+                val = data[name]
+            else:
+                continue
+
+            if not is_list:
+                if not isinstance(val, str):
+                    raise GooseDataError(
+                        f'Expected a single string for {name}')
+                val = (val,)
+            elif not isinstance(val, list):
+                raise GooseDataError(
+                    f'Expected a list of strings for {name}')
+            elif len(val) > max_items:
+                raise GooseDataError(
+                    f'Too many values for {name} (max {max_items})')
+            elif not all(isinstance(x, str) for x in val):
+                raise GooseDataError(
+                    f'Expected a list of strings for {name}')
+            if max(map(len, val), default=0) > max_length:
+                raise GooseDataError(
+                    f'Value too long for {name} '
+                    f'(max {max_length} characters)')
+            ret[cls] = collections.Counter(val)
+        return ret
+
+    return validate
+
+
+def id_limit_error(value: str) -> GooseLimitError:
+    """Get the error for a repeated submission from id `value`"""
+    return GooseLimitError(
+        f'No more than one submission permitted per id={value}')
+
+
+def check_id_limit(value: str, epoch: int, max_age: int) -> None:
+    """Raise GooseLimitError if `value` was submitted recently"""
+    if SubmitterId.objects.filter(digest=SubmitterId.hash_id(value),
+                                  epoch__gt=epoch - max_age).exists():
+        raise id_limit_error(value)
+
+
+def claim_id(value: str, epoch: int, max_age: int) -> None:
+    """
+    Record submission from id `value` in `epoch`
+
+    Raises GooseLimitError if `value` was submitted recently,
+    including concurrent submissions.
+    """
+
+    check_id_limit(value, epoch, max_age)
+    try:
+        with transaction.atomic():
+            SubmitterId.objects.create(digest=SubmitterId.hash_id(value),
+                                       epoch=epoch)
+    except IntegrityError:
+        raise id_limit_error(value)
+
+
+def recent_ids(values: typing.Sequence[str],
+               epoch: int,
+               max_age: int
+               ) -> typing.Set[str]:
+    """Return the subset of `values` that were submitted recently"""
+    ret: typing.Set[str] = set()
+    for batch in chunks(values, batch_size()):
+        digests = dict((SubmitterId.hash_id(x), x) for x in batch)
+        ret.update(digests[x] for x in SubmitterId.objects
+                   .filter(digest__in=digests,
+                           epoch__gt=epoch - max_age)
+                   .values_list('digest', flat=True))
+    return ret
+
+
+def record_ids(values: typing.Sequence[str], epoch: int) -> typing.Set[str]:
+    """
+    Record submissions from ids `values` in `epoch`
+
+    Returns the subset of `values` that were recorded.  Ids recorded
+    concurrently are excluded, so that their counts are not added
+    twice.
+    """
+
+    try:
+        with transaction.atomic():
+            SubmitterId.objects.bulk_create(
+                (SubmitterId(digest=SubmitterId.hash_id(x), epoch=epoch)
+                 for x in values),
+                batch_size=batch_size(2))
+        return set(values)
+    except IntegrityError:
+        pass
+
+    # some of the ids were recorded concurrently, find out which
+    ret: typing.Set[str] = set()
+    for value in values:
+        try:
+            with transaction.atomic():
+                SubmitterId.objects.create(digest=SubmitterId.hash_id(value),
+                                           epoch=epoch)
+        except IntegrityError:
+            continue
+        ret.add(value)
+    return ret
+
+
+def _lookup_values(keys: typing.Sequence[typing.Tuple[int, str]]
+                   ) -> ValueIds:
+    """Find ids of existing values matching `keys`"""
+    ret: ValueIds = {}
+    for batch in chunks(keys, batch_size()):
+        by_class: typing.Dict[int, typing.List[str]] = (
+            collections.defaultdict(list))
+        for cls_id, value in batch:
+            by_class[cls_id].append(value)
+        query = functools.reduce(
+            operator.or_,
+            (models.Q(data_class_id=cls_id, value__in=values)
+             for cls_id, values in by_class.items()))
+        ret.update(((cls_id, value), pk) for pk, cls_id, value
+                   in Value.objects.filter(query)
+                   .values_list('id', 'data_class_id', 'value'))
+    return ret
+
+
+def resolve_values(counts: ReportCounts, epoch: int) -> ValueIds:
+    """
+    Get ids of `Value` rows for all values in `counts`
+
+    `epoch` is the current epoch, used to verify the cache.
+    Values are looked up in `value_cache` first, then in the database.
+    Values that are not present in the database yet are inserted
+    in bulk.
+    """
+
+    keys = [(cls.pk, value) for cls, values in counts.items()
+            for value in values]
+    use_cache = value_cache.max_size > 0
+    if use_cache:
+        value_cache.validate(epoch)
+        cached = value_cache.get_many(keys)
+        keys = [x for x in keys if x not in cached]
+
+    ret = _lookup_values(keys)
+    missing = [x for x in keys if x not in ret]
+    if missing:
+        for batch in chunks(missing, batch_size(2)):
+            Value.objects.bulk_create(
+                (Value(data_class_id=cls_id, value=value)
+                 for cls_id, value in batch),
+                ignore_conflicts=True)
+        ret.update(_lookup_values(missing))
+
+    if use_cache:
+        # the ids can be cached only after the transaction is committed,
+        # as the values inserted by it could be rolled back
+        resolved = dict(ret)
+        transaction.on_commit(
+            lambda: value_cache.update(resolved, epoch))
+        ret.update(cached)
+    return ret
+
+
+def count_shard(id_: str) -> int:
+    """Get the shard for counts submitted by id `id_`"""
+    shards = settings.GOOSE_COUNT_SHARDS
+    if shards <= 1:
+        return 0
+    return int(SubmitterId.hash_id(id_)[:8], 16) % shards
+
+
+def _upsert_syntax() -> typing.Optional[str]:
+    """Return the upsert clause template supported by the backend"""
+    if connection.vendor == 'postgresql':
+        return 'ON CONFLICT ({value}, {epoch}, {shard}) DO UPDATE SET ' \
+               '{count} = {table}.{count} + EXCLUDED.{count}'
+    if (connection.vendor == 'sqlite'
+            and connection.Database.sqlite_version_info >= (3, 24, 0)):
+        return 'ON CONFLICT ({value}, {epoch}, {shard}) DO UPDATE SET ' \
+               '{count} = {table}.{count} + excluded.{count}'
+    if connection.vendor == 'mysql':
+        return 'ON DUPLICATE KEY UPDATE {count} = {count} + VALUES({count})'
+    return None
+
+
+def increment_counts(counts: typing.Mapping[int, int],
+                     epoch: int,
+                     shard: int = 0
+                     ) -> None:
+    """
+    Increase counts of values in `epoch` and `shard`
+
+    `counts` maps `Value` ids to the amounts to add.  Uses a single
+    upsert statement per batch if the backend supports it, or falls
+    back to a bulk update + bulk insert otherwise.
+    """
+
+    if not counts:
+        return
+    upsert = _upsert_syntax()
+    if upsert is None:
+        _increment_counts_fallback(counts, epoch, shard)
+        return
+
+    qn = connection.ops.quote_name
+    names = {
+        'table': qn(Count._meta.db_table),
+        'value': qn(Count._meta.get_field('value').column),
+        'epoch': qn(Count._meta.get_field('epoch').column),
+        'shard': qn(Count._meta.get_field('shard').column),
+        'count': qn(Count._meta.get_field('count').column),
+    }
+    upsert = upsert.format(**names)
+    items = sorted(counts.items())
+    with connection.cursor() as cursor:
+        for batch in chunks(items, batch_size(3)):
+            cursor.execute(
+                'INSERT INTO {table} ({value}, {epoch}, {shard}, {count}) '
+                'VALUES '.format(**names)
+                + ', '.join(len(batch) * ['(%s, %s, %s, %s)'])
+                + ' ' + upsert,
+                [x for value_id, count in batch
+                 for x in (value_id, epoch, shard, count)])
+
+
+def _increment_counts_fallback(counts: typing.Mapping[int, int],
+                               epoch: int,
+                               shard: int
+                               ) -> None:
+    """Portable implementation of increment_counts()"""
+    rows = Count.objects.filter(epoch=epoch, shard=shard)
+    existing: typing.Set[int] = set()
+    for batch in chunks(sorted(counts), batch_size()):
+        existing.update(rows
+                        .select_for_update()
+                        .filter(value_id__in=batch)
+                        .values_list('value_id', flat=True))
+
+    by_incr: typing.Dict[int, typing.List[int]] = (
+        collections.defaultdict(list))
+    for value_id in existing:
+        by_incr[counts[value_id]].append(value_id)
+    for incr, value_ids in by_incr.items():
+        for batch in chunks(value_ids, batch_size()):
+            (rows.filter(value_id__in=batch)
+             .update(count=models.F('count') + incr))
+
+    Count.objects.bulk_create(
+        (Count(value_id=value_id, epoch=epoch, shard=shard, count=incr)
+         for value_id, incr in counts.items()
+         if value_id not in existing),
+        batch_size=batch_size(4))
+
+
+def add_counts(counts: ReportCounts, epoch: int, shard: int = 0) -> None:
+    """Add folded report `counts` to the counts in `epoch` and `shard`"""
+    value_ids = resolve_values(counts, epoch)
+    increment_counts({value_ids[(cls.pk, value)]: num
+                      for cls, values in counts.items()
+                      for value, num in values.items()},
+                     epoch,
+                     shard)
+
+
+def merge_shards(epoch: int) -> None:
+    """
+    Merge all shards of counts in `epoch` into shard 0
+
+    Needs to be called after no more submissions can be added
+    to `epoch`, i.e. with the epoch locked by shiftdata.
+    """
+
+    shards = Count.objects.filter(epoch=epoch, shard__gt=0)
+    increment_counts(dict(shards
+                          .values('value')
+                          .annotate(total=models.Sum('count'))
+                          .order_by()
+                          .values_list('value', 'total')),
+                     epoch)
+    shards.delete()
+
+
+def add_reports(reports: typing.Sequence[typing.Tuple[str, ReportCounts]],
+                epoch: int,
+                max_age: int
+                ) -> typing.List[bool]:
+    """
+    Add multiple folded reports to the counts in `epoch`
+
+    `reports` is a list of (id, counts) tuples, `counts` not including
+    the id.  Reports whose id was submitted recently (or earlier
+    in `reports`) are skipped.  The counts of all remaining reports
+    are summed and added at once, to the shard of the first accepted
+    id.  Returns a list indicating whether each report was accepted.
+    """
+
+    seen = recent_ids([x[0] for x in reports], epoch, max_age)
+    accepted: typing.List[str] = []
+    ret: typing.List[bool] = []
+    for id_, _ in reports:
+        ret.append(id_ not in seen)
+        if ret[-1]:
+            seen.add(id_)
+            accepted.append(id_)
+
+    recorded = record_ids(accepted, epoch)
+    total: ReportCounts = {}
+    for i, (id_, counts) in enumerate(reports):
+        if not ret[i]:
+            continue
+        if id_ not in recorded:
+            # submitted concurrently
+            ret[i] = False
+            continue
+        for cls, values in counts.items():
+            total.setdefault(cls, collections.Counter()).update(values)
+
+    if recorded:
+        shard_id = next(x for x in accepted if x in recorded)
+        add_counts(total, epoch, count_shard(shard_id))
+    return ret
@@ -0,0 +1,62 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+JSON codec for submissions, spool records and API responses
+
+orjson is used if it is installed, and the standard json module
+otherwise.  The public statistics are rendered by stats.iter_stats()
+instead, as their output needs to match json.dumps() exactly.
+"""
+
+import json
+import typing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+class Backend(typing.NamedTuple):
+    name: str
+    loads: typing.Callable[[bytes], typing.Any]
+    dumps: typing.Callable[[typing.Any], bytes]
+
+
+def _json_dumps(obj: typing.Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+STDLIB = Backend('json', json.loads, _json_dumps)
+
+# available backends, in order of preference
+BACKENDS = [STDLIB]
+if orjson is not None:
+    BACKENDS.insert(0, Backend('orjson', orjson.loads, orjson.dumps))
+
+backend = BACKENDS[0]
+
+
+def loads(data: bytes) -> typing.Any:
+    """
+    Decode JSON document from `data`
+
+    If the fast backend rejects the data, it is decoded again using
+    the json module.  This guarantees that the same documents
+    are accepted, and the same exceptions are raised as by json.loads().
+    Note that orjson may decode integers that do not fit in 64 bits
+    as floats.
+    """
+
+    if backend is not STDLIB:
+        try:
+            return backend.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
+
+
+def dumps(obj: typing.Any) -> bytes:
+    """Encode `obj` as compact JSON"""
+    return backend.dumps(obj)
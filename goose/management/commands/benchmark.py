@@ -0,0 +1,128 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import typing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    setup_test_environment,
+    teardown_test_environment,
+    )
+
+from goose.benchmark import concurrency, runner
+
+
+def int_list(x: str) -> typing.List[int]:
+    return [int(v) for v in x.split(',')]
+
+
+class Command(BaseCommand):
+    help = ('Benchmark submit, shiftdata, stats.json and JSON codecs '
+            'on synthetic data (uses a temporary test database)')
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument('--values',
+                            type=int_list,
+                            default=[1000, 10000, 100000],
+                            help='Comma-separated numbers of distinct '
+                                 'values to benchmark with (default: '
+                                 '1000,10000,100000)')
+        parser.add_argument('--periods',
+                            type=int_list,
+                            help='Comma-separated numbers of periods '
+                                 'of data to benchmark with (default: '
+                                 '1,settings.GOOSE_MAX_PERIODS)')
+        parser.add_argument('--reports',
+                            type=int,
+                            default=100,
+                            help='Number of reports to submit '
+                                 '(default: 100)')
+        parser.add_argument('--repeat',
+                            type=int,
+                            default=10,
+                            help='Number of stats.json requests '
+                                 'and codec runs (default: 10)')
+        parser.add_argument('--seed',
+                            type=int,
+                            default=0,
+                            help='Random seed for the workload '
+                                 '(default: 0)')
+        parser.add_argument('--writers',
+                            type=int_list,
+                            default=[],
+                            help='Comma-separated numbers of concurrent '
+                                 'writer processes to benchmark '
+                                 'submissions with (default: none)')
+        parser.add_argument('--shards',
+                            type=int_list,
+                            default=[1, 4],
+                            help='Comma-separated numbers of count shards '
+                                 'to run the concurrent benchmark with '
+                                 '(default: 1,4)')
+        parser.add_argument('--no-memory',
+                            action='store_true',
+                            help='Do not trace peak memory use '
+                                 '(tracing slows down the calls)')
+        parser.add_argument('--output',
+                            help='Write JSON results to the specified '
+                                 'file (default: stdout)')
+
+    def handle(self, *args: typing.Any, **options: typing.Any) -> None:
+        periods = (options['periods']
+                   or [1, settings.GOOSE_MAX_PERIODS])
+
+        with contextlib.ExitStack() as stack:
+            if options['writers'] and connection.vendor == 'sqlite':
+                # writer processes can not share an in-memory database
+                tempdir = stack.enter_context(tempfile.TemporaryDirectory())
+                connection.settings_dict['TEST']['NAME'] = os.path.join(
+                    tempdir, 'benchmark.sqlite3')
+
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0,
+                                                          autoclobber=True,
+                                                          serialize=False)
+            try:
+                results = runner.run(options['values'],
+                                     periods,
+                                     options['reports'],
+                                     options['repeat'],
+                                     options['seed'],
+                                     not options['no_memory'])
+                if options['writers']:
+                    results['concurrency'] = concurrency.run(
+                        max(options['values']),
+                        options['writers'],
+                        options['reports'],
+                        options['shards'],
+                        options['seed'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        output = json.dumps(results, indent=2)
+        if options['output'] is not None:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        violations = [v for x in results['scenarios']
+                      for v in x['budget_violations']]
+        if violations:
+            raise CommandError('Query budgets exceeded:\n'
+                               + '\n'.join(violations))
+        failures = [f'{x["writers"]} writers, {x["shards"]} shards: '
+                    f'{x["failed"]} submissions failed'
+                    for x in results.get('concurrency', {}).get('runs', [])
+                    if x['failed'] > 0]
+        if failures:
+            raise CommandError('Concurrent submissions failed:\n'
+                               + '\n'.join(failures))
@@ -0,0 +1,24 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+import typing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from goose import spool
+
+
+class Command(BaseCommand):
+    help = 'Merge spooled submissions into counts'
+
+    def handle(self, *args: typing.Any, **options: typing.Any) -> None:
+        if spool.spool_dir() is None:
+            raise CommandError('Submission spool is not enabled '
+                               '(settings.GOOSE_SPOOL_DIR)')
+
+        result = spool.flush()
+        self.stdout.write(
+            f'{result.segments} segments flushed, '
+            f'{result.reports} reports added, '
+            f'{result.rejected} rejected, '
+            f'{result.corrupted} corrupted records discarded')
@@ -0,0 +1,34 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+import argparse
+import typing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from goose import stats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild (or verify) published totals from counts'
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument('--check',
+                            action='store_true',
+                            help='Verify the totals against counts '
+                                 'instead of rebuilding them')
+
+    def handle(self, *args: typing.Any, **options: typing.Any) -> None:
+        if not options['check']:
+            stats.rebuild_totals()
+            self.stdout.write('Totals rebuilt')
+            return
+
+        mismatches = 0
+        for value, stored, expected in stats.check_totals():
+            self.stdout.write(f'{value}: total {stored}, '
+                              f'expected {expected}')
+            mismatches += 1
+        if mismatches:
+            raise CommandError(f'{mismatches} totals do not match')
+        self.stdout.write('Totals match')
@@ -3,13 +3,17 @@
 
 import argparse
 import datetime
+import time
+import typing
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.utils import dateparse
 
-from goose.models import Count, DataClass, Value
+from goose import metrics, ratelimit, registry, retry, spool, stats
+from goose.ingest import batch_size, chunks, merge_shards
+from goose.models import Count, Epoch, SubmitterId, Value
 
 
 def timedelta(x):
@@ -26,6 +30,32 @@ def timestamp(x):
     return val
 
 
+def up_to(epoch: int, pk: int) -> models.Q:
+    """Match rows up to (`epoch`, `pk`) in the (epoch, id) index order"""
+    return models.Q(epoch__lt=epoch) | models.Q(epoch=epoch, pk__lte=pk)
+
+
+def checkpoint(mode: str) -> None:
+    """Run WAL checkpoint in `mode` if the database is SQLite"""
+    # the WAL can not be checkpointed within a transaction
+    if connection.vendor == 'sqlite' and not connection.in_atomic_block:
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA wal_checkpoint({mode})')
+
+
+def table_rows() -> typing.List[metrics.TableRows]:
+    """Get the numbers of rows for the metrics"""
+    current = Epoch.get_current()
+    ret: typing.List[metrics.TableRows] = [
+        ('count', current - epoch, rows)
+        for epoch, rows in (Count.objects
+                            .order_by()
+                            .values_list('epoch')
+                            .annotate(rows=models.Count('pk')))]
+    ret.append(('value', None, Value.objects.count()))
+    return ret
+
+
 class Command(BaseCommand):
     help = 'Include fresh submissions and discard old data'
 
@@ -42,6 +72,20 @@ class Command(BaseCommand):
                             type=timestamp,
                             help='Use the specified timestamp for new '
                                  'data (default: current time)')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            help='Max outdated counts to remove in one '
+                                 'transaction (default: '
+                                 'settings.GOOSE_SHIFT_BATCH_SIZE)')
+        parser.add_argument('--pause',
+                            type=float,
+                            help='Delay between batches, in seconds '
+                                 '(default: '
+                                 'settings.GOOSE_SHIFT_BATCH_PAUSE)')
+        parser.add_argument('--expire-only',
+                            action='store_true',
+                            help='Only finish removing outdated counts '
+                                 '(e.g. after an interrupted run)')
 
     def handle(self, *args, **options) -> None:
         dt = options['timestamp'] or datetime.datetime.utcnow()
@@ -49,30 +93,174 @@ class Command(BaseCommand):
                         or settings.GOOSE_MAX_PERIODS)
         min_delay = (options['min_delay']
                      or settings.GOOSE_MIN_UPDATE_DELAY)
+        batch = (options['batch_size']
+                 or settings.GOOSE_SHIFT_BATCH_SIZE)
+        pause = (options['pause']
+                 if options['pause'] is not None
+                 else settings.GOOSE_SHIFT_BATCH_PAUSE)
+
+        start = time.perf_counter()
+        # keep the WAL short before the long shift transaction
+        checkpoint('PASSIVE')
+        if not options['expire_only']:
+            self.shift(dt, keep_periods, min_delay)
+        counts, values = self.expire(batch, pause, options['verbosity'])
+        ids = self.prune_ids(keep_periods, batch, pause,
+                             options['verbosity'])
+        retry.atomic(ratelimit.prune)
+        # the removals have grown the WAL, so reset it
+        checkpoint('TRUNCATE')
 
-        stamp_cls = DataClass.objects.get(name='stamp')
+        if metrics.enabled():
+            metrics.record_shiftdata(
+                time.perf_counter() - start,
+                {'count': counts, 'value': values, 'submitterid': ids},
+                table_rows())
 
-        last_update = (Count.objects.filter(value__data_class=stamp_cls)
-                       .aggregate(models.Max('value__value'))
-                       ['value__value__max'])
+    def shift(self,
+              dt: datetime.datetime,
+              keep_periods: int,
+              min_delay: datetime.timedelta
+              ) -> None:
+        """Switch to the next epoch, if enough time has passed"""
+        last_update = stats.last_update()
         if last_update is not None:
-            # TODO: replace it with fromisoformat() when infra manages
-            # to switch to py3.7
-            delta = dt - datetime.datetime.strptime(
-                last_update.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+            delta = dt - stats.parse_stamp(last_update)
             if delta < min_delay:
                 raise CommandError(
                     f'shiftdata already called {delta} ago, min delay '
                     f'is set to {min_delay}')
 
-        with transaction.atomic():
-            Count.objects.filter(age__gte=keep_periods).delete()
-            # TODO: can we prevent unnecessary manual cascade here?
-            Value.objects.filter(count=None).delete()
-            Count.objects.all().update(age=models.F('age')+1)
-            Count.objects.create(
-                value=Value.objects.create(
-                    data_class=stamp_cls,
-                    value=dt.isoformat()),
-                count=1,
-                age=1)
+        # include all the spooled submissions in the current period
+        spool.flush()
+
+        retry.atomic(lambda: self.switch(dt, keep_periods))
+
+    def switch(self, dt: datetime.datetime, keep_periods: int) -> None:
+        """Publish the current period and switch to the next epoch"""
+        stamp_cls = registry.data_class('stamp')
+        # lock the epoch to wait for submissions in progress
+        epoch = Epoch.objects.select_for_update().get()
+        # no more submissions can be added to the current period,
+        # so its shards can be merged prior to publishing it
+        merge_shards(epoch.current)
+        # the outdated counts are discarded logically here,
+        # and removed in batches afterwards
+        stats.shift_totals(epoch, keep_periods)
+        # switching to the next epoch increases the age of all data
+        Count.objects.create(
+            value=Value.objects.create(
+                data_class=stamp_cls,
+                value=dt.isoformat()),
+            count=1,
+            epoch=epoch.current)
+        epoch.current += 1
+        epoch.save()
+
+        # public stats change only here, so render them once
+        # and publish them when the data is committed
+        if stats.snapshot_path() is not None:
+            transaction.on_commit(lambda: stats.write_snapshot(
+                stats.iter_stats(stats.last_update())))
+
+    def expire(self,
+               batch: int,
+               pause: float,
+               verbosity: int
+               ) -> typing.Tuple[int, int]:
+        """
+        Remove discarded counts and values left without counts
+
+        Returns the numbers of removed counts and values.
+
+        Every batch is removed in a separate transaction, so the process
+        can be safely interrupted and resumed.  Only the values that
+        lost a count in the batch are checked for being orphaned.
+        """
+
+        first = True
+        counts_removed = 0
+        values_removed = 0
+        while True:
+            if not first and pause > 0:
+                time.sleep(pause)
+            first = False
+            result = retry.atomic(lambda: self.expire_batch(batch))
+            if result is None:
+                break
+            counts, values = result
+            counts_removed += counts
+            values_removed += values
+            if verbosity >= 2:
+                self.stdout.write(
+                    f'{counts_removed} outdated counts removed, '
+                    f'{values_removed} orphaned values removed so far')
+
+        if verbosity >= 1 and counts_removed > 0:
+            self.stdout.write(
+                f'{counts_removed} outdated counts removed, '
+                f'{values_removed} orphaned values removed')
+        return (counts_removed, values_removed)
+
+    def expire_batch(self,
+                     batch: int
+                     ) -> typing.Optional[typing.Tuple[int, int]]:
+        """
+        Remove a single batch of discarded counts
+
+        Returns a tuple of removed counts and values, or None if there
+        are no counts left to remove.
+        """
+
+        # lock the epoch to prevent submissions from referencing
+        # the values being removed
+        epoch = Epoch.objects.select_for_update().get()
+        if epoch.expired is None:
+            return None
+        outdated = Count.objects.filter(epoch__lt=epoch.expired)
+        rows = list(outdated
+                    .order_by('epoch', 'pk')
+                    .values_list('epoch', 'pk', 'value_id')[:batch])
+        if not rows:
+            return None
+        counts, _ = outdated.filter(up_to(*rows[-1][:2])).delete()
+        values = 0
+        value_ids = sorted(set(x[2] for x in rows))
+        for value_batch in chunks(value_ids, batch_size()):
+            _, removed = (Value.objects
+                          .filter(id__in=value_batch, count=None)
+                          .delete())
+            values += removed.get(Value._meta.label, 0)
+        return (counts, values)
+
+    def prune_ids(self,
+                  keep_periods: int,
+                  batch: int,
+                  pause: float,
+                  verbosity: int
+                  ) -> int:
+        """Remove submitter ids that no longer limit submissions"""
+        oldest = Epoch.get_current() - keep_periods
+        removed = 0
+        while True:
+            if removed != 0 and pause > 0:
+                time.sleep(pause)
+            count = retry.atomic(lambda: self.prune_ids_batch(oldest, batch))
+            if count == 0:
+                break
+            removed += count
+
+        if verbosity >= 1 and removed > 0:
+            self.stdout.write(f'{removed} outdated submitter ids removed')
+        return removed
+
+    def prune_ids_batch(self, oldest: int, batch: int) -> int:
+        """Remove a single batch of ids, return the number removed"""
+        outdated = SubmitterId.objects.filter(epoch__lte=oldest)
+        rows = list(outdated
+                    .order_by('epoch', 'pk')
+                    .values_list('epoch', 'pk')[:batch])
+        if not rows:
+            return 0
+        count, _ = outdated.filter(up_to(*rows[-1])).delete()
+        return count
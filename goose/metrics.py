@@ -0,0 +1,504 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Prometheus metrics
+
+The metrics are collected only if settings.GOOSE_METRICS_DIR is set.
+Every process keeps its samples in memory, and dumps them into
+a process-*.json file in that directory, at most once
+per settings.GOOSE_METRICS_FLUSH_INTERVAL.  The file is named after
+the pid and a random token, so that a new process reusing the pid
+of a finished one does not overwrite its counters.  The metrics view
+sums the files of all processes, so all samples (including histogram
+buckets) need to be additive.
+
+The files of finished processes are kept, so that the counters do not
+go back when workers are recycled.  Therefore, the process-*.json
+files should be removed when the server is restarted (e.g. from
+ExecStartPre= of the service).
+
+The last 'shiftdata' run (along with the table sizes it leaves)
+is recorded into a separate file, so that the view does not need
+to scan the tables.
+"""
+
+import asyncio
+import atexit
+import functools
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.http import FileResponse, HttpRequest, HttpResponse
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# label names and values, in order
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+# family name -> {sample: value}
+Samples = typing.Dict[str, typing.Dict[str, float]]
+# (table, age or None, number of rows)
+TableRows = typing.Tuple[str, typing.Optional[int], int]
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Metric(typing.NamedTuple):
+    name: str
+    type: str
+    help: str
+    buckets: typing.Tuple[float, ...] = ()
+
+
+METRICS = dict((x.name, x) for x in [
+    Metric('goose_request_duration_seconds', 'histogram',
+           'Time spent processing requests, per view',
+           LATENCY_BUCKETS),
+    Metric('goose_db_queries', 'histogram',
+           'Database queries per request, per view',
+           (0, 1, 2, 5, 10, 20, 50, 100)),
+    Metric('goose_db_duration_seconds', 'histogram',
+           'Time spent in database queries per request, per view',
+           LATENCY_BUCKETS),
+    Metric('goose_submissions_total', 'counter',
+           'Submitted reports, per response status (200 if accepted)'),
+    Metric('goose_report_world_atoms', 'histogram',
+           'Number of @world atoms in valid reports',
+           (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+    Metric('goose_shiftdata_last_run_timestamp_seconds', 'gauge',
+           'Time when the last shiftdata run finished'),
+    Metric('goose_shiftdata_duration_seconds', 'gauge',
+           'Duration of the last shiftdata run'),
+    Metric('goose_shiftdata_removed_rows', 'gauge',
+           'Rows removed by the last shiftdata run, per table'),
+    Metric('goose_table_rows', 'gauge',
+           'Rows left by the last shiftdata run, per table and age'),
+])
+
+logger = logging.getLogger(__name__)
+
+# guards _samples and _last_flush, as threads of a process share them
+_lock = threading.Lock()
+# keeps the snapshots written in order
+_write_lock = threading.Lock()
+_samples: Samples = {}
+_last_flush = 0.0
+_process_key = f'{os.getpid()}-{secrets.token_hex(4)}'
+
+
+def enabled() -> bool:
+    """Check whether metrics are enabled"""
+    return settings.GOOSE_METRICS_DIR is not None
+
+
+def escape_label(value: str) -> str:
+    """Escape label value for the exposition format"""
+    return (value.replace('\\', r'\\')
+            .replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def sample_key(name: str, labels: Labels) -> str:
+    """Format sample name and labels in the exposition format"""
+    if not labels:
+        return name
+    formatted = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels)
+    return f'{name}{{{formatted}}}'
+
+
+@functools.lru_cache(maxsize=None)
+def histogram_keys(name: str,
+                   labels: Labels
+                   ) -> typing.Tuple[typing.List[typing.Tuple[float, str]],
+                                     str, str]:
+    """Get (bucket keys, sum key, count key) for histogram `name`"""
+    buckets = [(bound, sample_key(f'{name}_bucket',
+                                  labels + (('le', repr(float(bound))),)))
+               for bound in METRICS[name].buckets]
+    buckets.append((float('inf'),
+                    sample_key(f'{name}_bucket', labels + (('le', '+Inf'),))))
+    return (buckets,
+            sample_key(f'{name}_sum', labels),
+            sample_key(f'{name}_count', labels))
+
+
+def inc(name: str, labels: Labels = (), value: float = 1) -> None:
+    """Increase counter `name` by `value`"""
+    if not enabled():
+        return
+    key = sample_key(name, labels)
+    with _lock:
+        samples = _samples.setdefault(name, {})
+        samples[key] = samples.get(key, 0) + value
+
+
+def observe(name: str, value: float, labels: Labels = ()) -> None:
+    """Record `value` in histogram `name`"""
+    if not enabled():
+        return
+    buckets, sum_key, count_key = histogram_keys(name, labels)
+    with _lock:
+        samples = _samples.setdefault(name, {})
+        # all buckets need to be present, even if empty
+        for bound, key in buckets:
+            samples[key] = samples.get(key, 0) + (1 if value <= bound else 0)
+        samples[sum_key] = samples.get(sum_key, 0) + value
+        samples[count_key] = samples.get(count_key, 0) + 1
+
+
+def reset() -> None:
+    """Discard samples of the current process"""
+    global _last_flush
+    with _lock:
+        _samples.clear()
+        _last_flush = 0.0
+
+
+def after_fork() -> None:
+    """Reset the state inherited from the parent process"""
+    global _lock, _write_lock, _process_key
+    # the locks could have been held by another thread of the parent
+    _lock = threading.Lock()
+    _write_lock = threading.Lock()
+    _process_key = f'{os.getpid()}-{secrets.token_hex(4)}'
+    reset()
+
+
+def write(name: str, samples: Samples) -> None:
+    """Write `samples` into file `name` in the metrics directory"""
+    path = Path(settings.GOOSE_METRICS_DIR)
+    with tempfile.NamedTemporaryFile('w',
+                                     dir=path,
+                                     prefix=f'.{name}.',
+                                     delete=False) as f:
+        try:
+            json.dump(samples, f)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path / f'{name}.json')
+
+
+def flush(force: bool = False) -> None:
+    """
+    Dump samples of the current process, if the interval passed
+
+    Errors are logged rather than raised, so that failing to write
+    metrics never breaks the request being handled.
+    """
+    global _last_flush
+    if not enabled():
+        return
+    now = time.monotonic()
+    interval = settings.GOOSE_METRICS_FLUSH_INTERVAL
+    with _lock:
+        if not _samples or (not force and now - _last_flush < interval):
+            return
+        _last_flush = now
+    with _write_lock:
+        with _lock:
+            snapshot = dict((name, dict(values))
+                            for name, values in _samples.items())
+        try:
+            write(f'process-{_process_key}', snapshot)
+        except (OSError, ValueError):
+            logger.exception('Writing metrics failed')
+
+
+def collect() -> Samples:
+    """Sum the samples of all processes"""
+    flush(force=True)
+    ret: Samples = {}
+    for path in Path(settings.GOOSE_METRICS_DIR).glob('*.json'):
+        try:
+            with open(path) as f:
+                samples = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        for name, values in samples.items():
+            family = ret.setdefault(name, {})
+            for key, value in values.items():
+                family[key] = family.get(key, 0) + value
+    return ret
+
+
+def sample_order(key: str) -> typing.Tuple[str, float]:
+    """Sort key placing histogram buckets in the order of bounds"""
+    m = re.search(r'[{,]le="([^"]*)"', key)
+    if m is None:
+        return (key, 0.0)
+    return (key[:m.start()], float(m.group(1)))
+
+
+def render() -> str:
+    """Render the metrics of all processes in text exposition format"""
+    samples = collect()
+    lines = []
+    for name, metric in METRICS.items():
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        family = samples.get(name, {})
+        for key in sorted(family, key=sample_order):
+            lines.append(f'{key} {family[key]!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def record_shiftdata(duration: float,
+                     removed: typing.Dict[str, int],
+                     rows: typing.Iterable[TableRows]
+                     ) -> None:
+    """
+    Record the results of a shiftdata run
+
+    `removed` maps table names to the number of removed rows, `rows`
+    yields (table, age, rows) tuples for the remaining rows.  Age
+    is None for tables that are not split into periods.
+    """
+
+    if not enabled():
+        return
+    table_rows: typing.Dict[str, float] = {}
+    for table, age, count in rows:
+        labels: Labels = (('table', table),)
+        if age is not None:
+            labels += (('age', str(age)),)
+        table_rows[sample_key('goose_table_rows', labels)] = count
+
+    write('shiftdata', {
+        'goose_shiftdata_last_run_timestamp_seconds': {
+            'goose_shiftdata_last_run_timestamp_seconds': time.time(),
+        },
+        'goose_shiftdata_duration_seconds': {
+            'goose_shiftdata_duration_seconds': duration,
+        },
+        'goose_shiftdata_removed_rows': dict(
+            (sample_key('goose_shiftdata_removed_rows',
+                        (('table', table),)), count)
+            for table, count in removed.items()),
+        'goose_table_rows': table_rows,
+    })
+
+
+class QueryTimer(object):
+    """Database execute wrapper counting queries and their time"""
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.duration = 0.0
+
+    def __call__(self,
+                 execute: typing.Callable[..., typing.Any],
+                 *args: typing.Any
+                 ) -> typing.Any:
+        start = time.perf_counter()
+        try:
+            return execute(*args)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.queries += 1
+
+
+class InstrumentedStream(object):
+    """
+    Iterator over streaming response content, producing every chunk
+    inside `context()` and calling `finish` once it is exhausted
+    or closed
+    """
+
+    def __init__(self,
+                 content: typing.Iterable[bytes],
+                 context: typing.Callable[[], typing.ContextManager[None]],
+                 finish: typing.Callable[[], None]
+                 ) -> None:
+        self.content = iter(content)
+        self.context = context
+        self.finish = finish
+        self.finished = False
+
+    def __iter__(self) -> 'InstrumentedStream':
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            with self.context():
+                chunk = next(self.content, None)
+        except BaseException:
+            self.close()
+            raise
+        if chunk is None:
+            self.close()
+            raise StopIteration()
+        return chunk
+
+    def close(self) -> None:
+        if not self.finished:
+            self.finished = True
+            self.finish()
+
+
+async def instrument_async(
+        content: typing.AsyncIterable[bytes],
+        context: typing.Callable[[], typing.ContextManager[None]],
+        finish: typing.Callable[[], None]
+        ) -> typing.AsyncIterator[bytes]:
+    """Async variant of InstrumentedStream"""
+    iterator = content.__aiter__()
+    try:
+        while True:
+            with context():
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            yield chunk
+    finally:
+        finish()
+
+
+def instrument_streaming(
+        response: HttpResponse,
+        context: typing.Callable[[], typing.ContextManager[None]],
+        finish: typing.Callable[[], None]
+        ) -> bool:
+    """
+    Call `finish` once the content of streaming `response` is complete
+
+    The content of streaming responses is generated after the middleware
+    returns, so it is produced inside `context()`, and `finish` is called
+    once it is exhausted or the response is closed.  Returns False
+    if `response` is complete already, and the caller needs to finish
+    it.  File responses are complete immediately, as the server can send
+    them bypassing the iterator.
+
+    Async content is iterated on the event loop, so `context()` must not
+    depend on the current thread.
+    """
+    if getattr(response, 'is_async', False):
+        response.streaming_content = instrument_async(
+            response.streaming_content, context, finish)
+    elif response.streaming and not isinstance(response, FileResponse):
+        response.streaming_content = InstrumentedStream(
+            response.streaming_content, context, finish)
+    else:
+        return False
+    return True
+
+
+def request_connection() -> BaseDatabaseWrapper:
+    """
+    Get the database connection of the current thread
+
+    Async middleware calls it via sync_to_async(), to get the connection
+    used by the request thread.
+    """
+    return connections[DEFAULT_DB_ALIAS]
+
+
+class MetricsMiddleware(object):
+    """
+    Middleware recording request metrics
+
+    Removed from the chain if metrics are disabled.  It supports both
+    sync and async requests, so that async views are not forced into
+    a thread.  The database is instrumented via the connection
+    of the thread running the queries.  Streaming responses are recorded
+    once their content is exhausted.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self,
+                 get_response: typing.Callable[[HttpRequest], typing.Any]
+                 ) -> None:
+        if not enabled():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest) -> typing.Any:
+        if self.is_async:
+            return self.acall(request)
+        # bind the connection of this thread, for async content
+        db = request_connection()
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with db.execute_wrapper(timer):
+            response = self.get_response(request)
+        finish = self.finisher(request, response, start, timer)
+        if not instrument_streaming(response,
+                                    lambda: db.execute_wrapper(timer),
+                                    finish):
+            finish()
+        return response
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        """Async variant of __call__()"""
+        db = await sync_to_async(request_connection)()
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with db.execute_wrapper(timer):
+            response = await self.get_response(request)
+        finish = self.finisher(request, response, start, timer)
+        if not instrument_streaming(response,
+                                    lambda: db.execute_wrapper(timer),
+                                    finish):
+            # keep the file I/O off the event loop
+            await sync_to_async(finish)()
+        return response
+
+    def finisher(self,
+                 request: HttpRequest,
+                 response: HttpResponse,
+                 start: float,
+                 timer: QueryTimer
+                 ) -> typing.Callable[[], None]:
+        """Get the function recording the request once it is complete"""
+        def finish() -> None:
+            duration = time.perf_counter() - start
+            # never let metrics break the response
+            try:
+                self.record(request, response, duration, timer)
+            except Exception:
+                logger.exception('Recording request metrics failed')
+        return finish
+
+    @staticmethod
+    def record(request: HttpRequest,
+               response: HttpResponse,
+               duration: float,
+               timer: QueryTimer
+               ) -> None:
+        """Record metrics of a finished request"""
+        match = request.resolver_match
+        view = match.url_name if match is not None else None
+        labels = (('view', view or 'none'),)
+        observe('goose_request_duration_seconds', duration, labels)
+        observe('goose_db_queries', timer.queries, labels)
+        observe('goose_db_duration_seconds', timer.duration, labels)
+        if view == 'submit' and request.method == 'PUT':
+            inc('goose_submissions_total',
+                (('status', str(response.status_code)),))
+        flush()
+
+
+# samples inherited from the parent belong to its file
+os.register_at_fork(after_in_child=after_fork)
+atexit.register(flush, True)
@@ -13,17 +13,19 @@ from goose.models import DataClass
 def add_data_classes(apps: migrations.state.StateApps,
                      schema_editor: BaseDatabaseSchemaEditor
                      ) -> None:
-    DataClass(
+    # the current model can have fields that do not exist yet
+    HistoricalDataClass = apps.get_model('goose', 'DataClass')
+    HistoricalDataClass(
         name='id',
         description='Unique system identifier',
         data_type=DataClass.DataClassType.STRING,
         public=False).save()
-    DataClass(
+    HistoricalDataClass(
         name='profile',
         description='Profile used',
         data_type=DataClass.DataClassType.STRING,
         public=True).save()
-    DataClass(
+    HistoricalDataClass(
         name='world',
         description='Packages found in @world',
         data_type=DataClass.DataClassType.STRING_ARRAY,
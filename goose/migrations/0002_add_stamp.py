@@ -12,7 +12,9 @@ from goose.models import DataClass
 def add_data_classes(apps: migrations.state.StateApps,
                      schema_editor: BaseDatabaseSchemaEditor
                      ) -> None:
-    DataClass(
+    # the current model can have fields that do not exist yet
+    HistoricalDataClass = apps.get_model('goose', 'DataClass')
+    HistoricalDataClass(
         name='stamp',
         description='Meaningless stamp added in case of no data',
         data_type=DataClass.DataClassType.STRING,
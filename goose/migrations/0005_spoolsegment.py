@@ -0,0 +1,30 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 05:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0004_replace_inclusion_time_with_age'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpoolSegment',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True,
+                    primary_key=True,
+                    serialize=False,
+                    verbose_name='ID')),
+                ('name', models.CharField(
+                    help_text='Segment file name',
+                    max_length=128,
+                    unique=True)),
+            ],
+        ),
+    ]
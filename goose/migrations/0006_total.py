@@ -0,0 +1,49 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 05:57
+
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+import django.db.models.deletion
+
+
+def compute_totals(apps: migrations.state.StateApps,
+                   schema_editor: BaseDatabaseSchemaEditor
+                   ) -> None:
+    Count = apps.get_model('goose', 'Count')
+    Total = apps.get_model('goose', 'Total')
+    Total.objects.bulk_create(
+        (Total(value_id=x['value'], count=x['total'])
+         for x in Count.objects
+         .filter(age__gt=0, value__data_class__public=True)
+         .values('value')
+         .annotate(total=models.Sum('count'))
+         .iterator()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0005_spoolsegment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Total',
+            fields=[
+                ('value', models.OneToOneField(
+                    help_text='The value',
+                    on_delete=django.db.models.deletion.CASCADE,
+                    primary_key=True,
+                    serialize=False,
+                    to='goose.value')),
+                ('count', models.IntegerField(
+                    default=0,
+                    help_text='Total number of occurrences '
+                              'of the value')),
+            ],
+        ),
+        migrations.RunPython(compute_totals),
+    ]
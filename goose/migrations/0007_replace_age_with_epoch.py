@@ -0,0 +1,71 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 06:10
+
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+
+
+def convert_to_epoch(apps: migrations.state.StateApps,
+                     schema_editor: BaseDatabaseSchemaEditor
+                     ) -> None:
+    Count = apps.get_model('goose', 'Count')
+    Epoch = apps.get_model('goose', 'Epoch')
+    # start with the oldest data at epoch 0
+    current = (Count.objects.aggregate(models.Max('age'))['age__max']
+               or 0)
+    Epoch.objects.create(current=current)
+    Count.objects.update(epoch=current - models.F('age'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0006_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Epoch',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True,
+                    primary_key=True,
+                    serialize=False,
+                    verbose_name='ID')),
+                ('current', models.IntegerField(
+                    default=0,
+                    help_text='Number of the current period')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='count',
+            name='epoch',
+            field=models.IntegerField(
+                default=0,
+                help_text='Epoch when the data was submitted'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(convert_to_epoch),
+        migrations.RemoveConstraint(
+            model_name='count',
+            name='unique_count',
+        ),
+        migrations.RemoveField(
+            model_name='count',
+            name='age',
+        ),
+        migrations.AddConstraint(
+            model_name='count',
+            constraint=models.UniqueConstraint(
+                fields=('value', 'epoch'),
+                name='unique_count'),
+        ),
+        migrations.AddIndex(
+            model_name='count',
+            index=models.Index(
+                fields=['epoch'],
+                name='count_epoch'),
+        ),
+    ]
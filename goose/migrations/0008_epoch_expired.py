@@ -0,0 +1,24 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 07:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0007_replace_age_with_epoch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epoch',
+            name='expired',
+            field=models.IntegerField(
+                help_text='Counts older than this epoch are discarded '
+                          '(null if none were)',
+                null=True),
+        ),
+    ]
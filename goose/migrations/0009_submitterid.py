@@ -0,0 +1,59 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 08:04
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+
+
+def move_ids(apps: migrations.state.StateApps,
+             schema_editor: BaseDatabaseSchemaEditor
+             ) -> None:
+    Count = apps.get_model('goose', 'Count')
+    SubmitterId = apps.get_model('goose', 'SubmitterId')
+    Value = apps.get_model('goose', 'Value')
+    counts = Count.objects.filter(value__data_class__name='id')
+    SubmitterId.objects.bulk_create(
+        (SubmitterId(
+            digest=hashlib.blake2b(value.encode(),
+                                   digest_size=16).hexdigest(),
+            epoch=epoch)
+         for value, epoch in counts.values_list('value__value', 'epoch')),
+        batch_size=500)
+    counts.delete()
+    Value.objects.filter(data_class__name='id').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0008_epoch_expired'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmitterId',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True,
+                    primary_key=True,
+                    serialize=False,
+                    verbose_name='ID')),
+                ('digest', models.CharField(
+                    help_text='Hash of the submitter id',
+                    max_length=32)),
+                ('epoch', models.IntegerField(
+                    help_text='Epoch of the submission')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='submitterid',
+            constraint=models.UniqueConstraint(
+                fields=('digest', 'epoch'),
+                name='unique_submitter_id'),
+        ),
+        migrations.RunPython(move_ids),
+    ]
@@ -0,0 +1,39 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0009_submitterid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitCounter',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True,
+                    primary_key=True,
+                    serialize=False,
+                    verbose_name='ID')),
+                ('network', models.BigIntegerField(
+                    help_text='Normalized client network')),
+                ('window', models.IntegerField(
+                    help_text='Number of the time window')),
+                ('count', models.IntegerField(
+                    default=0,
+                    help_text='Number of submissions in the window')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ratelimitcounter',
+            constraint=models.UniqueConstraint(
+                fields=('network', 'window'),
+                name='unique_rate_limit_counter'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 10:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0010_ratelimitcounter'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='count',
+            name='count_epoch',
+        ),
+        migrations.AddIndex(
+            model_name='count',
+            index=models.Index(
+                fields=['epoch', 'id'],
+                name='count_epoch_id'),
+        ),
+        migrations.AddIndex(
+            model_name='ratelimitcounter',
+            index=models.Index(
+                fields=['window'],
+                name='ratelimitcounter_window'),
+        ),
+        migrations.AddIndex(
+            model_name='submitterid',
+            index=models.Index(
+                fields=['epoch', 'id'],
+                name='submitterid_epoch_id'),
+        ),
+    ]
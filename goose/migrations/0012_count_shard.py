@@ -0,0 +1,33 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0011_query_plan_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='count',
+            name='unique_count',
+        ),
+        migrations.AddField(
+            model_name='count',
+            name='shard',
+            field=models.SmallIntegerField(
+                default=0,
+                help_text='Shard of the count within the epoch'),
+        ),
+        migrations.AddConstraint(
+            model_name='count',
+            constraint=models.UniqueConstraint(
+                fields=('value', 'epoch', 'shard'),
+                name='unique_count'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 15:41
+
+from django.db import migrations, models
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+import django.db.models.deletion
+
+
+def rank_totals(apps: migrations.state.StateApps,
+                schema_editor: BaseDatabaseSchemaEditor
+                ) -> None:
+    Total = apps.get_model('goose', 'Total')
+    Value = apps.get_model('goose', 'Value')
+    Total.objects.update(
+        data_class=models.Subquery(
+            Value.objects
+            .filter(id=models.OuterRef('value'))
+            .values('data_class')[:1]))
+    updated = []
+    for data_class_id in (Total.objects
+                          .order_by()
+                          .values_list('data_class', flat=True)
+                          .distinct()):
+        for rank, total in enumerate(
+                Total.objects
+                .filter(data_class=data_class_id, count__gt=0)
+                .order_by('-count', 'value__value'),
+                start=1):
+            total.rank = rank
+            updated.append(total)
+    Total.objects.bulk_update(updated, ['rank'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0012_count_shard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='total',
+            name='data_class',
+            field=models.ForeignKey(
+                db_index=False,
+                help_text='Class of the value',
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to='goose.dataclass'),
+        ),
+        migrations.AddField(
+            model_name='total',
+            name='rank',
+            field=models.IntegerField(
+                help_text='Position of the value within its class '
+                          'by count',
+                null=True),
+        ),
+        migrations.RunPython(rank_totals),
+        migrations.AlterField(
+            model_name='total',
+            name='data_class',
+            field=models.ForeignKey(
+                db_index=False,
+                help_text='Class of the value',
+                on_delete=django.db.models.deletion.CASCADE,
+                to='goose.dataclass'),
+        ),
+        migrations.AddIndex(
+            model_name='total',
+            index=models.Index(
+                fields=['data_class', 'rank'],
+                name='total_class_rank'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+# Generated by Django 3.2.25 on 2026-10-17 18:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goose', '0013_total_rank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataclass',
+            name='updated',
+            field=models.DateTimeField(
+                auto_now=True,
+                default=django.utils.timezone.now,
+                help_text='Time of the last change, used to invalidate '
+                          'caches'),
+            preserve_default=False,
+        ),
+    ]
@@ -1,7 +1,18 @@
 # (c) 2020 Michał Górny
 # 2-clause BSD license
 
-from django.db import models
+import hashlib
+
+from django.db import connection, models
+
+
+def share_lock_clause() -> str:
+    """Get the clause share-locking the selected rows"""
+    # FOR SHARE is not supported by MySQL < 8.0 nor MariaDB
+    if connection.vendor == 'mysql' and (connection.mysql_is_mariadb
+                                         or connection.mysql_version < (8,)):
+        return 'LOCK IN SHARE MODE'
+    return 'FOR SHARE'
 
 
 class DataClass(models.Model):
@@ -12,7 +23,8 @@ class DataClass(models.Model):
     the key in JSON report that contains the data, and `data_type`
     indicates the expected contents type.  If `public` is True,
     the data is included in output JSON, otherwise it is only kept
-    for internal use.
+    for internal use.  `updated` lets other processes notice changes
+    to the cached data classes.
     """
 
     class DataClassType(models.IntegerChoices):
@@ -43,6 +55,9 @@ class DataClass(models.Model):
         help_text='Type of data reported')
     public = models.BooleanField(
         help_text='Whether the data is a publicly reported statistic')
+    updated = models.DateTimeField(
+        auto_now=True,
+        help_text='Time of the last change, used to invalidate caches')
 
     def __str__(self) -> str:
         return f'data class: {self.name}'
@@ -78,6 +93,59 @@ class Value(models.Model):
         return f'value: {self.value}; of {self.data_class}'
 
 
+class Epoch(models.Model):
+    """
+    Current epoch
+
+    A table holding a single row with the number of the current period.
+    Fresh submissions are stored with the current epoch.  shiftdata
+    increments it, effectively increasing the age of all data.
+
+    `expired` is the oldest epoch that has not been discarded yet.
+    Counts from older epochs are already subtracted from totals
+    and are ignored, even if they were not removed yet.
+    """
+
+    current = models.IntegerField(
+        default=0,
+        help_text='Number of the current period')
+    expired = models.IntegerField(
+        null=True,
+        help_text='Counts older than this epoch are discarded '
+                  '(null if none were)')
+
+    @classmethod
+    def get_current(cls, for_write: bool = False) -> int:
+        """
+        Get the current epoch
+
+        If `for_write` is True, the row is share-locked until the end
+        of the transaction, so that shiftdata can not switch to the next
+        epoch while the data is being added.
+        """
+
+        if for_write and connection.vendor in ('mysql', 'postgresql'):
+            qn = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'SELECT {qn("current")} FROM {qn(cls._meta.db_table)} '
+                    f'{share_lock_clause()}')
+                return cursor.fetchone()[0]
+        return cls.objects.values_list('current', flat=True).get()
+
+    def __str__(self) -> str:
+        return f'epoch: {self.current}'
+
+
+class CountQuerySet(models.QuerySet):
+    def with_age(self) -> models.QuerySet:
+        """Annotate counts with age"""
+        return self.annotate(
+            age=models.Subquery(
+                Epoch.objects.values('current')[:1])
+            - models.F('epoch'))
+
+
 class Count(models.Model):
     """
     Partial count towards the statistic
@@ -87,19 +155,35 @@ class Count(models.Model):
     `value` is the value.  It implies the data type as well.
     `count` is the number of occurrences in the partial sum.
 
-    `age` indicates the age of data.  It starts at 0 at submission time,
+    `epoch` indicates the period when the data was submitted.
+    The age of data is the difference between the current epoch
+    (see `Epoch`) and `epoch`.  It starts at 0 at submission time,
     and it is increased periodically.  Data with age >= 1 is included
     in public statistics, data with age defined in settings is discarded
     as outdated.
+
+    `shard` is used to split the counts of the current epoch between
+    multiple rows, so that concurrent submissions do not contend
+    for the same rows (see settings.GOOSE_COUNT_SHARDS).  The shards
+    are merged into shard 0 by shiftdata, so older epochs have a single
+    row per value.
     """
 
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 name='unique_count',
-                fields=['value', 'age']),
+                fields=['value', 'epoch', 'shard']),
+        ]
+        indexes = [
+            # used to find and remove outdated counts in batches
+            models.Index(
+                name='count_epoch_id',
+                fields=['epoch', 'id']),
         ]
 
+    objects = CountQuerySet.as_manager()
+
     value = models.ForeignKey(
         'Value',
         help_text='The value',
@@ -107,9 +191,155 @@ class Count(models.Model):
     count = models.IntegerField(
         default=1,
         help_text='Number of occurrences of the value')
-    age = models.IntegerField(
+    epoch = models.IntegerField(
+        help_text='Epoch when the data was submitted')
+    shard = models.SmallIntegerField(
+        default=0,
+        help_text='Shard of the count within the epoch')
+
+    def __str__(self) -> str:
+        return (f'count: {self.count} of {self.value}, '
+                f'epoch: {self.epoch}')
+
+
+class Total(models.Model):
+    """
+    Published total count of a public value
+
+    Materialized sum of `Count.count` over all published counts
+    (i.e. with age >= 1) of the value.  It is maintained by shiftdata,
+    and can be rebuilt using the rebuildtotals command.  Only values
+    of public data classes have totals.
+
+    `value` is the value.
+    `data_class` is the class of the value (copied from `value`,
+    for the ranking index).
+    `count` is the total number of occurrences.
+    `rank` is the position of the value within its class, ordered
+    by descending count and then by value, or None if count is 0.
+    It is updated along with the counts.
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(
+                name='total_class_rank',
+                fields=['data_class', 'rank']),
+        ]
+
+    value = models.OneToOneField(
+        'Value',
+        help_text='The value',
+        on_delete=models.CASCADE,
+        primary_key=True)
+    data_class = models.ForeignKey(
+        'DataClass',
+        db_index=False,
+        help_text='Class of the value',
+        on_delete=models.CASCADE)
+    count = models.IntegerField(
+        default=0,
+        help_text='Total number of occurrences of the value')
+    rank = models.IntegerField(
+        help_text='Position of the value within its class by count',
+        null=True)
+
+    def __str__(self) -> str:
+        return f'total: {self.count} of {self.value}'
+
+
+class SpoolSegment(models.Model):
+    """
+    Spool segment that was applied to the counts
+
+    Used to ensure that a spool segment is never applied twice.
+    The entry is added in the same transaction as the counts from
+    the segment, and removed after the segment file is removed.
+
+    `name` is the segment file name.
+    """
+
+    name = models.CharField(
+        help_text='Segment file name',
+        max_length=128,
+        unique=True)
+
+    def __str__(self) -> str:
+        return f'spool segment: {self.name}'
+
+
+class SubmitterId(models.Model):
+    """
+    Submitter id seen in an epoch
+
+    Used to permit only one submission per id in GOOSE_MAX_PERIODS
+    periods.  The ids are stored as fixed-width hashes, and removed
+    by shiftdata once they are no longer needed.
+
+    `digest` is the hex-encoded hash of the id (see `hash_id()`).
+    `epoch` is the epoch of the submission.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name='unique_submitter_id',
+                fields=['digest', 'epoch']),
+        ]
+        indexes = [
+            models.Index(
+                name='submitterid_epoch_id',
+                fields=['epoch', 'id']),
+        ]
+
+    digest = models.CharField(
+        help_text='Hash of the submitter id',
+        max_length=32)
+    epoch = models.IntegerField(
+        help_text='Epoch of the submission')
+
+    @staticmethod
+    def hash_id(value: str) -> str:
+        """Get the digest of submitter id `value`"""
+        return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+    def __str__(self) -> str:
+        return f'submitter id: {self.digest} in epoch {self.epoch}'
+
+
+class RateLimitCounter(models.Model):
+    """
+    Number of submissions from a network in a time window
+
+    Used by the database backend of the submission rate limiter
+    (see `goose.ratelimit`).
+
+    `network` is the normalized client network (see
+    `goose.ratelimit.network_key()`).  `window` is the number
+    of the time window, and `count` is the number of submissions
+    accepted in it.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name='unique_rate_limit_counter',
+                fields=['network', 'window']),
+        ]
+        indexes = [
+            models.Index(
+                name='ratelimitcounter_window',
+                fields=['window']),
+        ]
+
+    network = models.BigIntegerField(
+        help_text='Normalized client network')
+    window = models.IntegerField(
+        help_text='Number of the time window')
+    count = models.IntegerField(
         default=0,
-        help_text='Age of data')
+        help_text='Number of submissions in the window')
 
     def __str__(self) -> str:
-        return (f'count: {self.count} of {self.value}, age: {self.age}')
+        return (f'rate limit counter: {self.count} from {self.network} '
+                f'in window {self.window}')
@@ -0,0 +1,327 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Sampling request profiler
+
+Enabled if settings.GOOSE_PROFILE_DIR is set.  A random fraction
+of requests (settings.GOOSE_PROFILE_SAMPLE_RATE) is sampled.
+The other requests only pay for a single random() call.
+
+For every sampled request, the wall time, SQL query count and SQL time
+are appended to samples.ndjson in the profile directory.  If the request
+took longer than settings.GOOSE_PROFILE_SLOW_THRESHOLD, a cProfile
+or tracemalloc dump (settings.GOOSE_PROFILE_MODE) is written along
+with a JSON summary including EXPLAIN output for the slowest query.
+Only the last settings.GOOSE_PROFILE_MAX_DUMPS dumps are kept.
+"""
+
+import asyncio
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+import typing
+
+from pathlib import Path
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.http import HttpRequest, HttpResponse
+
+from goose.metrics import (QueryTimer, instrument_streaming,
+                           request_connection)
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+# size of samples.ndjson at which it is rotated
+SAMPLES_LOG_SIZE = 1024 * 1024
+
+
+class SlowestQueryTimer(QueryTimer):
+    """QueryTimer that also keeps the slowest query"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.slowest_duration = 0.0
+        self.slowest_sql: typing.Optional[str] = None
+        self.slowest_params: typing.Any = None
+        self.slowest_many = False
+
+    def __call__(self,
+                 execute: typing.Callable[..., typing.Any],
+                 *args: typing.Any
+                 ) -> typing.Any:
+        before = self.duration
+        try:
+            return super().__call__(execute, *args)
+        finally:
+            elapsed = self.duration - before
+            if self.slowest_sql is None or elapsed > self.slowest_duration:
+                sql, params, many, _ = args
+                self.slowest_duration = elapsed
+                self.slowest_sql = sql
+                self.slowest_params = params
+                self.slowest_many = many
+
+
+class Profiler(object):
+    """Profiler for a single request, in one of PROFILE_MODES"""
+
+    def __init__(self, mode: str) -> None:
+        self.mode = mode
+        self.profile: typing.Optional[cProfile.Profile] = None
+        self.snapshot: typing.Optional[tracemalloc.Snapshot] = None
+        self.started_tracemalloc = False
+
+    def start(self) -> None:
+        """Start profiling, paused"""
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    @contextlib.contextmanager
+    def resumed(self) -> typing.Iterator[None]:
+        """Context manager profiling the code inside it"""
+        # tracemalloc keeps tracing until stop()
+        profile = self.profile
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # another thread is being profiled already
+                profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+
+    def stop(self) -> None:
+        if self.started_tracemalloc:
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def dump(self, path: Path) -> typing.Optional[Path]:
+        """Dump the profile into `path` with suffix, return the path"""
+        if self.profile is not None:
+            target = path.with_suffix('.prof')
+            self.profile.dump_stats(target)
+        elif self.snapshot is not None:
+            target = path.with_suffix('.tracemalloc')
+            self.snapshot.dump(str(target))
+        else:
+            return None
+        return target
+
+
+def explain(db: BaseDatabaseWrapper,
+            sql: str,
+            params: typing.Any
+            ) -> typing.List[str]:
+    """Get the query plan for `sql` using `db`, or the error if it fails"""
+    if sql.split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE',
+                                             'DELETE'):
+        return []
+    try:
+        with db.cursor() as cursor:
+            cursor.execute(f'{db.ops.explain_query_prefix()} {sql}', params)
+            return [' '.join(str(x) for x in row)
+                    for row in cursor.fetchall()]
+    except Exception as e:
+        return [f'EXPLAIN failed: {e}']
+
+
+def append_sample(directory: Path, record: typing.Dict[str, typing.Any]
+                  ) -> None:
+    """Append `record` to samples.ndjson, rotating it if necessary"""
+    path = directory / 'samples.ndjson'
+    try:
+        if path.stat().st_size >= SAMPLES_LOG_SIZE:
+            os.replace(path, directory / 'samples.ndjson.1')
+    except FileNotFoundError:
+        pass
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def rotate_dumps(directory: Path) -> None:
+    """Remove dumps exceeding settings.GOOSE_PROFILE_MAX_DUMPS"""
+    summaries = sorted(directory.glob('slow-*.json'))
+    for summary in summaries[:-settings.GOOSE_PROFILE_MAX_DUMPS or None]:
+        for path in directory.glob(f'{summary.stem}.*'):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def request_thread() -> typing.Tuple[BaseDatabaseWrapper, int]:
+    """Get the database connection and id of the current thread"""
+    return (request_connection(), threading.get_ident())
+
+
+class Sample(object):
+    """Profiling state of a single sampled request"""
+
+    def __init__(self, db: BaseDatabaseWrapper, thread: int) -> None:
+        self.db = db
+        self.thread = thread
+        self.timer = SlowestQueryTimer()
+        self.profiler = Profiler(settings.GOOSE_PROFILE_MODE)
+        self.start = time.perf_counter()
+        self.profiler.start()
+
+    @contextlib.contextmanager
+    def instrumented(self) -> typing.Iterator[None]:
+        """Profile the code and queries run in the context"""
+        with self.profiler.resumed():
+            with self.db.execute_wrapper(self.timer):
+                yield
+
+    def finisher(self,
+                 request: HttpRequest,
+                 response: HttpResponse
+                 ) -> typing.Callable[[], None]:
+        """Get the function recording the request once it is complete"""
+        def finish() -> None:
+            self.profiler.stop()
+            # async content finishes on the event loop, where
+            # the connection can not be used for EXPLAIN
+            explain_db = (self.db if threading.get_ident() == self.thread
+                          else None)
+            # never let profiling break the response
+            try:
+                ProfilingMiddleware.record(
+                    request, response, time.perf_counter() - self.start,
+                    self.timer, self.profiler, explain_db)
+            except Exception:
+                logger.exception('Recording request profile failed')
+        return finish
+
+
+class ProfilingMiddleware(object):
+    """
+    Middleware profiling a sample of requests
+
+    Removed from the chain if settings.GOOSE_PROFILE_DIR is not set.
+    It supports both sync and async requests.  Streaming responses
+    are profiled until their content is exhausted.  cProfile profiles
+    only the current thread, so for async views and content it covers
+    the event loop rather than the database thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self,
+                 get_response: typing.Callable[[HttpRequest], typing.Any]
+                 ) -> None:
+        if settings.GOOSE_PROFILE_DIR is None:
+            raise MiddlewareNotUsed()
+        if settings.GOOSE_PROFILE_MODE not in PROFILE_MODES:
+            raise ImproperlyConfigured(
+                f'Invalid GOOSE_PROFILE_MODE: '
+                f'{settings.GOOSE_PROFILE_MODE}')
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest) -> typing.Any:
+        if self.is_async:
+            return self.acall(request)
+        if random.random() >= settings.GOOSE_PROFILE_SAMPLE_RATE:
+            return self.get_response(request)
+
+        # bind the connection of this thread, for async content
+        sample = Sample(*request_thread())
+        try:
+            with sample.instrumented():
+                response = self.get_response(request)
+        except BaseException:
+            sample.profiler.stop()
+            raise
+
+        finish = sample.finisher(request, response)
+        if not instrument_streaming(response, sample.instrumented, finish):
+            finish()
+        return response
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        """Async variant of __call__()"""
+        if random.random() >= settings.GOOSE_PROFILE_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        sample = Sample(*await sync_to_async(request_thread)())
+        try:
+            with sample.instrumented():
+                response = await self.get_response(request)
+        except BaseException:
+            sample.profiler.stop()
+            raise
+
+        finish = sample.finisher(request, response)
+        if not instrument_streaming(response, sample.instrumented, finish):
+            # finish on the request thread, to be able to EXPLAIN
+            await sync_to_async(finish)()
+        return response
+
+    @staticmethod
+    def record(request: HttpRequest,
+               response: HttpResponse,
+               duration: float,
+               timer: SlowestQueryTimer,
+               profiler: Profiler,
+               db: typing.Optional[BaseDatabaseWrapper]
+               ) -> None:
+        """
+        Record the sample of a finished request
+
+        The slowest query is explained using `db`, unless it is None.
+        """
+        match = request.resolver_match
+        now = datetime.datetime.utcnow()
+        record: typing.Dict[str, typing.Any] = {
+            'time': now.isoformat(),
+            'view': match.url_name if match is not None else None,
+            'method': request.method,
+            'status': response.status_code,
+            'wall_time': duration,
+            'sql_count': timer.queries,
+            'sql_time': timer.duration,
+        }
+        directory = Path(settings.GOOSE_PROFILE_DIR)
+        append_sample(directory, record)
+
+        if duration >= settings.GOOSE_PROFILE_SLOW_THRESHOLD:
+            stem = now.strftime('slow-%Y%m%d-%H%M%S-%f') + f'-{os.getpid()}'
+            path = directory / stem
+            dump = profiler.dump(path)
+            record['profile'] = dump.name if dump is not None else None
+            if timer.slowest_sql is not None:
+                record['slowest_sql'] = {
+                    'sql': timer.slowest_sql,
+                    'params': repr(timer.slowest_params),
+                    'time': timer.slowest_duration,
+                    'explain': (explain(db,
+                                        timer.slowest_sql,
+                                        timer.slowest_params)
+                                if db is not None and not timer.slowest_many
+                                else []),
+                }
+            with open(path.with_suffix('.json'), 'w') as f:
+                json.dump(record, f, indent=2)
+            rotate_dumps(directory)
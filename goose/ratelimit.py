@@ -0,0 +1,150 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Per-network submission rate limiter
+
+Submissions are limited to settings.GOOSE_MAX_SUBMISSIONS_PER_IP
+per settings.GOOSE_RATE_LIMIT_WINDOW, per IPv4 address or IPv6 /64
+network.  The sliding window is approximated using the counts
+from the current and the previous fixed window: the previous count
+is weighted by the part of the previous window that is still within
+the sliding window.
+
+The counters are kept by the backend specified
+in settings.GOOSE_RATE_LIMIT_BACKEND, and need to be shared
+by all worker processes.
+
+The limit is best-effort: it is checked before the report is parsed,
+and the submission is counted only once it is stored.  Concurrent
+submissions from one network can therefore exceed the limit by up
+to the number of requests processed in parallel.  This is a deliberate
+trade-off, as reserving the submission before parsing would require
+releasing it for every rejected report.
+"""
+
+import abc
+import functools
+import ipaddress
+import time
+import typing
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.utils.module_loading import import_string
+
+from goose.models import RateLimitCounter
+
+
+class Backend(abc.ABC):
+    """
+    Base class for rate limiter backends
+
+    counts() and increment() are called separately, so they do not need
+    to be atomic together.  increment() must not lose concurrent
+    increments though.
+    """
+
+    @abc.abstractmethod
+    def counts(self, network: int, window: int) -> typing.Tuple[int, int]:
+        """Return submission counts in the previous and `window`"""
+
+    @abc.abstractmethod
+    def increment(self, network: int, window: int) -> None:
+        """Increase submission count in `window`"""
+
+    @abc.abstractmethod
+    def prune(self, window: int) -> None:
+        """Remove counts from windows older than `window`"""
+
+
+class DatabaseBackend(Backend):
+    """Backend storing counters in `RateLimitCounter` table"""
+
+    def counts(self, network: int, window: int) -> typing.Tuple[int, int]:
+        counts = dict(RateLimitCounter.objects
+                      .filter(network=network,
+                              window__in=(window - 1, window))
+                      .values_list('window', 'count'))
+        return (counts.get(window - 1, 0), counts.get(window, 0))
+
+    def increment(self, network: int, window: int) -> None:
+        counter = RateLimitCounter.objects.filter(network=network,
+                                                  window=window)
+        if counter.update(count=models.F('count') + 1):
+            return
+        try:
+            with transaction.atomic():
+                RateLimitCounter.objects.create(network=network,
+                                                window=window,
+                                                count=1)
+        except IntegrityError:
+            # created concurrently
+            counter.update(count=models.F('count') + 1)
+
+    def prune(self, window: int) -> None:
+        RateLimitCounter.objects.filter(window__lt=window).delete()
+
+
+@functools.lru_cache()
+def _load_backend(path: str) -> Backend:
+    return import_string(path)()
+
+
+def get_backend() -> Backend:
+    """Get the configured backend instance"""
+    return _load_backend(settings.GOOSE_RATE_LIMIT_BACKEND)
+
+
+def network_key(address: str) -> typing.Optional[int]:
+    """
+    Normalize client `address` into a network key
+
+    IPv6 addresses are truncated to the /64 prefix, and IPv4 addresses
+    are mapped into the /64 prefix of their 6to4 network.  The prefix
+    is returned as a signed 64-bit integer.  Returns None if `address`
+    is not a valid IP address.
+    """
+
+    try:
+        addr = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if isinstance(addr, ipaddress.IPv6Address):
+        if addr.ipv4_mapped is not None:
+            addr = addr.ipv4_mapped
+    if isinstance(addr, ipaddress.IPv4Address):
+        prefix = b'\x20\x02' + addr.packed + b'\x00\x00'
+    else:
+        prefix = addr.packed[:8]
+    return int.from_bytes(prefix, 'big', signed=True)
+
+
+def current_window() -> typing.Tuple[int, float]:
+    """Return the current window and the elapsed fraction of it"""
+    pos = time.time() / settings.GOOSE_RATE_LIMIT_WINDOW.total_seconds()
+    return (int(pos), pos - int(pos))
+
+
+def limit_exceeded(network: int) -> bool:
+    """Check whether `network` has exhausted its submission limit"""
+    limit = settings.GOOSE_MAX_SUBMISSIONS_PER_IP
+    if limit is None:
+        return False
+    window, elapsed = current_window()
+    previous, current = get_backend().counts(network, window)
+    return previous * (1 - elapsed) + current >= limit
+
+
+def record(network: int) -> None:
+    """Record an accepted submission from `network`"""
+    if settings.GOOSE_MAX_SUBMISSIONS_PER_IP is None:
+        return
+    window, _ = current_window()
+    get_backend().increment(network, window)
+
+
+def prune() -> None:
+    """Remove counters that no longer affect the limit"""
+    window, _ = current_window()
+    get_backend().prune(window - 1)
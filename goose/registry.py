@@ -0,0 +1,101 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""Process-local cache of DataClass rows"""
+
+import datetime
+import time
+import typing
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from goose.ingest import Validator, compile_validator
+from goose.models import DataClass
+
+
+Signature = typing.Tuple[int, typing.Optional[datetime.datetime]]
+
+_data_classes: typing.Optional[typing.Dict[str, DataClass]] = None
+_validator: typing.Optional[Validator] = None
+# signature of the cached data classes, see signature()
+_signature: typing.Optional[Signature] = None
+# time.monotonic() at which check() queries the database next
+_next_check = 0.0
+
+
+def data_classes() -> typing.Dict[str, DataClass]:
+    """
+    Get all data classes, keyed by name
+
+    The data classes are loaded from the database on the first call,
+    and cached afterwards.  The cache is invalidated whenever
+    a `DataClass` is saved or deleted in this process (via signals),
+    and by check() if it was changed by another process.
+    """
+
+    global _data_classes, _signature, _next_check
+    ret = _data_classes
+    if ret is None:
+        ret = dict((x.name, x) for x
+                   in DataClass.objects.order_by('id'))
+        _signature = (len(ret),
+                      max((x.updated for x in ret.values()), default=None))
+        _next_check = time.monotonic() + settings.GOOSE_REGISTRY_TTL
+        _data_classes = ret
+    return ret
+
+
+def data_class(name: str) -> DataClass:
+    """Get data class by name, raise DataClass.DoesNotExist if none"""
+    try:
+        return data_classes()[name]
+    except KeyError:
+        raise DataClass.DoesNotExist(f'No data class named {name}')
+
+
+def validator() -> Validator:
+    """Get report validator compiled for all data classes"""
+    global _validator
+    ret = _validator
+    if ret is None:
+        ret = compile_validator(data_classes().values())
+        _validator = ret
+    return ret
+
+
+def signature() -> Signature:
+    """
+    Get the signature of the data classes in the database
+
+    The signature is the row count and the last update time, so it
+    changes whenever a data class is added, removed or saved.
+    """
+    ret = DataClass.objects.aggregate(count=Count('id'),
+                                      updated=Max('updated'))
+    return (ret['count'], ret['updated'])
+
+
+def check(**kwargs: typing.Any) -> None:
+    """
+    Invalidate the cache if the data classes were changed elsewhere
+
+    The signature is queried at most once per settings.GOOSE_REGISTRY_TTL
+    seconds (usable as a signal handler, called at request start).
+    """
+    global _next_check
+    if _data_classes is None:
+        return
+    now = time.monotonic()
+    if now < _next_check:
+        return
+    _next_check = now + settings.GOOSE_REGISTRY_TTL
+    if signature() != _signature:
+        invalidate()
+
+
+def invalidate(**kwargs: typing.Any) -> None:
+    """Invalidate the cache (usable as a signal handler)"""
+    global _data_classes, _validator
+    _data_classes = None
+    _validator = None
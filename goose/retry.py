@@ -0,0 +1,64 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Retrying transactions that failed due to lock contention
+
+The transaction is retried up to settings.GOOSE_DB_LOCK_RETRIES
+times, with exponential backoff starting
+at settings.GOOSE_DB_LOCK_RETRY_DELAY.
+"""
+
+import random
+import time
+import typing
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+
+T = typing.TypeVar('T')
+
+# SQLite error messages
+LOCK_MESSAGES = ('database is locked', 'database table is locked')
+# PostgreSQL serialization_failure and deadlock_detected
+LOCK_PGCODES = ('40001', '40P01')
+
+
+def is_lock_error(e: Exception) -> bool:
+    """Check whether `e` is a transient lock error"""
+    if not isinstance(e, OperationalError):
+        return False
+    if getattr(e.__cause__, 'pgcode', None) in LOCK_PGCODES:
+        return True
+    return any(x in str(e) for x in LOCK_MESSAGES)
+
+
+def atomic(func: typing.Callable[[], T]) -> T:
+    """
+    Call `func` in a transaction, retrying on lock errors
+
+    `func` may be called multiple times, so it must not have side
+    effects outside the database.  If called within a transaction
+    already, the error is propagated, as only the outermost transaction
+    can be retried.
+    """
+
+    if connection.in_atomic_block:
+        with transaction.atomic():
+            return func()
+
+    delay = settings.GOOSE_DB_LOCK_RETRY_DELAY
+    for retry in range(settings.GOOSE_DB_LOCK_RETRIES):
+        try:
+            with transaction.atomic():
+                return func()
+        except OperationalError as e:
+            if not is_lock_error(e):
+                raise
+        # add jitter, so that the retries do not collide again
+        time.sleep(delay * random.uniform(0.5, 1))
+        delay *= 2
+
+    with transaction.atomic():
+        return func()
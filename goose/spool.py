@@ -0,0 +1,218 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""
+Write-behind spool for submissions
+
+If settings.GOOSE_SPOOL_DIR is set, submit() only appends validated
+reports to the spool, and they are merged into counts in bulk
+by `flush()` (called by the flushsubmissions and shiftdata commands).
+
+The reports are appended to 'current.spool' file, one record per line.
+Every record consists of CRC32 of the JSON data (as 8 hex digits),
+a space and the JSON-encoded report.  Records are appended under
+an exclusive lock, and the file is fsync()-ed after every write.
+Records that are not terminated or whose checksum does not match
+are the result of an interrupted write, and are discarded.
+
+`flush()` renames the current file into a new segment, and applies
+every segment in a separate transaction.  The segment name is recorded
+in `SpoolSegment` within the same transaction, so that the segment
+is never applied twice if the process is interrupted before removing
+the segment file.
+"""
+
+import contextlib
+import fcntl
+import os
+import time
+import typing
+import uuid
+import zlib
+
+from pathlib import Path
+
+from django.conf import settings
+
+from goose import jsoncodec, registry, retry
+from goose.ingest import (
+    GooseDataError,
+    ReportCounts,
+    add_reports,
+    )
+from goose.models import Epoch, SpoolSegment
+
+
+CURRENT_FILE = 'current.spool'
+LOCK_FILE = 'spool.lock'
+FLUSH_LOCK_FILE = 'flush.lock'
+SEGMENT_SUFFIX = '.segment'
+
+
+class FlushResult(typing.NamedTuple):
+    segments: int
+    reports: int
+    rejected: int
+    corrupted: int
+
+
+def spool_dir() -> typing.Optional[Path]:
+    """Get the spool directory, or None if spool is disabled"""
+    if settings.GOOSE_SPOOL_DIR is None:
+        return None
+    return Path(settings.GOOSE_SPOOL_DIR)
+
+
+@contextlib.contextmanager
+def locked(path: Path) -> typing.Iterator[None]:
+    """Hold an exclusive lock on `path` (created if necessary)"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: Path) -> None:
+    """fsync() directory `path` to persist renames"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_record(report: typing.Dict[str, typing.Any]) -> bytes:
+    """Encode `report` as a spool record"""
+    data = jsoncodec.dumps(report)
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+
+def decode_record(line: bytes) -> typing.Dict[str, typing.Any]:
+    """Decode spool record, raise ValueError if it is corrupted"""
+    if not line.endswith(b'\n') or line[8:9] != b' ':
+        raise ValueError('Truncated record')
+    data = line[9:-1]
+    if int(line[:8], 16) != zlib.crc32(data):
+        raise ValueError('Checksum mismatch')
+    ret = jsoncodec.loads(data)
+    if not isinstance(ret, dict):
+        raise ValueError('Malformed record')
+    return ret
+
+
+def append(report: typing.Dict[str, typing.Any]) -> None:
+    """Durably append a validated `report` to the spool"""
+    append_many([report])
+
+
+def append_many(reports: typing.Iterable[typing.Dict[str, typing.Any]]
+                ) -> None:
+    """Durably append multiple validated `reports` to the spool"""
+    path = spool_dir()
+    assert path is not None
+    records = b''.join(encode_record(x) for x in reports)
+    if not records:
+        return
+    with locked(path / LOCK_FILE):
+        fd = os.open(path / CURRENT_FILE,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size > 0:
+                # terminate a record left over from an interrupted
+                # write, so that it does not corrupt the new one
+                with open(path / CURRENT_FILE, 'rb') as f:
+                    f.seek(size - 1)
+                    if f.read(1) != b'\n':
+                        records = b'\n' + records
+            os.write(fd, records)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if size == 0:
+            fsync_dir(path)
+
+
+def rotate(path: Path) -> None:
+    """Turn the current spool file into a new segment"""
+    with locked(path / LOCK_FILE):
+        current = path / CURRENT_FILE
+        if not current.exists() or current.stat().st_size == 0:
+            return
+        name = (f'{int(time.time() * 1000000):020d}-'
+                f'{uuid.uuid4().hex}{SEGMENT_SUFFIX}')
+        current.rename(path / name)
+        fsync_dir(path)
+
+
+def read_segment(path: Path
+                 ) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]],
+                                   int]:
+    """Read reports from segment, return (reports, corrupted count)"""
+    reports = []
+    corrupted = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                reports.append(decode_record(line))
+            except ValueError:
+                corrupted += 1
+    return reports, corrupted
+
+
+def apply_segment(path: Path) -> FlushResult:
+    """Apply a single segment in one transaction"""
+    reports, corrupted = read_segment(path)
+    max_age = settings.GOOSE_MAX_PERIODS
+    id_cls = registry.data_class('id')
+    validate = registry.validator()
+
+    folded: typing.List[typing.Tuple[str, ReportCounts]] = []
+    for report in reports:
+        try:
+            counts = validate(report)
+        except GooseDataError:
+            continue
+        if counts.pop(id_cls, None) is None:
+            continue
+        folded.append((report['id'], counts))
+
+    def apply() -> int:
+        # the ids are verified again, as they could have been used
+        # since the report was spooled
+        accepted = sum(add_reports(folded,
+                                   Epoch.get_current(for_write=True),
+                                   max_age))
+        SpoolSegment.objects.create(name=path.name)
+        return accepted
+
+    accepted = retry.atomic(apply)
+
+    return FlushResult(segments=1,
+                       reports=accepted,
+                       rejected=len(reports) - accepted,
+                       corrupted=corrupted)
+
+
+def flush() -> FlushResult:
+    """Apply all spooled submissions to counts"""
+    ret = FlushResult(0, 0, 0, 0)
+    path = spool_dir()
+    if path is None:
+        return ret
+
+    with locked(path / FLUSH_LOCK_FILE):
+        rotate(path)
+        for segment in sorted(path.glob(f'*{SEGMENT_SUFFIX}')):
+            # if the segment is already recorded, we were interrupted
+            # before removing it
+            if not SpoolSegment.objects.filter(name=segment.name).exists():
+                result = apply_segment(segment)
+                ret = FlushResult(*(x + y for x, y in zip(ret, result)))
+            segment.unlink()
+            SpoolSegment.objects.filter(name=segment.name).delete()
+
+    return ret
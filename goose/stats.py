@@ -0,0 +1,467 @@
+# (c) 2020 Michał Górny
+# 2-clause BSD license
+
+"""Public statistics rendering"""
+
+import base64
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import sys
+import tempfile
+import typing
+
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, models, transaction
+
+from goose import compression, jsoncodec, registry
+from goose.ingest import batch_size
+from goose.models import Count, DataClass, Epoch, Total, Value
+
+
+# number of rows fetched from the database at once
+STATS_CHUNK_ROWS = 2000
+# approximate size of chunks yielded by iter_stats()
+STATS_CHUNK_BYTES = 65536
+
+encode_string = json.encoder.encode_basestring_ascii  # type: ignore
+
+# orders supported by class_stats_page()
+CLASS_STATS_ORDERS = ('count', 'value')
+
+# process-local cache of compressed stats: encoding -> (stamp, data)
+_compressed_stats: typing.Dict[str, typing.Tuple[str, bytes]] = {}
+
+
+def last_update() -> typing.Optional[str]:
+    """Get the timestamp of the last shiftdata run"""
+    return (Count.objects.filter(
+                value__data_class=registry.data_class('stamp'))
+            .aggregate(models.Max('value__value'))
+            ['value__value__max'])
+
+
+def parse_stamp(stamp: str) -> datetime.datetime:
+    """Parse the timestamp returned by last_update()"""
+    # TODO: replace it with fromisoformat() when infra manages
+    # to switch to py3.7
+    return datetime.datetime.strptime(stamp.split('.')[0],
+                                      '%Y-%m-%dT%H:%M:%S')
+
+
+def iter_stats(stamp: typing.Optional[str]) -> typing.Iterator[bytes]:
+    """
+    Render the public statistics document for `stamp` as JSON
+
+    The counts are taken from `Total` table.  All public data classes
+    are included, even if they have no published values yet.
+    The document is rendered incrementally from a database cursor,
+    in chunks of approximately `STATS_CHUNK_BYTES`, so that memory use
+    does not depend on the number of values.  The output is identical
+    to json.dumps() of the document.
+    """
+
+    public = [cls.id for cls in registry.data_classes().values()
+              if cls.public]
+    # filtering on class ids lets the database use the index
+    # on data_class instead of scanning all values
+    totals = itertools.groupby(
+        Total.objects
+        .filter(value__data_class_id__in=public, count__gt=0)
+        .order_by('value__data_class_id', 'value__id')
+        .values_list('value__data_class_id', 'value__value', 'count')
+        .iterator(chunk_size=STATS_CHUNK_ROWS),
+        key=lambda x: x[0])
+    group = next(totals, None)
+
+    buf: typing.List[str] = ['{']
+    buf_len = 0
+    for cls in registry.data_classes().values():
+        if not cls.public:
+            continue
+        buf.append(encode_string(cls.name))
+        buf.append(': {')
+        if group is not None and group[0] == cls.id:
+            sep = ''
+            for _, value, total_count in group[1]:
+                buf += (sep, encode_string(value), ': ', str(total_count))
+                sep = ', '
+                buf_len += len(value)
+                if buf_len >= STATS_CHUNK_BYTES:
+                    yield ''.join(buf).encode()
+                    buf = []
+                    buf_len = 0
+            group = next(totals, None)
+        buf.append('}, ')
+    buf.append(f'"last-update": {json.dumps(stamp)}}}')
+    yield ''.join(buf).encode()
+
+
+def compressed_stats(stamp: str, encoding: str) -> bytes:
+    """
+    Get the statistics document for `stamp` compressed using `encoding`
+
+    The compressed document is cached by the process, and reused
+    until the stamp changes.  It is not cached if shiftdata has been
+    run while it was being rendered, as the counts could be newer
+    than `stamp` then.
+    """
+
+    cached = _compressed_stats.get(encoding)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    data = compression.compress(iter_stats(stamp), encoding)
+    if last_update() == stamp:
+        _compressed_stats[encoding] = (stamp, data)
+    return data
+
+
+def clear_compressed_stats() -> None:
+    """Clear the cache of compressed stats"""
+    _compressed_stats.clear()
+
+
+def encode_cursor(fields: typing.List[typing.Any]) -> str:
+    """Encode pagination cursor"""
+    return (base64.urlsafe_b64encode(jsoncodec.dumps(fields))
+            .decode().rstrip('='))
+
+
+def decode_cursor(cursor: str) -> typing.List[typing.Any]:
+    """Decode pagination cursor, raise ValueError if it is malformed"""
+    try:
+        fields = json.loads(
+            base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError('Malformed cursor')
+    if not isinstance(fields, list) or len(fields) != 5:
+        raise ValueError('Malformed cursor')
+    return fields
+
+
+def prefix_filter(field: str, prefix: str) -> models.Q:
+    """
+    Match `field` values starting with `prefix`
+
+    The range lets the database use an index on `field`.
+    """
+
+    q = models.Q(**{f'{field}__gte': prefix,
+                    f'{field}__startswith': prefix})
+    if ord(prefix[-1]) < sys.maxunicode:
+        q &= models.Q(**{f'{field}__lt':
+                         prefix[:-1] + chr(ord(prefix[-1]) + 1)})
+    return q
+
+
+def class_stats_page(cls: DataClass,
+                     stamp: typing.Optional[str],
+                     limit: int,
+                     order: str = 'count',
+                     prefix: str = '',
+                     top: typing.Optional[int] = None,
+                     cursor: typing.Optional[str] = None
+                     ) -> typing.Tuple[typing.List[typing.Tuple[str, int]],
+                                       typing.Optional[str]]:
+    """
+    Get a page of the published values of `cls`
+
+    Values are ordered by `order` (descending count, or value),
+    and filtered to those starting with `prefix`.  At most `limit`
+    values are returned, and at most `top` over all pages.  `cursor`
+    is the cursor returned for the previous page.
+
+    The values are read from `Total` via the (data_class, rank) index
+    when ordered by count, or via the (data_class, value) index
+    when ordered by value, starting right after the cursor.  Only
+    `prefix` with count order needs to skip the non-matching values.
+
+    Returns a list of (value, count) tuples and the cursor for the next
+    page (None if this is the last page).  Raises ValueError
+    if the cursor is malformed, or does not match the query or `stamp`.
+    """
+
+    after = None
+    returned = 0
+    if cursor is not None:
+        fields = decode_cursor(cursor)
+        if fields[:3] != [stamp, order, prefix]:
+            raise ValueError('Cursor does not match the query, or the stats '
+                             'have been updated since')
+        after, returned = fields[3:]
+        if (not isinstance(after, int if order == 'count' else str)
+                or not isinstance(returned, int)):
+            raise ValueError('Malformed cursor')
+    if top is not None:
+        limit = min(limit, top - returned)
+    if limit <= 0:
+        return ([], None)
+
+    rows: models.QuerySet
+    if order == 'count':
+        rows = Total.objects.filter(data_class=cls, rank__isnull=False)
+        if prefix:
+            rows = rows.filter(prefix_filter('value__value', prefix))
+        if after is not None:
+            rows = rows.filter(rank__gt=after)
+        rows = (rows
+                .order_by('rank')
+                .values_list('value__value', 'count', 'rank'))
+    else:
+        rows = Value.objects.filter(data_class=cls,
+                                    total__rank__isnull=False)
+        if prefix:
+            rows = rows.filter(prefix_filter('value', prefix))
+        if after is not None:
+            rows = rows.filter(value__gt=after)
+        rows = (rows
+                .order_by('value')
+                .values_list('value', 'total__count', 'value'))
+
+    page = list(rows[:limit + 1])
+    next_cursor = None
+    if len(page) > limit and (top is None or returned + limit < top):
+        next_cursor = encode_cursor(
+            [stamp, order, prefix, page[limit - 1][2], returned + limit])
+    return ([(value, count) for value, count, _ in page[:limit]],
+            next_cursor)
+
+
+def live_totals() -> models.QuerySet:
+    """Compute published totals of public values from counts"""
+    epoch = Epoch.objects.get()
+    counts = Count.objects.filter(epoch__lt=epoch.current,
+                                  value__data_class__public=True)
+    if epoch.expired is not None:
+        counts = counts.filter(epoch__gte=epoch.expired)
+    return (counts
+            .values('value', 'value__data_class')
+            .annotate(total=models.Sum('count'))
+            .filter(total__gt=0))
+
+
+def rebuild_totals() -> None:
+    """Recompute `Total` table from scratch"""
+    with transaction.atomic():
+        Total.objects.all().delete()
+        Total.objects.bulk_create(
+            (Total(value_id=x['value'],
+                   data_class_id=x['value__data_class'],
+                   count=x['total'])
+             for x in live_totals()),
+            batch_size=batch_size(3))
+        rank_totals()
+
+
+def ranked_totals(classes: typing.List[DataClass]) -> models.QuerySet:
+    """Get (pk, new_rank) of positive totals of `classes`"""
+    return (Total.objects
+            .filter(data_class__in=classes, count__gt=0)
+            .annotate(new_rank=models.Window(
+                expression=models.functions.RowNumber(),
+                partition_by=models.F('data_class'),
+                order_by=(models.F('count').desc(),
+                          models.F('value__value').asc())))
+            .order_by()
+            .values_list('pk', 'new_rank'))
+
+
+def can_rank_in_update() -> bool:
+    """Check whether ranks can be updated using a single UPDATE"""
+    if not connection.features.supports_over_clause:
+        return False
+    if connection.vendor == 'sqlite':
+        # UPDATE ... FROM was added in SQLite 3.33
+        return connection.Database.sqlite_version_info >= (3, 33)
+    return connection.vendor in ('mysql', 'postgresql')
+
+
+def rank_totals() -> None:
+    """
+    Update `Total.rank` after the counts changed
+
+    Values are ranked within their class by descending count,
+    and then by value.  Only the rows whose rank changed are updated.
+    If the database supports it, the ranks are computed and updated
+    by a single UPDATE query.  Otherwise, they are computed in Python
+    and updated in batches.
+    """
+
+    classes = [cls for cls in registry.data_classes().values()
+               if cls.public]
+    if not classes:
+        return
+    (Total.objects
+     .filter(data_class__in=classes, rank__isnull=False, count__lte=0)
+     .update(rank=None))
+
+    if can_rank_in_update():
+        qn = connection.ops.quote_name
+        table = qn(Total._meta.db_table)
+        pk = qn(Total._meta.pk.column)
+        rank = qn(Total._meta.get_field('rank').column)
+        subquery, params = ranked_totals(classes).query.sql_with_params()
+        changed = (f'{table}.{pk} = ranked.{pk} AND '
+                   f'({table}.{rank} IS NULL OR '
+                   f'{table}.{rank} <> ranked.new_rank)')
+        if connection.vendor == 'mysql':
+            sql = (f'UPDATE {table} INNER JOIN ({subquery}) ranked '
+                   f'ON {changed} SET {table}.{rank} = ranked.new_rank')
+        else:
+            sql = (f'UPDATE {table} SET {rank} = ranked.new_rank '
+                   f'FROM ({subquery}) ranked WHERE {changed}')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return
+
+    for cls in classes:
+        ranked = (Total.objects
+                  .filter(data_class=cls, count__gt=0)
+                  .order_by('-count', 'value__value')
+                  .values_list('pk', 'rank'))
+        Total.objects.bulk_update(
+            (Total(pk=pk, rank=rank)
+             for rank, (pk, old_rank) in enumerate(ranked, start=1)
+             if old_rank != rank),
+            ['rank'],
+            batch_size=batch_size(3))
+
+
+def check_totals() -> typing.Iterator[typing.Tuple[Value, int, int]]:
+    """Yield (value, stored total, live total) for mismatched totals"""
+    live = dict((x['value'], x['total']) for x in live_totals())
+    for total in Total.objects.select_related('value'):
+        expected = live.pop(total.value_id, 0)
+        if total.count != expected:
+            yield (total.value, total.count, expected)
+    for value in Value.objects.filter(id__in=live.keys()):
+        yield (value, 0, live[value.id])
+
+
+def shift_totals(epoch: Epoch, keep_periods: int) -> None:
+    """
+    Update `Total` table prior to switching to the next epoch
+
+    `epoch` is the (locked) current epoch.  Subtracts the counts that
+    are going to be discarded (age >= `keep_periods`) and adds
+    the counts that are going to be published (age == 0), and updates
+    the ranks.  Needs to be called before switching the epoch, after
+    merging the shards of the current epoch.  Updates `epoch.expired`
+    but does not save it.
+
+    Only the counts that were not discarded before are subtracted,
+    so that the counts left over from an interrupted expiry are not
+    subtracted twice.
+    """
+
+    current = epoch.current
+    expired = current + 1 - keep_periods
+    if epoch.expired is not None:
+        expired = max(expired, epoch.expired)
+    discarded = {'epoch__lt': expired}
+    if epoch.expired is not None:
+        discarded['epoch__gte'] = epoch.expired
+
+    def period_sum(**kwargs: typing.Any) -> models.Subquery:
+        return models.Subquery(
+            Count.objects
+            .filter(value=models.OuterRef('value'), **kwargs)
+            .values('value')
+            .annotate(total=models.Sum('count'))
+            .values('total'))
+
+    (Total.objects
+     .filter(value__in=Count.objects
+             .filter(**discarded)
+             .values('value'))
+     .update(count=models.F('count') - period_sum(**discarded)))
+    (Total.objects
+     .filter(value__in=Count.objects.filter(epoch=current).values('value'))
+     .update(count=models.F('count') + period_sum(epoch=current)))
+    Total.objects.bulk_create(
+        (Total(value_id=value_id, data_class_id=data_class_id, count=count)
+         for value_id, data_class_id, count in Count.objects
+         .filter(epoch=current,
+                 value__data_class__public=True,
+                 value__total=None)
+         .values_list('value_id', 'value__data_class_id', 'count')),
+        batch_size=batch_size(3))
+    rank_totals()
+    epoch.expired = expired
+
+
+def snapshot_path() -> typing.Optional[Path]:
+    """Get the stats snapshot path, or None if snapshots are disabled"""
+    if settings.GOOSE_STATS_SNAPSHOT is None:
+        return None
+    return Path(settings.GOOSE_STATS_SNAPSHOT)
+
+
+def snapshot_matches(path: Path, stamp: typing.Optional[str]) -> bool:
+    """
+    Check whether snapshot at `path` exists and matches `stamp`
+
+    The snapshot is written after shiftdata transaction is committed,
+    so it can be outdated for a short while.  The stamp is always
+    the last key in the document, so it suffices to check the tail.
+    """
+
+    tail = json.dumps({'last-update': stamp})[1:].encode()
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - len(tail)))
+            return f.read() == tail
+    except FileNotFoundError:
+        return False
+
+
+def write_snapshot(chunks: typing.Iterable[bytes]) -> None:
+    """
+    Write stats snapshot from `chunks`, along with compressed variants
+
+    All files are written into temporary files first, and then renamed
+    into place.  The main file is renamed last, so that the variants
+    are ready when it is replaced.
+    """
+
+    path = snapshot_path()
+    assert path is not None
+    targets: typing.List[typing.Tuple[Path,
+                                      typing.Optional[compression.Writer]]]
+    targets = [(path.with_name(path.name + suffix), writer)
+               for _, suffix, writer in compression.ENCODERS]
+    targets.append((path, None))
+
+    with contextlib.ExitStack() as stack:
+        files = []
+        writers = []
+        for target, writer in targets:
+            f = stack.enter_context(
+                tempfile.NamedTemporaryFile(dir=target.parent,
+                                            prefix=f'.{target.name}.',
+                                            delete=False))
+            files.append(f)
+            writers.append(writer(f) if writer is not None else f)
+
+        try:
+            for chunk in chunks:
+                for w in writers:
+                    w.write(chunk)
+            for f, w in zip(files, writers):
+                if w is not f:
+                    w.close()
+                f.flush()
+                os.fsync(f.fileno())
+                os.chmod(f.name, 0o644)
+            for f, (target, _) in zip(files, targets):
+                os.replace(f.name, target)
+        except BaseException:
+            for f in files:
+                if os.path.exists(f.name):
+                    os.unlink(f.name)
+            raise
@@ -1,15 +1,66 @@
 # (c) 2020 Michał Górny
 # 2-clause BSD license
 
+import asyncio
+import collections
 import datetime
-
+import gzip
+import io
+import json
+import multiprocessing
+import pstats
+import re
+import sqlite3
+import tempfile
+import threading
+import tracemalloc
+import typing
+import unittest.mock
+
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
 from django.conf import settings
 from django.core import management
-from django.db import transaction
-from django.test import TestCase
-from django.urls import reverse
-
-from goose.models import Count, DataClass, Value
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, connection, models, transaction
+from django.http import FileResponse, HttpRequest, HttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+
+from goose import (
+    compression,
+    jsoncodec,
+    metrics,
+    profiling,
+    ratelimit,
+    registry,
+    retry,
+    spool,
+    stats,
+    views,
+    )
+from goose.benchmark import codecs as benchmark_codecs
+from goose.benchmark import concurrency as benchmark_concurrency
+from goose.benchmark import runner as benchmark_runner
+from goose.backends.sqlite3.base import (
+    DatabaseWrapper as SQLiteDatabaseWrapper,
+    )
+from goose.benchmark.workload import Workload
+from goose.ingest import merge_shards, value_cache
+from goose.management.commands import shiftdata
+from goose.models import (
+    Count,
+    DataClass,
+    Epoch,
+    RateLimitCounter,
+    SpoolSegment,
+    SubmitterId,
+    Total,
+    Value,
+    share_lock_clause,
+    )
 
 
 class CountTuple(tuple):
@@ -38,6 +89,10 @@ def value_to_tuple(value: Value) -> tuple:
             value.value)
 
 
+def age_to_epoch(age: int) -> int:
+    return Epoch.get_current() - age
+
+
 def create_stamp(dt: datetime.datetime) -> datetime.datetime:
     stamp = DataClass.objects.get(name='stamp')
     with transaction.atomic():
@@ -46,7 +101,7 @@ def create_stamp(dt: datetime.datetime) -> datetime.datetime:
                 data_class=stamp,
                 value=dt.isoformat()),
             count=1,
-            age=1)
+            epoch=age_to_epoch(1))
     return dt
 
 
@@ -59,28 +114,47 @@ def create_data1(age: int) -> None:
                 data_class=profile,
                 value='default/linux/amd64/17.0')[0],
             count=3,
-            age=age)
+            epoch=age_to_epoch(age))
         Count.objects.create(
             value=Value.objects.get_or_create(
                 data_class=world,
                 value='dev-libs/libfoo')[0],
             count=5,
-            age=age)
+            epoch=age_to_epoch(age))
         Count.objects.create(
             value=Value.objects.get_or_create(
                 data_class=world,
                 value='dev-libs/libbar')[0],
             count=2,
-            age=age)
+            epoch=age_to_epoch(age))
         Count.objects.create(
             value=Value.objects.get_or_create(
                 data_class=world,
                 value='dev-util/bar')[0],
             count=1,
-            age=age)
+            epoch=age_to_epoch(age))
+        stats.rebuild_totals()
+
+
+def response_json(resp: HttpResponse) -> typing.Any:
+    """Decode JSON from a (possibly streaming) response"""
+    if resp.streaming:
+        return json.loads(b''.join(resp.streaming_content))
+    return resp.json()
 
 
-class SubmissionTests(TestCase):
+class GooseTestCase(TestCase):
+    def setUp(self) -> None:
+        # ensure that query counts do not depend on test order
+        # (or on registry.check() becoming due)
+        registry.invalidate()
+        registry.data_classes()
+        # test transactions are rolled back, so cached ids are invalid
+        value_cache.clear()
+        stats.clear_compressed_stats()
+
+
+class SubmissionTests(GooseTestCase):
     JSON_1 = {
         'goose-version': 1,
         'id': 'test1',
@@ -119,9 +193,8 @@ class SubmissionTests(TestCase):
         self.assertEqual(resp.status_code, 200)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
-                ('id', 'test1', 1, 0),
                 ('profile', 'default/linux/amd64/17.0', 1, 0),
                 ('world', 'dev-libs/libbar', 1, 0),
                 ('world', 'dev-libs/libfoo', 1, 0),
@@ -143,11 +216,8 @@ class SubmissionTests(TestCase):
         self.assertEqual(resp.status_code, 200)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
-                ('id', 'test1', 1, 0),
-                ('id', 'test2', 1, 0),
-                ('id', 'test3', 1, 0),
                 ('profile', 'default/linux/amd64/17.0', 2, 0),
                 ('profile', 'default/linux/amd64/17.1', 1, 0),
                 ('world', 'dev-libs/libbar', 3, 0),
@@ -167,9 +237,8 @@ class SubmissionTests(TestCase):
         self.assertEqual(resp.status_code, 429)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
-                ('id', 'test1', 1, 0),
                 ('profile', 'default/linux/amd64/17.0', 1, 0),
                 ('world', 'dev-libs/libbar', 1, 0),
                 ('world', 'dev-libs/libfoo', 1, 0),
@@ -185,9 +254,8 @@ class SubmissionTests(TestCase):
         self.assertEqual(resp.status_code, 200)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
-                ('id', 'test1', 1, 0),
                 ('profile', 'default/linux/amd64/17.0', 1, 0),
                 ('profile', 'default/linux/amd64/17.0', 3, 1),
                 ('world', 'dev-libs/libbar', 1, 0),
@@ -198,6 +266,17 @@ class SubmissionTests(TestCase):
                 ('world', 'sys-apps/frobnicate', 1, 0),
             ])
 
+    def test_id_stored_as_hash(self) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=self.JSON_1)
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(
+            list(SubmitterId.objects.values_list('digest', 'epoch')),
+            [(SubmitterId.hash_id('test1'), Epoch.get_current())])
+        self.assertFalse(Value.objects.filter(data_class__name='id'))
+
     def test_bad_method(self) -> None:
         resp = self.client.get(reverse('submit'))
         self.assertEqual(resp.status_code, 405)
@@ -208,6 +287,81 @@ class SubmissionTests(TestCase):
                                data=self.JSON_1)
         self.assertEqual(resp.status_code, 415)
 
+    def put_encoded(self,
+                    body: bytes,
+                    encoding: str
+                    ) -> HttpResponse:
+        return self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=body,
+                               HTTP_CONTENT_ENCODING=encoding)
+
+    def test_gzip(self) -> None:
+        resp = self.put_encoded(
+            gzip.compress(json.dumps(self.JSON_1).encode()), 'gzip')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Count.objects.count(), 4)
+
+    @unittest.skipIf(compression.zstandard is None,
+                     'zstandard module not installed')
+    def test_zstd(self) -> None:
+        resp = self.put_encoded(
+            compression.zstandard.ZstdCompressor().compress(
+                json.dumps(self.JSON_1).encode()),
+            'zstd')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Count.objects.count(), 4)
+
+    def test_unsupported_encoding(self) -> None:
+        resp = self.put_encoded(json.dumps(self.JSON_1).encode(), 'foo')
+        self.assertEqual(resp.status_code, 415)
+
+    def test_malformed_gzip(self) -> None:
+        resp = self.put_encoded(
+            gzip.compress(json.dumps(self.JSON_1).encode())[:-10], 'gzip')
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Count.objects.all())
+
+    def test_decompressed_too_large(self) -> None:
+        body = gzip.compress(json.dumps(self.JSON_1).encode())
+        with self.settings(GOOSE_MAX_REPORT_SIZE=50):
+            resp = self.put_encoded(body, 'gzip')
+        self.assertEqual(resp.status_code, 413)
+        self.assertFalse(Count.objects.all())
+
+    def test_compression_ratio_too_high(self) -> None:
+        report = dict(self.JSON_1, world=1000 * ['dev-libs/libfoo'])
+        resp = self.put_encoded(
+            gzip.compress(json.dumps(report).encode()), 'gzip')
+        self.assertEqual(resp.status_code, 413)
+        self.assertFalse(Count.objects.all())
+
+    def test_too_large(self) -> None:
+        with self.settings(GOOSE_MAX_REPORT_SIZE=50):
+            with self.assertNumQueries(0):
+                resp = self.put_encoded(
+                    json.dumps(self.JSON_1).encode(), 'identity')
+        self.assertEqual(resp.status_code, 413)
+
+    def test_too_many_values(self) -> None:
+        with self.settings(GOOSE_MAX_LIST_LENGTH=2):
+            resp = self.client.put(reverse('submit'),
+                                   content_type='application/json',
+                                   data=self.JSON_1)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.content,
+                         b'Too many values for world (max 2)\n')
+        self.assertFalse(Count.objects.all())
+
+    def test_value_too_long(self) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=dict(self.JSON_1,
+                                         world=['dev-libs/' + 256 * 'a']))
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(Count.objects.all())
+        self.assertFalse(SubmitterId.objects.all())
+
     def test_malformed_json(self) -> None:
         resp = self.client.put(reverse('submit'),
                                content_type='application/json',
@@ -277,12 +431,8 @@ class SubmissionTests(TestCase):
 
     def test_duplicate_submission_in_almost_last_period(self) -> None:
         max_age = settings.GOOSE_MAX_PERIODS
-        Count.objects.create(
-            value=Value.objects.create(
-                data_class=DataClass.objects.get(name='id'),
-                value='test1'),
-            count=1,
-            age=max_age-1)
+        SubmitterId.objects.create(digest=SubmitterId.hash_id('test1'),
+                                   epoch=age_to_epoch(max_age-1))
 
         resp = self.client.put(reverse('submit'),
                                content_type='application/json',
@@ -300,12 +450,8 @@ class SubmissionTests(TestCase):
         """
 
         max_age = settings.GOOSE_MAX_PERIODS
-        Count.objects.create(
-            value=Value.objects.create(
-                data_class=DataClass.objects.get(name='id'),
-                value='test1'),
-            count=1,
-            age=max_age)
+        SubmitterId.objects.create(digest=SubmitterId.hash_id('test1'),
+                                   epoch=age_to_epoch(max_age))
 
         resp = self.client.put(reverse('submit'),
                                content_type='application/json',
@@ -313,28 +459,217 @@ class SubmissionTests(TestCase):
         self.assertEqual(resp.status_code, 200)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
-                ('id', 'test1', 1, 0),
-                ('id', 'test1', 1, max_age),
                 ('profile', 'default/linux/amd64/17.0', 1, 0),
                 ('world', 'dev-libs/libbar', 1, 0),
                 ('world', 'dev-libs/libfoo', 1, 0),
                 ('world', 'sys-apps/frobnicate', 1, 0),
             ])
 
+    def test_duplicate_values_in_report(self) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data={'goose-version': 1,
+                                     'id': 'testz',
+                                     'world': [
+                                         'dev-libs/libfoo',
+                                         'dev-libs/libfoo',
+                                         'dev-libs/libbar',
+                                     ]})
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('world', 'dev-libs/libbar', 1, 0),
+                ('world', 'dev-libs/libfoo', 2, 0),
+            ])
+
+    def test_queries_independent_of_size(self) -> None:
+        """Test that the number of queries does not grow with report"""
+
+        def submit(id_: str, world_size: int) -> int:
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.put(
+                    reverse('submit'),
+                    content_type='application/json',
+                    data={'goose-version': 1,
+                          'id': id_,
+                          'profile': 'default/linux/amd64/17.0',
+                          'world': [f'dev-libs/lib{i}'
+                                    for i in range(world_size)]})
+            self.assertEqual(resp.status_code, 200)
+            return len(ctx.captured_queries)
+
+        # the first submission creates the rate limit counter
+        submit('first', 0)
+        self.assertEqual(submit('small', 3), submit('large', 300))
+        self.assertEqual(
+            Count.objects.get(value__value='dev-libs/lib0').count, 2)
+        self.assertEqual(
+            Count.objects.get(value__value='dev-libs/lib299').count, 1)
+
+    def test_portable_upsert_fallback(self) -> None:
+        with unittest.mock.patch('goose.ingest._upsert_syntax',
+                                 return_value=None):
+            for data in (self.JSON_1, self.JSON_2, self.JSON_3):
+                resp = self.client.put(reverse('submit'),
+                                       content_type='application/json',
+                                       data=data)
+                self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.0', 2, 0),
+                ('profile', 'default/linux/amd64/17.1', 1, 0),
+                ('world', 'dev-libs/libbar', 3, 0),
+                ('world', 'dev-libs/libfoo', 2, 0),
+                ('world', 'sys-apps/example', 1, 0),
+                ('world', 'sys-apps/frobnicate', 1, 0),
+            ])
+
+
+@override_settings(GOOSE_RELAY_NETWORKS=['127.0.0.0/8'])
+class BulkSubmissionTests(GooseTestCase):
+    JSON_1 = SubmissionTests.JSON_1
+    JSON_2 = SubmissionTests.JSON_2
+
+    def put(self,
+            data: typing.Any,
+            content_type: str = 'application/json'
+            ) -> typing.Any:
+        resp = self.client.put(reverse('submit_bulk'),
+                               content_type=content_type,
+                               data=data)
+        self.assertEqual(resp.status_code, 200)
+        return [x['status'] for x in resp.json()]
+
+    def test_json_array(self) -> None:
+        self.assertEqual(
+            self.put([self.JSON_1, {'goose-version': 1}, self.JSON_2,
+                      self.JSON_1, 'foo']),
+            [200, 400, 200, 429, 400])
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.0', 1, 0),
+                ('profile', 'default/linux/amd64/17.1', 1, 0),
+                ('world', 'dev-libs/libbar', 2, 0),
+                ('world', 'dev-libs/libfoo', 1, 0),
+                ('world', 'sys-apps/example', 1, 0),
+                ('world', 'sys-apps/frobnicate', 1, 0),
+            ])
+
+    def test_ndjson(self) -> None:
+        body = '\n'.join([json.dumps(self.JSON_1), '{"foo"', '',
+                          json.dumps(self.JSON_2)])
+        self.assertEqual(self.put(body, views.NDJSON), [200, 400, 200])
+        self.assertEqual(SubmitterId.objects.count(), 2)
+
+    def test_ndjson_report_too_large(self) -> None:
+        body = '\n'.join([json.dumps(dict(self.JSON_1,
+                                          world=100 * ['dev-libs/foo'])),
+                          json.dumps(self.JSON_2)])
+        with self.settings(GOOSE_MAX_REPORT_SIZE=200):
+            self.assertEqual(self.put(body, views.NDJSON), [400, 200])
+
+    def test_json_array_report_too_large(self) -> None:
+        data = [dict(self.JSON_1, world=100 * ['dev-libs/foo']),
+                self.JSON_2]
+        with self.settings(GOOSE_MAX_REPORT_SIZE=200):
+            resp = self.client.put(reverse('submit_bulk'),
+                                   content_type='application/json',
+                                   data=data)
+        self.assertEqual(resp.json(), [
+            {'status': 400, 'error': 'Report too large'},
+            {'status': 200},
+        ])
+
+    def test_json_array_too_large(self) -> None:
+        with self.settings(GOOSE_MAX_BULK_ARRAY_SIZE=100):
+            resp = self.client.put(reverse('submit_bulk'),
+                                   content_type='application/json',
+                                   data=[self.JSON_1, self.JSON_2])
+        self.assertEqual(resp.status_code, 413)
+        self.assertIn(b'use NDJSON', resp.content)
+        self.assertFalse(Count.objects.all())
+
+    def test_json_array_upload_limit(self) -> None:
+        """Test that DATA_UPLOAD_MAX_MEMORY_SIZE does not apply"""
+        with self.settings(DATA_UPLOAD_MAX_MEMORY_SIZE=100):
+            self.assertEqual(self.put([self.JSON_1, self.JSON_2]),
+                             [200, 200])
+
+    def test_id_submitted_before(self) -> None:
+        SubmitterId.objects.create(digest=SubmitterId.hash_id('test1'),
+                                   epoch=Epoch.get_current())
+        self.assertEqual(self.put([self.JSON_1, self.JSON_2]), [429, 200])
+
+    def test_id_submitted_concurrently(self) -> None:
+        """Test that ids recorded after the check are not counted"""
+        SubmitterId.objects.create(digest=SubmitterId.hash_id('test1'),
+                                   epoch=Epoch.get_current())
+        with unittest.mock.patch('goose.ingest.recent_ids',
+                                 return_value=set()):
+            self.assertEqual(self.put([self.JSON_1, self.JSON_2]),
+                             [429, 200])
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.1', 1, 0),
+                ('world', 'dev-libs/libbar', 1, 0),
+                ('world', 'sys-apps/example', 1, 0),
+            ])
+
+    def test_batches(self) -> None:
+        with self.settings(GOOSE_BULK_BATCH_SIZE=1):
+            self.assertEqual(self.put([self.JSON_1, self.JSON_1,
+                                       self.JSON_2]),
+                             [200, 429, 200])
+        self.assertEqual(
+            Count.objects.get(value__value='dev-libs/libbar').count, 2)
+
+    def test_spooled(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_SPOOL_DIR=tempdir):
+                self.assertEqual(self.put([self.JSON_1, self.JSON_1,
+                                           self.JSON_2]),
+                                 [200, 429, 200])
+                self.assertFalse(Count.objects.all())
+                management.call_command('flushsubmissions',
+                                        stdout=io.StringIO())
+        self.assertEqual(
+            Count.objects.get(value__value='dev-libs/libbar').count, 2)
+
+    def test_malformed_array(self) -> None:
+        for body in ('[{"foo"', '{}'):
+            resp = self.client.put(reverse('submit_bulk'),
+                                   content_type='application/json',
+                                   data=body)
+            self.assertEqual(resp.status_code, 400)
+
+    @override_settings(GOOSE_RELAY_NETWORKS=['192.0.2.0/24'])
+    def test_not_relay(self) -> None:
+        resp = self.client.put(reverse('submit_bulk'),
+                               content_type='application/json',
+                               data=[self.JSON_1])
+        self.assertEqual(resp.status_code, 403)
+        self.assertFalse(Count.objects.all())
+
 
-class ShiftDataTests(TestCase):
+class ShiftDataTests(GooseTestCase):
     def test_new_data(self) -> None:
         dt = datetime.datetime.utcnow()
         create_data1(0)
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(26):
             management.call_command('shiftdata',
                                     timestamp=dt,
                                     max_periods=2)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
                 ('profile', 'default/linux/amd64/17.0', 3, 1),
                 ('stamp', dt.isoformat(), 1, 1),
@@ -346,13 +681,13 @@ class ShiftDataTests(TestCase):
     def test_old_data(self) -> None:
         new_dt = datetime.datetime.utcnow()
         create_data1(1)
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(25):
             management.call_command('shiftdata',
                                     timestamp=new_dt,
                                     max_periods=2)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
                 ('profile', 'default/linux/amd64/17.0', 3, 2),
                 ('stamp', new_dt.isoformat(), 1, 1),
@@ -366,17 +701,17 @@ class ShiftDataTests(TestCase):
         new_dt = mid_dt + datetime.timedelta(days=1)
         create_data1(2)
 
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(34):
             management.call_command('shiftdata',
                                     timestamp=mid_dt,
                                     max_periods=2)
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(25):
             management.call_command('shiftdata',
                                     timestamp=new_dt,
                                     max_periods=2)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
                 ('stamp', mid_dt.isoformat(), 1, 2),
                 ('stamp', new_dt.isoformat(), 1, 1),
@@ -394,17 +729,17 @@ class ShiftDataTests(TestCase):
         create_data1(3)
         create_data1(2)
 
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(34):
             management.call_command('shiftdata',
                                     timestamp=mid_dt,
                                     max_periods=2)
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(25):
             management.call_command('shiftdata',
                                     timestamp=new_dt,
                                     max_periods=2)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
                 ('stamp', mid_dt.isoformat(), 1, 2),
                 ('stamp', new_dt.isoformat(), 1, 1),
@@ -421,19 +756,19 @@ class ShiftDataTests(TestCase):
         new_dt = mid_dt + datetime.timedelta(days=1)
         create_data1(1)
         create_data1(0)
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(25):
             management.call_command('shiftdata',
                                     timestamp=mid_dt,
                                     max_periods=2)
 
         create_data1(0)
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(31):
             management.call_command('shiftdata',
                                     timestamp=new_dt,
                                     max_periods=2)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
                 ('profile', 'default/linux/amd64/17.0', 3, 1),
                 ('profile', 'default/linux/amd64/17.0', 3, 2),
@@ -447,36 +782,369 @@ class ShiftDataTests(TestCase):
                 ('world', 'dev-util/bar', 1, 2),
             ])
 
+    def test_counts_not_rewritten(self) -> None:
+        """Test that shifting data does not update all counts"""
+        create_data1(1)
+        create_data1(0)
+        with CaptureQueriesContext(connection) as ctx:
+            management.call_command('shiftdata',
+                                    timestamp=datetime.datetime.utcnow(),
+                                    max_periods=2)
+        self.assertFalse([x for x in ctx.captured_queries
+                          if x['sql'].startswith('UPDATE "goose_count"')])
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()
+                   if x.value.data_class.name != 'stamp'),
+            [
+                ('profile', 'default/linux/amd64/17.0', 3, 1),
+                ('profile', 'default/linux/amd64/17.0', 3, 2),
+                ('world', 'dev-libs/libbar', 2, 1),
+                ('world', 'dev-libs/libbar', 2, 2),
+                ('world', 'dev-libs/libfoo', 5, 1),
+                ('world', 'dev-libs/libfoo', 5, 2),
+                ('world', 'dev-util/bar', 1, 1),
+                ('world', 'dev-util/bar', 1, 2),
+            ])
+
+    def test_batches(self) -> None:
+        dt = datetime.datetime.utcnow()
+        create_data1(3)
+        create_data1(2)
+        management.call_command('shiftdata',
+                                timestamp=dt,
+                                max_periods=2,
+                                batch_size=3)
+
+        self.assertEqual(
+            sorted(value_to_tuple(x) for x in Value.objects.all()),
+            [
+                ('stamp', dt.isoformat()),
+            ])
+        self.assertEqual(list(stats.check_totals()), [])
+
+    def test_resume(self) -> None:
+        mid_dt = datetime.datetime.utcnow()
+        new_dt = mid_dt + datetime.timedelta(days=1)
+        create_data1(2)
+        create_data1(1)
+
+        # interrupt after the first batch
+        with unittest.mock.patch('time.sleep',
+                                 side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                management.call_command('shiftdata',
+                                        timestamp=mid_dt,
+                                        max_periods=2,
+                                        batch_size=1,
+                                        pause=1)
+        self.assertEqual(Count.objects.with_age().filter(age=3).count(), 3)
+        # leftover counts are not published anymore
+        self.assertEqual(list(stats.check_totals()), [])
+
+        management.call_command('shiftdata', expire_only=True)
+        self.assertFalse(Count.objects.with_age().filter(age=3).exists())
+        self.assertEqual(list(stats.check_totals()), [])
+
+        management.call_command('shiftdata',
+                                timestamp=new_dt,
+                                max_periods=2)
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('stamp', mid_dt.isoformat(), 1, 2),
+                ('stamp', new_dt.isoformat(), 1, 1),
+            ])
+        self.assertEqual(list(stats.check_totals()), [])
+
+    def test_unrelated_orphans_kept(self) -> None:
+        """Test that only values that lost counts are removed"""
+        dt = datetime.datetime.utcnow()
+        Value.objects.create(data_class=DataClass.objects.get(name='world'),
+                             value='dev-libs/unused')
+        create_data1(2)
+        management.call_command('shiftdata',
+                                timestamp=dt,
+                                max_periods=2)
+
+        self.assertEqual(
+            sorted(value_to_tuple(x) for x in Value.objects.all()),
+            [
+                ('stamp', dt.isoformat()),
+                ('world', 'dev-libs/unused'),
+            ])
+
+    def test_old_ids_pruned(self) -> None:
+        max_age = settings.GOOSE_MAX_PERIODS
+        for id_, age in (('test1', max_age - 2), ('test2', max_age - 1)):
+            SubmitterId.objects.create(digest=SubmitterId.hash_id(id_),
+                                       epoch=age_to_epoch(age))
+        management.call_command('shiftdata',
+                                timestamp=datetime.datetime.utcnow())
+
+        self.assertEqual(
+            list(SubmitterId.objects.values_list('digest', flat=True)),
+            [SubmitterId.hash_id('test1')])
+
+    def test_old_ids_pruned_max_periods(self) -> None:
+        for id_, age in (('test1', 0), ('test2', 1)):
+            SubmitterId.objects.create(digest=SubmitterId.hash_id(id_),
+                                       epoch=age_to_epoch(age))
+        management.call_command('shiftdata',
+                                timestamp=datetime.datetime.utcnow(),
+                                max_periods=2)
+
+        self.assertEqual(
+            list(SubmitterId.objects.values_list('digest', flat=True)),
+            [SubmitterId.hash_id('test1')])
+
+    def test_share_lock_clause(self) -> None:
+        for vendor, mariadb, version, expected in (
+                ('postgresql', False, (13,), 'FOR SHARE'),
+                ('mysql', False, (8, 0, 22), 'FOR SHARE'),
+                ('mysql', False, (5, 7, 30), 'LOCK IN SHARE MODE'),
+                ('mysql', True, (10, 5, 8), 'LOCK IN SHARE MODE')):
+            with self.subTest(vendor=vendor, mariadb=mariadb,
+                              version=version):
+                with unittest.mock.patch.multiple(
+                        connection,
+                        create=True,
+                        vendor=vendor,
+                        mysql_is_mariadb=mariadb,
+                        mysql_version=version):
+                    self.assertEqual(share_lock_clause(), expected)
+
     def test_too_frequent(self) -> None:
         old_dt = datetime.datetime.utcnow()
         new_dt = old_dt + datetime.timedelta(hours=12)
 
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(25):
             management.call_command('shiftdata',
                                     timestamp=old_dt,
                                     max_periods=2)
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             with self.assertRaises(management.CommandError):
                 management.call_command('shiftdata',
                                         timestamp=new_dt,
                                         max_periods=2)
 
         self.assertEqual(
-            sorted(count_to_tuple(x) for x in Count.objects.all()),
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
             [
                 ('stamp', old_dt.isoformat(), 1, 1),
             ])
 
 
-class StatsJsonTests(TestCase):
+@override_settings(GOOSE_COUNT_SHARDS=4)
+class ShardTests(GooseTestCase):
+    def submit_all(self) -> None:
+        # test1 and test2 fall into shard 2, test3 into shard 0
+        for data in (SubmissionTests.JSON_1,
+                     SubmissionTests.JSON_2,
+                     SubmissionTests.JSON_3):
+            resp = self.client.put(reverse('submit'),
+                                   content_type='application/json',
+                                   data=data)
+            self.assertEqual(resp.status_code, 200)
+
+    def libbar_counts(self) -> typing.List[typing.Tuple[int, int]]:
+        return sorted(Count.objects
+                      .filter(value__value='dev-libs/libbar')
+                      .values_list('shard', 'count'))
+
+    def test_sharded(self) -> None:
+        self.submit_all()
+        self.assertEqual(self.libbar_counts(), [(0, 1), (2, 2)])
+
+        management.call_command('shiftdata',
+                                timestamp=datetime.datetime.utcnow())
+        self.assertEqual(self.libbar_counts(), [(0, 3)])
+        self.assertFalse(Count.objects.filter(shard__gt=0))
+        data = response_json(self.client.get(reverse('stats_json')))
+        self.assertEqual(data['world'], {
+            'dev-libs/libbar': 3,
+            'dev-libs/libfoo': 2,
+            'sys-apps/example': 1,
+            'sys-apps/frobnicate': 1,
+        })
+        self.assertEqual(list(stats.check_totals()), [])
+
+    def test_sharded_fallback(self) -> None:
+        with unittest.mock.patch('goose.ingest._upsert_syntax',
+                                 return_value=None):
+            self.submit_all()
+        self.assertEqual(self.libbar_counts(), [(0, 1), (2, 2)])
+
+    def test_merge_into_empty_shard(self) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=SubmissionTests.JSON_1)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.libbar_counts(), [(2, 1)])
+        merge_shards(Epoch.get_current())
+        self.assertEqual(self.libbar_counts(), [(0, 1)])
+
+
+@override_settings(ROOT_URLCONF='anser.asgi_urls')
+class AsyncViewTests(GooseTestCase):
+    """Test async views via ASGI client"""
+
+    def put(self, data: typing.Any) -> HttpResponse:
+        async def request() -> HttpResponse:
+            return await self.async_client.put(
+                reverse('submit'),
+                content_type='application/json',
+                data=data)
+        return async_to_sync(request)()
+
+    def get(self, path: str) -> HttpResponse:
+        async def request() -> HttpResponse:
+            return await self.async_client.get(path)
+        return async_to_sync(request)()
+
+    def test_urlconf(self) -> None:
+        self.assertIs(resolve(reverse('submit')).func,
+                      views.submit_async)
+        self.assertIs(resolve(reverse('stats_json')).func,
+                      views.stats_json_async)
+
+    def test_submit(self) -> None:
+        resp = self.put(SubmissionTests.JSON_1)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.0', 1, 0),
+                ('world', 'dev-libs/libbar', 1, 0),
+                ('world', 'dev-libs/libfoo', 1, 0),
+                ('world', 'sys-apps/frobnicate', 1, 0),
+            ])
+
+    def test_submit_duplicate(self) -> None:
+        self.assertEqual(self.put(SubmissionTests.JSON_1).status_code, 200)
+        self.assertEqual(self.put(SubmissionTests.JSON_1).status_code, 429)
+
+    def test_submit_malformed(self) -> None:
+        self.assertEqual(self.put('{"foo"').status_code, 400)
+        self.assertFalse(Count.objects.all())
+
+    def test_submit_bad_method(self) -> None:
+        self.assertEqual(self.get(reverse('submit')).status_code, 405)
+
+    def get_stats(self) -> typing.Tuple[HttpResponse, bytes]:
+        async def request() -> typing.Tuple[HttpResponse, bytes]:
+            resp = await self.async_client.get(reverse('stats_json'))
+            if not resp.streaming:
+                return (resp, resp.content)
+            return (resp, b''.join([x async for x in resp.streaming_content]))
+        return async_to_sync(request)()
+
+    def test_stats_json(self) -> None:
+        dt = create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+        resp, content = self.get_stats()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['ETag'], f'"{dt.isoformat()}"')
+        self.assertEqual(resp.streaming, views.ASYNC_STREAMING)
+        with self.settings(ROOT_URLCONF='anser.urls'):
+            sync_resp = self.client.get(reverse('stats_json'))
+        self.assertEqual(content, b''.join(sync_resp.streaming_content))
+
+    def test_stats_json_metrics(self) -> None:
+        create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_METRICS_DIR=tempdir):
+                metrics.reset()
+                self.addCleanup(metrics.reset)
+                self.get_stats()
+                samples = metrics.collect()
+        family = samples['goose_db_queries']
+        self.assertEqual(family['goose_db_queries_count'
+                                '{view="stats_json"}'], 1)
+        self.assertGreater(family['goose_db_queries_sum'
+                                  '{view="stats_json"}'], 0)
+
+    def test_stats_json_profiled(self) -> None:
+        create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_PROFILE_DIR=tempdir,
+                               GOOSE_PROFILE_SAMPLE_RATE=1,
+                               GOOSE_PROFILE_SLOW_THRESHOLD=0):
+                resp, _ = self.get_stats()
+            summary_path, = Path(tempdir).glob('slow-*.json')
+            with open(summary_path) as f:
+                summary = json.load(f)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(summary['view'], 'stats_json')
+        # the slowest query depends on timing
+        self.assertGreater(summary['sql_count'], 0)
+        self.assertTrue(summary['slowest_sql']['sql'].startswith('SELECT'))
+
+    def test_middleware_async(self) -> None:
+        async def get_response(request: HttpRequest) -> HttpResponse:
+            return HttpResponse()
+
+        def get_response_sync(request: HttpRequest) -> HttpResponse:
+            return HttpResponse()
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_METRICS_DIR=tempdir,
+                               GOOSE_PROFILE_DIR=tempdir):
+                for cls in (metrics.MetricsMiddleware,
+                            profiling.ProfilingMiddleware):
+                    self.assertTrue(asyncio.iscoroutinefunction(
+                        cls(get_response)))
+                    self.assertFalse(asyncio.iscoroutinefunction(
+                        cls(get_response_sync)))
+
+    def test_submit_metrics(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_METRICS_DIR=tempdir):
+                metrics.reset()
+                self.addCleanup(metrics.reset)
+                self.assertEqual(self.put(SubmissionTests.JSON_1)
+                                 .status_code, 200)
+                samples = metrics.collect()
+        self.assertEqual(samples['goose_submissions_total']
+                         ['goose_submissions_total{status="200"}'], 1)
+        self.assertGreater(samples['goose_db_queries']
+                           ['goose_db_queries_sum{view="submit"}'], 0)
+
+    def test_submit_profiled(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_PROFILE_DIR=tempdir,
+                               GOOSE_PROFILE_SAMPLE_RATE=1,
+                               GOOSE_PROFILE_SLOW_THRESHOLD=0):
+                self.assertEqual(self.put(SubmissionTests.JSON_1)
+                                 .status_code, 200)
+            summary_path, = Path(tempdir).glob('slow-*.json')
+            with open(summary_path) as f:
+                summary = json.load(f)
+        self.assertEqual(summary['view'], 'submit')
+        self.assertGreater(summary['sql_count'], 0)
+        # finished on the request thread, so the query is explained
+        # (the slowest one depends on timing, and can be a SAVEPOINT)
+        if summary['slowest_sql']['sql'].startswith('SELECT'):
+            self.assertTrue(summary['slowest_sql']['explain'])
+
+    def test_iter_chunks_async(self) -> None:
+        async def collect() -> typing.List[bytes]:
+            return [x async for x in views.iter_chunks_async(
+                iter([b'foo', b'', b'bar']))]
+        self.assertEqual(async_to_sync(collect)(), [b'foo', b'', b'bar'])
+
+
+class StatsJsonTests(GooseTestCase):
     def test_one_submission(self) -> None:
         dt = create_stamp(datetime.datetime.utcnow())
         create_data1(1)
 
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             resp = self.client.get(reverse('stats_json'))
+            data = response_json(resp)
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.json(), {
+        self.assertEqual(data, {
             'last-update': dt.isoformat(),
             'profile': {
                 'default/linux/amd64/17.0': 3,
@@ -494,10 +1162,11 @@ class StatsJsonTests(TestCase):
         new_dt = create_stamp(old_dt + datetime.timedelta(days=1))
         create_data1(1)
 
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             resp = self.client.get(reverse('stats_json'))
+            data = response_json(resp)
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.json(), {
+        self.assertEqual(data, {
             'last-update': new_dt.isoformat(),
             'profile': {
                 'default/linux/amd64/17.0': 6,
@@ -511,10 +1180,11 @@ class StatsJsonTests(TestCase):
 
     def test_unprocessed_submission(self) -> None:
         create_data1(0)
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             resp = self.client.get(reverse('stats_json'))
+            data = response_json(resp)
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.json(), {
+        self.assertEqual(data, {
             'last-update': None,
             'profile': {},
             'world': {},
@@ -525,10 +1195,616 @@ class StatsJsonTests(TestCase):
         create_data1(1)
         create_data1(0)
 
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
+            resp = self.client.get(reverse('stats_json'))
+            data = response_json(resp)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data, {
+            'last-update': dt.isoformat(),
+            'profile': {
+                'default/linux/amd64/17.0': 3,
+            },
+            'world': {
+                'dev-libs/libfoo': 5,
+                'dev-libs/libbar': 2,
+                'dev-util/bar': 1,
+            },
+        })
+
+    def test_streaming_output(self) -> None:
+        """Test that streamed output matches plain json.dumps()"""
+        dt = create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+        create_data1(0)
+        Count.objects.create(
+            value=Value.objects.create(
+                data_class=DataClass.objects.get(name='world'),
+                value='dev-libs/\u0105\"'),
+            count=7,
+            epoch=age_to_epoch(2))
+        stats.rebuild_totals()
+
+        with unittest.mock.patch('goose.stats.STATS_CHUNK_BYTES', 8):
             resp = self.client.get(reverse('stats_json'))
+            chunks = list(resp.streaming_content)
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(
+            b''.join(chunks),
+            json.dumps({
+                'profile': {
+                    'default/linux/amd64/17.0': 3,
+                },
+                'world': {
+                    'dev-libs/libfoo': 5,
+                    'dev-libs/libbar': 2,
+                    'dev-util/bar': 1,
+                    'dev-libs/\u0105\"': 7,
+                },
+                'last-update': dt.isoformat(),
+            }).encode())
+
+    def test_conditional_etag(self) -> None:
+        dt = create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+
+        resp = self.client.get(reverse('stats_json'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['ETag'], f'"{dt.isoformat()}"')
+        self.assertIn('public', resp['Cache-Control'])
+        self.assertIn('max-age', resp['Cache-Control'])
+
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('stats_json'),
+                                   HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['ETag'], f'"{dt.isoformat()}"')
+
+        create_stamp(dt + datetime.timedelta(days=1))
+        resp = self.client.get(reverse('stats_json'),
+                               HTTP_IF_NONE_MATCH=f'"{dt.isoformat()}"')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_conditional_last_modified(self) -> None:
+        dt = create_stamp(datetime.datetime(2020, 5, 20, 12, 0, 0))
+        create_data1(1)
+
+        resp = self.client.get(reverse('stats_json'))
+        self.assertEqual(resp['Last-Modified'],
+                         'Wed, 20 May 2020 12:00:00 GMT')
+
+        with self.assertNumQueries(1):
+            resp = self.client.get(
+                reverse('stats_json'),
+                HTTP_IF_MODIFIED_SINCE='Wed, 20 May 2020 13:00:00 GMT')
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(
+            reverse('stats_json'),
+            HTTP_IF_MODIFIED_SINCE='Wed, 20 May 2020 11:00:00 GMT')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(response_json(resp)['last-update'], dt.isoformat())
+
+    def test_compressed(self) -> None:
+        dt = create_stamp(datetime.datetime(2020, 5, 20, 12, 0, 0))
+        create_data1(1)
+
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse('stats_json'),
+                                   HTTP_ACCEPT_ENCODING='deflate, gzip')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertTrue(resp['ETag'].endswith('-gzip"'))
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(resp.content)),
+                         response_json(self.client.get(reverse('stats_json'))))
+
+        # compressed once per stamp
+        with self.assertNumQueries(1):
+            resp2 = self.client.get(reverse('stats_json'),
+                                    HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(resp2.content, resp.content)
+
+        create_stamp(dt + datetime.timedelta(days=1))
+        resp = self.client.get(reverse('stats_json'),
+                               HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotEqual(resp.content, resp2.content)
+
+    @unittest.skipIf(compression.brotli is None,
+                     'brotli module not installed')
+    def test_brotli_quality(self) -> None:
+        """Test that live stats are compressed using faster quality"""
+        create_stamp(datetime.datetime(2020, 5, 20, 12, 0, 0))
+        create_data1(1)
+        with unittest.mock.patch.object(
+                compression.brotli, 'Compressor',
+                wraps=compression.brotli.Compressor) as compressor:
+            resp = self.client.get(reverse('stats_json'),
+                                   HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual(resp['Content-Encoding'], 'br')
+        compressor.assert_called_once_with(
+            quality=compression.LIVE_BROTLI_QUALITY)
+        identity = self.client.get(reverse('stats_json'),
+                                   HTTP_ACCEPT_ENCODING='identity')
+        self.assertEqual(
+            json.loads(compression.brotli.decompress(resp.content)),
+            response_json(identity))
+
+    def test_compression_refused(self) -> None:
+        create_stamp(datetime.datetime(2020, 5, 20, 12, 0, 0))
+        create_data1(1)
+        resp = self.client.get(reverse('stats_json'),
+                               HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', resp)
+        self.assertIn('Accept-Encoding', resp['Vary'])
+
+    def test_no_stamp_no_etag(self) -> None:
+        create_data1(0)
+        resp = self.client.get(reverse('stats_json'))
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.json(), {
+        self.assertNotIn('ETag', resp)
+        self.assertNotIn('Last-Modified', resp)
+
+
+class ClassStatsTests(GooseTestCase):
+    WORLD = [
+        ['dev-libs/libfoo', 5],
+        ['dev-libs/libbar', 2],
+        ['dev-util/bar', 1],
+    ]
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.dt = create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+
+    def get(self,
+            name: str = 'world',
+            status: int = 200,
+            **params: typing.Any
+            ) -> typing.Any:
+        resp = self.client.get(reverse('class_stats_json', args=(name,)),
+                               params)
+        self.assertEqual(resp.status_code, status)
+        return resp.json() if status == 200 else resp
+
+    def get_all(self, **params: typing.Any) -> typing.List[typing.Any]:
+        """Follow the cursors, return the values from all pages"""
+        ret = []
+        cursor = None
+        while True:
+            if cursor is not None:
+                params['cursor'] = cursor
+            data = self.get(**params)
+            self.assertTrue(data['values'])
+            ret += data['values']
+            cursor = data['next']
+            if cursor is None:
+                return ret
+
+    def test_all(self) -> None:
+        with self.assertNumQueries(2):
+            data = self.get()
+        self.assertEqual(data, {
+            'class': 'world',
+            'values': self.WORLD,
+            'next': None,
+            'last-update': self.dt.isoformat(),
+        })
+
+    def test_top(self) -> None:
+        self.assertEqual(self.get(top=2)['values'], self.WORLD[:2])
+        self.assertEqual(self.get_all(top=2, limit=1), self.WORLD[:2])
+
+    def test_pagination(self) -> None:
+        self.assertEqual(self.get_all(limit=1), self.WORLD)
+        self.assertEqual(self.get_all(limit=2), self.WORLD)
+        self.assertEqual(self.get_all(limit=1, order='value'),
+                         sorted(self.WORLD))
+
+    def test_prefix(self) -> None:
+        self.assertEqual(self.get(prefix='dev-libs/')['values'],
+                         self.WORLD[:2])
+        self.assertEqual(
+            self.get_all(prefix='dev-libs/', order='value', limit=1),
+            [['dev-libs/libbar', 2], ['dev-libs/libfoo', 5]])
+        self.assertEqual(self.get(prefix='dev-libs/libfoo')['values'],
+                         self.WORLD[:1])
+        self.assertEqual(self.get(prefix='sys-')['values'], [])
+
+    def test_not_found(self) -> None:
+        self.get('nonexistent', status=404)
+        self.get('id', status=404)
+
+    def test_bad_params(self) -> None:
+        for params in ({'order': 'random'},
+                       {'top': 0},
+                       {'top': 'many'},
+                       {'limit': settings.GOOSE_STATS_PAGE_SIZE + 1},
+                       {'cursor': 'garbage'},
+                       {'cursor': stats.encode_cursor(['a', 'b'])}):
+            with self.subTest(params=params):
+                self.get(status=400, **params)
+
+    def test_cursor_mismatch(self) -> None:
+        cursor = self.get(limit=1)['next']
+        self.get(status=400, cursor=cursor, order='value')
+        self.get(status=400, cursor=cursor, prefix='dev-')
+        create_stamp(self.dt + datetime.timedelta(days=1))
+        self.get(status=400, cursor=cursor)
+
+
+class TotalsTests(GooseTestCase):
+    def totals(self) -> typing.List[typing.Tuple[str, str, int]]:
+        return sorted(value_to_tuple(x.value) + (x.count,)
+                      for x in Total.objects.all())
+
+    def test_maintained_by_shiftdata(self) -> None:
+        dt = datetime.datetime.utcnow()
+        create_data1(1)
+        create_data1(0)
+        for i in range(3):
+            management.call_command('shiftdata',
+                                    timestamp=dt,
+                                    max_periods=2)
+            self.assertEqual(list(stats.check_totals()), [])
+            dt += datetime.timedelta(days=1)
+            if i == 0:
+                self.assertEqual(self.totals(), [
+                    ('profile', 'default/linux/amd64/17.0', 6),
+                    ('world', 'dev-libs/libbar', 4),
+                    ('world', 'dev-libs/libfoo', 10),
+                    ('world', 'dev-util/bar', 2),
+                ])
+        self.assertFalse(Total.objects.all())
+
+    def ranks(self, cls: str) -> typing.List[typing.Tuple[str, int]]:
+        return list(Total.objects
+                    .filter(data_class__name=cls, rank__isnull=False)
+                    .order_by('rank')
+                    .values_list('value__value', 'rank'))
+
+    def test_ranked_by_shiftdata(self) -> None:
+        create_data1(1)
+        self.assertEqual(self.ranks('world'), [
+            ('dev-libs/libfoo', 1),
+            ('dev-libs/libbar', 2),
+            ('dev-util/bar', 3),
+        ])
+        Count.objects.create(value=Value.objects.get(value='dev-util/bar'),
+                             count=10,
+                             epoch=age_to_epoch(0))
+        management.call_command('shiftdata',
+                                timestamp=datetime.datetime.utcnow(),
+                                max_periods=2)
+        self.assertEqual(self.ranks('world'), [
+            ('dev-util/bar', 1),
+            ('dev-libs/libfoo', 2),
+            ('dev-libs/libbar', 3),
+        ])
+        self.assertEqual(self.ranks('profile'), [
+            ('default/linux/amd64/17.0', 1),
+        ])
+
+    def test_rank_methods(self) -> None:
+        """Test that both ranking methods give the same ranks"""
+        create_data1(1)
+        Total.objects.filter(value__value='dev-libs/libfoo').update(
+            count=2)
+        Total.objects.filter(value__value='dev-util/bar').update(count=0)
+        for in_update in (True, False):
+            with self.subTest(in_update=in_update):
+                Total.objects.update(rank=5)
+                with unittest.mock.patch('goose.stats.can_rank_in_update',
+                                         return_value=in_update):
+                    stats.rank_totals()
+                self.assertEqual(self.ranks('world'), [
+                    ('dev-libs/libbar', 1),
+                    ('dev-libs/libfoo', 2),
+                ])
+                self.assertIsNone(
+                    Total.objects.get(value__value='dev-util/bar').rank)
+
+    def test_check_command(self) -> None:
+        create_data1(1)
+        out = io.StringIO()
+        management.call_command('rebuildtotals', check=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Totals match\n')
+
+        Total.objects.filter(value__value='dev-libs/libfoo').update(
+            count=1)
+        Total.objects.filter(value__value='dev-util/bar').delete()
+        with self.assertRaises(management.CommandError):
+            management.call_command('rebuildtotals', check=True,
+                                    stdout=io.StringIO())
+
+        management.call_command('rebuildtotals', stdout=io.StringIO())
+        self.assertEqual(list(stats.check_totals()), [])
+        self.assertEqual(self.totals(), [
+            ('profile', 'default/linux/amd64/17.0', 3),
+            ('world', 'dev-libs/libbar', 2),
+            ('world', 'dev-libs/libfoo', 5),
+            ('world', 'dev-util/bar', 1),
+        ])
+
+
+class ValueCacheTests(GooseTestCase):
+    JSON = {
+        'goose-version': 1,
+        'id': 'test1',
+        'world': [
+            'dev-libs/libfoo',
+            'dev-libs/libbar',
+        ],
+        'profile': 'default/linux/amd64/17.0'
+    }
+
+    def submit(self, id_: str) -> None:
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.put(reverse('submit'),
+                                   content_type='application/json',
+                                   data=dict(self.JSON, id=id_))
+        self.assertEqual(resp.status_code, 200)
+
+    def test_hits(self) -> None:
+        self.submit('test1')
+        self.assertEqual(len(value_cache), 3)
+        hits = value_cache.hits
+        self.submit('test2')
+        self.assertEqual(value_cache.hits - hits, 3)
+        self.assertEqual(len(value_cache), 3)
+
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.0', 2, 0),
+                ('world', 'dev-libs/libbar', 2, 0),
+                ('world', 'dev-libs/libfoo', 2, 0),
+            ])
+
+    def test_max_size(self) -> None:
+        with self.settings(GOOSE_VALUE_CACHE_SIZE=2):
+            self.submit('test1')
+            self.assertEqual(len(value_cache), 2)
+
+    def test_disabled(self) -> None:
+        with self.settings(GOOSE_VALUE_CACHE_SIZE=0):
+            self.submit('test1')
+            self.assertEqual(len(value_cache), 0)
+
+    def test_flushed_by_shiftdata(self) -> None:
+        """Test that values removed by shiftdata are not reused"""
+        dt = datetime.datetime.utcnow()
+        self.submit('test1')
+        Count.objects.update(epoch=age_to_epoch(10))
+        management.call_command('shiftdata',
+                                timestamp=dt,
+                                max_periods=2)
+        self.assertFalse(Value.objects.exclude(data_class__name='stamp'))
+        self.submit('test2')
+
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.0', 1, 0),
+                ('stamp', dt.isoformat(), 1, 1),
+                ('world', 'dev-libs/libbar', 1, 0),
+                ('world', 'dev-libs/libfoo', 1, 0),
+            ])
+
+
+@unittest.mock.patch('goose.ratelimit.time.time',
+                     return_value=1000 * 86400.0)
+class RateLimitTests(GooseTestCase):
+    JSON = {
+        'goose-version': 1,
+        'profile': 'default/linux/amd64/17.0'
+    }
+
+    def submit(self, id_: str, addr: str = '192.0.2.1') -> int:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=dict(self.JSON, id=id_),
+                               REMOTE_ADDR=addr)
+        return resp.status_code
+
+    def test_network_key(self, time: unittest.mock.Mock) -> None:
+        key = ratelimit.network_key('192.0.2.1')
+        self.assertEqual(ratelimit.network_key('::ffff:192.0.2.1'), key)
+        self.assertEqual(ratelimit.network_key('2002:c000:201::1'), key)
+        self.assertNotEqual(ratelimit.network_key('192.0.2.2'), key)
+        self.assertEqual(ratelimit.network_key('2001:db8:0:1::1'),
+                         ratelimit.network_key('2001:db8:0:1:ffff::2'))
+        self.assertNotEqual(ratelimit.network_key('2001:db8:0:1::1'),
+                            ratelimit.network_key('2001:db8:0:2::1'))
+        self.assertLess(ratelimit.network_key('ff00::1'), 0)
+        self.assertIsNone(ratelimit.network_key('foo'))
+
+    @override_settings(GOOSE_MAX_SUBMISSIONS_PER_IP=2)
+    def test_limit(self, time: unittest.mock.Mock) -> None:
+        self.assertEqual(self.submit('test1'), 200)
+        self.assertEqual(self.submit('test2', '::ffff:192.0.2.1'), 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.submit('test3'), 429)
+        self.assertEqual(self.submit('test4', '192.0.2.2'), 200)
+        self.assertEqual(
+            Count.objects.get(value__value='default/linux/amd64/17.0').count,
+            3)
+
+    @override_settings(GOOSE_MAX_SUBMISSIONS_PER_IP=2)
+    def test_sliding_window(self, time: unittest.mock.Mock) -> None:
+        self.assertEqual(self.submit('test1'), 200)
+        self.assertEqual(self.submit('test2'), 200)
+        # 3/4 of the previous window still count
+        time.return_value = 1001.25 * 86400
+        self.assertEqual(self.submit('test3'), 200)
+        self.assertEqual(self.submit('test4'), 429)
+        time.return_value = 1002 * 86400
+        self.assertEqual(self.submit('test5'), 200)
+        self.assertEqual(self.submit('test6'), 429)
+
+    @override_settings(GOOSE_MAX_SUBMISSIONS_PER_IP=1)
+    def test_rejected_submission_not_counted(self,
+                                             time: unittest.mock.Mock
+                                             ) -> None:
+        self.assertEqual(self.submit('test1'), 200)
+        self.assertEqual(self.submit('test1', '192.0.2.2'), 429)
+        self.assertEqual(self.submit('test2', '192.0.2.2'), 200)
+
+    @override_settings(GOOSE_MAX_SUBMISSIONS_PER_IP=None)
+    def test_disabled(self, time: unittest.mock.Mock) -> None:
+        for i in range(3):
+            self.assertEqual(self.submit(f'test{i}'), 200)
+        self.assertFalse(RateLimitCounter.objects.all())
+
+    def test_backend_abstract(self, time: unittest.mock.Mock) -> None:
+        class IncompleteBackend(ratelimit.Backend):
+            def counts(self, network: int, window: int
+                       ) -> typing.Tuple[int, int]:
+                return (0, 0)
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend()  # type: ignore
+
+    def test_pruned_by_shiftdata(self, time: unittest.mock.Mock) -> None:
+        self.assertEqual(self.submit('test1'), 200)
+        time.return_value = 1001 * 86400
+        self.assertEqual(self.submit('test2'), 200)
+        time.return_value = 1002 * 86400
+        management.call_command('shiftdata',
+                                timestamp=datetime.datetime.utcnow())
+        self.assertEqual(
+            list(RateLimitCounter.objects.values_list('window', 'count')),
+            [(1001, 1)])
+
+
+class SpoolTests(GooseTestCase):
+    JSON_1 = SubmissionTests.JSON_1
+    JSON_2 = SubmissionTests.JSON_2
+
+    def setUp(self) -> None:
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.spool_dir = Path(tempdir.name)
+        override = self.settings(GOOSE_SPOOL_DIR=tempdir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def submit(self, data: dict, status: int = 200) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=data)
+        self.assertEqual(resp.status_code, status)
+
+    def flush(self) -> str:
+        out = io.StringIO()
+        management.call_command('flushsubmissions', stdout=out)
+        return out.getvalue().strip()
+
+    def test_spooled(self) -> None:
+        self.submit(self.JSON_1)
+        self.submit(self.JSON_2)
+        self.assertFalse(Count.objects.all())
+        self.assertEqual(
+            self.flush(),
+            '1 segments flushed, 2 reports added, 0 rejected, '
+            '0 corrupted records discarded')
+
+        self.assertEqual(
+            sorted(count_to_tuple(x) for x in Count.objects.with_age()),
+            [
+                ('profile', 'default/linux/amd64/17.0', 1, 0),
+                ('profile', 'default/linux/amd64/17.1', 1, 0),
+                ('world', 'dev-libs/libbar', 2, 0),
+                ('world', 'dev-libs/libfoo', 1, 0),
+                ('world', 'sys-apps/example', 1, 0),
+                ('world', 'sys-apps/frobnicate', 1, 0),
+            ])
+        self.assertEqual(list(self.spool_dir.glob('*.s*')), [])
+        self.assertFalse(SpoolSegment.objects.all())
+
+    def test_invalid_not_spooled(self) -> None:
+        self.submit({'goose-version': 1,
+                     'id': 'testz',
+                     'world': 'dev-libs/foo'},
+                    status=400)
+        self.assertFalse((self.spool_dir / spool.CURRENT_FILE).exists())
+
+    def test_duplicate_id(self) -> None:
+        self.submit(self.JSON_1)
+        self.flush()
+        self.submit(self.JSON_1, status=429)
+
+    def test_duplicate_id_in_spool(self) -> None:
+        self.submit(self.JSON_1)
+        self.submit(self.JSON_1)
+        self.assertEqual(
+            self.flush(),
+            '1 segments flushed, 1 reports added, 1 rejected, '
+            '0 corrupted records discarded')
+        self.assertEqual(
+            Count.objects.get(value__value='dev-libs/libfoo').count, 1)
+
+    def test_interrupted_write(self) -> None:
+        self.submit(self.JSON_1)
+        with (self.spool_dir / spool.CURRENT_FILE).open('ab') as f:
+            f.write(spool.encode_record(self.JSON_2)[:20])
+        self.submit(dict(self.JSON_2, id='test3'))
+        with (self.spool_dir / spool.CURRENT_FILE).open('ab') as f:
+            f.write(spool.encode_record(self.JSON_2)[:-1])
+        self.assertEqual(
+            self.flush(),
+            '1 segments flushed, 2 reports added, 0 rejected, '
+            '2 corrupted records discarded')
+        self.assertEqual(
+            sorted(SubmitterId.objects.values_list('digest', flat=True)),
+            sorted(SubmitterId.hash_id(x) for x in ('test1', 'test3')))
+
+    def test_segment_not_applied_twice(self) -> None:
+        self.submit(self.JSON_1)
+        spool.rotate(self.spool_dir)
+        segment, = self.spool_dir.glob('*.segment')
+        # simulate interruption after committing the segment
+        spool.apply_segment(segment)
+        self.flush()
+        self.assertEqual(
+            Count.objects.get(value__value='dev-libs/libfoo').count, 1)
+        self.assertFalse(segment.exists())
+        self.assertFalse(SpoolSegment.objects.all())
+
+    def test_flushed_by_shiftdata(self) -> None:
+        dt = datetime.datetime.utcnow()
+        self.submit(self.JSON_1)
+        management.call_command('shiftdata',
+                                timestamp=dt,
+                                max_periods=2)
+        self.assertEqual(
+            Count.objects.with_age()
+            .get(value__value='dev-libs/libfoo').age, 1)
+
+
+class StatsSnapshotTests(GooseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = Path(tempdir.name) / 'stats.json'
+        override = self.settings(GOOSE_STATS_SNAPSHOT=str(self.path))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def shiftdata(self) -> datetime.datetime:
+        dt = datetime.datetime.utcnow()
+        with self.captureOnCommitCallbacks(execute=True):
+            management.call_command('shiftdata',
+                                    timestamp=dt,
+                                    max_periods=2)
+        return dt
+
+    def test_snapshot_written(self) -> None:
+        create_data1(0)
+        dt = self.shiftdata()
+        expected = {
             'last-update': dt.isoformat(),
             'profile': {
                 'default/linux/amd64/17.0': 3,
@@ -538,4 +1814,691 @@ class StatsJsonTests(TestCase):
                 'dev-libs/libbar': 2,
                 'dev-util/bar': 1,
             },
+        }
+        self.assertEqual(json.loads(self.path.read_bytes()), expected)
+        self.assertEqual(
+            gzip.decompress(Path(f'{self.path}.gz').read_bytes()),
+            self.path.read_bytes())
+
+        # the view should only look the stamp up now
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('stats_json'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/json')
+        self.assertEqual(response_json(resp),
+                         expected)
+
+    def test_gzip_variant(self) -> None:
+        create_data1(0)
+        self.shiftdata()
+        resp = self.client.get(reverse('stats_json'),
+                               HTTP_ACCEPT_ENCODING='deflate, gzip')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertTrue(resp['ETag'].endswith('-gzip"'))
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        self.assertEqual(
+            gzip.decompress(b''.join(resp.streaming_content)),
+            self.path.read_bytes())
+
+        resp = self.client.get(reverse('stats_json'),
+                               HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', resp)
+
+    def test_outdated_snapshot(self) -> None:
+        create_data1(0)
+        self.shiftdata()
+        create_stamp(datetime.datetime.utcnow()
+                     + datetime.timedelta(days=1))
+        with self.assertNumQueries(2):
+            resp = self.client.get(reverse('stats_json'))
+            response_json(resp)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIsInstance(resp, FileResponse)
+
+    def test_no_snapshot(self) -> None:
+        create_data1(1)
+        resp = self.client.get(reverse('stats_json'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            response_json(resp)['world']['dev-libs/libfoo'], 5)
+
+
+class MetricsTests(GooseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        override = self.settings(GOOSE_METRICS_DIR=tempdir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def get_metrics(self) -> typing.Dict[str, float]:
+        resp = self.client.get(reverse('metrics'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], metrics.CONTENT_TYPE)
+        ret = {}
+        for line in resp.content.decode().splitlines():
+            if not line.startswith('#'):
+                key, value = line.rsplit(' ', 1)
+                ret[key] = float(value)
+        return ret
+
+    def test_disabled(self) -> None:
+        with self.settings(GOOSE_METRICS_DIR=None):
+            resp = self.client.get(reverse('metrics'))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_submissions(self) -> None:
+        for data, status in ((SubmissionTests.JSON_1, 200),
+                             (SubmissionTests.JSON_1, 429),
+                             ({'goose-version': 1}, 400)):
+            resp = self.client.put(reverse('submit'),
+                                   content_type='application/json',
+                                   data=data)
+            self.assertEqual(resp.status_code, status)
+        resp = self.client.put(reverse('submit'),
+                               content_type='text/plain',
+                               data='')
+        self.assertEqual(resp.status_code, 415)
+
+        samples = self.get_metrics()
+        for code in ('200', '400', '415', '429'):
+            self.assertEqual(
+                samples[f'goose_submissions_total{{status="{code}"}}'], 1)
+        self.assertEqual(
+            samples['goose_request_duration_seconds_count'
+                    '{view="submit"}'], 4)
+        self.assertEqual(
+            samples['goose_request_duration_seconds_bucket'
+                    '{view="submit",le="+Inf"}'], 4)
+        self.assertGreater(
+            samples['goose_db_queries_sum{view="submit"}'], 0)
+        # the report with duplicate id is validated too
+        self.assertEqual(samples['goose_report_world_atoms_count'], 2)
+        self.assertEqual(samples['goose_report_world_atoms_sum'], 6)
+        self.assertEqual(
+            samples['goose_report_world_atoms_bucket{le="2.0"}'], 0)
+        self.assertEqual(
+            samples['goose_report_world_atoms_bucket{le="5.0"}'], 2)
+
+    def test_aggregated(self) -> None:
+        """Test that samples of other processes are summed"""
+        metrics.write('process-1', {
+            'goose_submissions_total': {
+                'goose_submissions_total{status="200"}': 3,
+            },
         })
+        metrics.inc('goose_submissions_total', (('status', '200'),))
+        metrics.inc('goose_submissions_total', (('status', '400'),))
+        samples = self.get_metrics()
+        self.assertEqual(samples['goose_submissions_total{status="200"}'],
+                         4)
+        self.assertEqual(samples['goose_submissions_total{status="400"}'],
+                         1)
+
+    def test_pid_reused(self) -> None:
+        """Test that a process with the same pid uses another file"""
+        metrics.inc('goose_submissions_total', (('status', '200'),))
+        metrics.flush(force=True)
+        # pretend to be a new process that got the same pid
+        metrics.after_fork()
+        metrics.inc('goose_submissions_total', (('status', '200'),))
+        metrics.flush(force=True)
+        self.assertEqual(
+            len(list(Path(settings.GOOSE_METRICS_DIR)
+                     .glob('process-*.json'))), 2)
+        samples = self.get_metrics()
+        self.assertEqual(samples['goose_submissions_total{status="200"}'],
+                         2)
+
+    def test_threads(self) -> None:
+        def worker() -> None:
+            for i in range(1000):
+                metrics.inc('goose_submissions_total', (('status', '200'),))
+                metrics.flush()
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        samples = self.get_metrics()
+        self.assertEqual(samples['goose_submissions_total{status="200"}'],
+                         4000)
+
+    def test_write_error(self) -> None:
+        """Test that failing to write metrics does not break requests"""
+        with self.settings(GOOSE_METRICS_DIR='/nonexistent/metrics'):
+            with self.assertLogs('goose.metrics', 'ERROR'):
+                resp = self.client.put(reverse('submit'),
+                                       content_type='application/json',
+                                       data=SubmissionTests.JSON_1)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_streaming(self) -> None:
+        """Test that queries run while streaming are recorded"""
+        create_data1(1)
+        resp = self.client.get(reverse('stats_json'))
+        self.assertTrue(resp.streaming)
+        resp_queries = self.get_metrics()
+        b''.join(resp.streaming_content)
+        samples = self.get_metrics()
+        self.assertNotIn('goose_db_queries_count{view="stats_json"}',
+                         resp_queries)
+        self.assertEqual(samples['goose_db_queries_count'
+                                 '{view="stats_json"}'], 1)
+        self.assertGreater(samples['goose_db_queries_sum'
+                                   '{view="stats_json"}'], 0)
+
+        # closing the response without reading it is recorded too
+        self.client.get(reverse('stats_json')).close()
+        samples = self.get_metrics()
+        self.assertEqual(samples['goose_db_queries_count'
+                                 '{view="stats_json"}'], 2)
+
+    def test_shiftdata(self) -> None:
+        create_data1(0)
+        create_data1(2)
+        outdated = Count.objects.with_age().filter(age=2).count()
+        management.call_command('shiftdata',
+                                timestamp=datetime.datetime.utcnow(),
+                                max_periods=2,
+                                verbosity=0)
+        samples = self.get_metrics()
+        self.assertGreaterEqual(samples['goose_shiftdata_duration_seconds'],
+                                0)
+        self.assertEqual(
+            samples['goose_shiftdata_removed_rows{table="count"}'],
+            outdated)
+        self.assertEqual(
+            samples['goose_table_rows{table="count",age="1"}'],
+            Count.objects.count())
+        self.assertEqual(samples['goose_table_rows{table="value"}'],
+                         Value.objects.count())
+
+
+class ProfilingTests(GooseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.profile_dir = Path(tempdir.name)
+        override = self.settings(GOOSE_PROFILE_DIR=tempdir.name,
+                                 GOOSE_PROFILE_SAMPLE_RATE=1,
+                                 GOOSE_PROFILE_SLOW_THRESHOLD=0)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def submit(self) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=SubmissionTests.JSON_1)
+        self.assertEqual(resp.status_code, 200)
+
+    def summaries(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        ret = []
+        for path in sorted(self.profile_dir.glob('slow-*.json')):
+            with open(path) as f:
+                ret.append(json.load(f))
+        return ret
+
+    def test_sampled(self) -> None:
+        with self.settings(GOOSE_PROFILE_SLOW_THRESHOLD=3600):
+            self.submit()
+        with open(self.profile_dir / 'samples.ndjson') as f:
+            record = json.loads(f.read())
+        self.assertEqual(record['view'], 'submit')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['sql_count'], 0)
+        self.assertGreaterEqual(record['wall_time'], record['sql_time'])
+        self.assertEqual(self.summaries(), [])
+
+    def test_not_sampled(self) -> None:
+        with self.settings(GOOSE_PROFILE_SAMPLE_RATE=0):
+            self.submit()
+        self.assertEqual(list(self.profile_dir.iterdir()), [])
+
+    def test_slow_cprofile(self) -> None:
+        self.submit()
+        summary, = self.summaries()
+        self.assertTrue(summary['profile'].endswith('.prof'))
+        stats = pstats.Stats(str(self.profile_dir / summary['profile']))
+        self.assertIn('submit', stats.get_stats_profile().func_profiles)
+        self.assertGreater(summary['slowest_sql']['time'], 0)
+        self.assertIsInstance(summary['slowest_sql']['explain'], list)
+
+    def test_slow_tracemalloc(self) -> None:
+        with self.settings(GOOSE_PROFILE_MODE='tracemalloc'):
+            self.submit()
+        summary, = self.summaries()
+        self.assertTrue(summary['profile'].endswith('.tracemalloc'))
+        snapshot = tracemalloc.Snapshot.load(
+            str(self.profile_dir / summary['profile']))
+        self.assertTrue(snapshot.traces)
+
+    def test_rotation(self) -> None:
+        with self.settings(GOOSE_PROFILE_MAX_DUMPS=2):
+            for _ in range(3):
+                resp = self.client.get(reverse('stats_json'))
+                b''.join(resp.streaming_content)
+        self.assertEqual(len(self.summaries()), 2)
+        self.assertEqual(len(list(self.profile_dir.glob('slow-*.prof'))),
+                         2)
+
+    def test_streaming(self) -> None:
+        """Test that streaming responses are profiled until exhausted"""
+        create_data1(1)
+        resp = self.client.get(reverse('stats_json'))
+        self.assertTrue(resp.streaming)
+        self.assertFalse((self.profile_dir / 'samples.ndjson').exists())
+        b''.join(resp.streaming_content)
+        summary, = self.summaries()
+        self.assertEqual(summary['view'], 'stats_json')
+        # the slowest query depends on timing
+        self.assertGreater(summary['sql_count'], 0)
+        self.assertTrue(summary['slowest_sql']['sql'].startswith('SELECT'))
+        stats = pstats.Stats(str(self.profile_dir / summary['profile']))
+        self.assertIn('iter_stats', stats.get_stats_profile().func_profiles)
+
+    def test_write_error(self) -> None:
+        """Test that failing to write samples does not break requests"""
+        with self.settings(GOOSE_PROFILE_DIR='/nonexistent/profile'):
+            with self.assertLogs('goose.profiling', 'ERROR'):
+                self.submit()
+            with self.assertLogs('goose.profiling', 'ERROR'):
+                resp = self.client.get(reverse('stats_json'))
+                b''.join(resp.streaming_content)
+
+    def test_explain(self) -> None:
+        self.assertTrue(profiling.explain(
+            connection, 'SELECT * FROM goose_value WHERE id = %s', [1]))
+        self.assertEqual(
+            profiling.explain(connection, 'SAVEPOINT "s1"', None), [])
+        plan, = profiling.explain(connection, 'SELECT * FROM nonexistent',
+                                  None)
+        self.assertTrue(plan.startswith('EXPLAIN failed:'))
+
+    def test_explain_other_thread(self) -> None:
+        """Test that EXPLAIN is skipped when finished in another thread"""
+        resp = self.client.get(reverse('stats_json'))
+        thread = threading.Thread(
+            target=lambda: b''.join(resp.streaming_content))
+        thread.start()
+        thread.join()
+        summary, = self.summaries()
+        self.assertEqual(summary['slowest_sql']['explain'], [])
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite',
+                     'EXPLAIN QUERY PLAN is specific to SQLite')
+class QueryPlanTests(GooseTestCase):
+    """Test that the hot queries do not scan whole tables"""
+
+    # tables that are small enough to be scanned
+    SMALL_TABLES = ('goose_dataclass', 'goose_epoch')
+
+    def assertNoTableScans(self, ctx: CaptureQueriesContext) -> None:
+        with connection.cursor() as cursor:
+            for query in ctx.captured_queries:
+                sql = query['sql']
+                if sql.split()[0] not in ('SELECT', 'INSERT', 'UPDATE',
+                                          'DELETE'):
+                    continue
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                plan = [row[-1] for row in cursor.fetchall()]
+                # subquery results are scanned rather than tables
+                subqueries = set(m.group(1) for m in (
+                    re.match(r'MATERIALIZE (\w+)', x) for x in plan)
+                    if m is not None)
+                for row in plan:
+                    m = re.match(r'SCAN (?:TABLE )?(\w+)', row)
+                    if (m is not None
+                            and 'CONSTANT ROW' not in row
+                            and m.group(1) not in self.SMALL_TABLES
+                            and m.group(1) not in subqueries):
+                        self.fail(f'{row} in query: {sql}')
+
+    def submit(self, data: dict) -> None:
+        resp = self.client.put(reverse('submit'),
+                               content_type='application/json',
+                               data=data)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_submit(self) -> None:
+        create_data1(1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.submit(SubmissionTests.JSON_1)
+            self.submit(SubmissionTests.JSON_2)
+        self.assertNoTableScans(ctx)
+
+    def test_flush(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.settings(GOOSE_SPOOL_DIR=tempdir):
+                self.submit(SubmissionTests.JSON_1)
+                self.submit(SubmissionTests.JSON_2)
+                with CaptureQueriesContext(connection) as ctx:
+                    management.call_command('flushsubmissions',
+                                            stdout=io.StringIO())
+        self.assertNoTableScans(ctx)
+
+    def test_stats_json(self) -> None:
+        create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+        with CaptureQueriesContext(connection) as ctx:
+            response_json(self.client.get(reverse('stats_json')))
+        self.assertNoTableScans(ctx)
+
+    def test_class_stats(self) -> None:
+        create_stamp(datetime.datetime.utcnow())
+        create_data1(1)
+        with CaptureQueriesContext(connection) as ctx:
+            for params in ({'top': 2},
+                           {'limit': 1},
+                           {'limit': 1, 'order': 'value'},
+                           {'prefix': 'dev-libs/', 'order': 'value'}):
+                resp = self.client.get(
+                    reverse('class_stats_json', args=('world',)), params)
+                cursor = resp.json()['next']
+                if cursor is not None:
+                    self.client.get(
+                        reverse('class_stats_json', args=('world',)),
+                        dict(params, cursor=cursor))
+        self.assertNoTableScans(ctx)
+
+    def test_shiftdata(self) -> None:
+        create_data1(2)
+        create_data1(0)
+        self.submit(SubmissionTests.JSON_1)
+        SubmitterId.objects.create(digest=SubmitterId.hash_id('old'),
+                                   epoch=age_to_epoch(10))
+        with CaptureQueriesContext(connection) as ctx:
+            management.call_command('shiftdata',
+                                    timestamp=datetime.datetime.utcnow(),
+                                    max_periods=2,
+                                    verbosity=0)
+        self.assertNoTableScans(ctx)
+        self.assertFalse(Count.objects.with_age().filter(age__gte=2))
+
+
+class BenchmarkTests(GooseTestCase):
+    def test_workload_deterministic(self) -> None:
+        reports = [Workload(100, seed=1).report() for _ in range(2)]
+        self.assertEqual(reports[0], reports[1])
+        self.assertEqual(len(set(reports[0]['world'])),
+                         len(reports[0]['world']))
+
+    def test_query_budgets(self) -> None:
+        result = benchmark_runner.run_scenario(values=200,
+                                               periods=2,
+                                               reports=5,
+                                               repeat=2,
+                                               trace_memory=False)
+        self.assertEqual(result['budget_violations'], [])
+        self.assertEqual(
+            sorted(result['operations']),
+            ['shiftdata', 'stats_json', 'submit'])
+        self.assertEqual(result['operations']['submit']['calls'], 5)
+        self.assertEqual(list(stats.check_totals()), [])
+
+    def test_writer(self) -> None:
+        workload = Workload(50)
+        benchmark_runner.preload(workload, 1, 5)
+        reports = [workload.report() for _ in range(3)]
+        self.assertEqual(benchmark_concurrency.writer(reports, 4), (3, 0))
+        self.assertTrue(Count.objects.filter(shard__gt=0))
+
+    def test_codecs(self) -> None:
+        result = benchmark_codecs.run(values=200, reports=5, repeat=1)
+        self.assertEqual(result['reports'], 5)
+        self.assertEqual(
+            sorted(result['backends']),
+            sorted(x.name for x in jsoncodec.BACKENDS))
+        self.assertIn('json', result['backends'])
+
+
+class JsonCodecTests(TestCase):
+    def test_backends_agree(self) -> None:
+        doc = SubmissionTests.JSON_1
+        for backend in jsoncodec.BACKENDS:
+            with self.subTest(backend=backend.name):
+                self.assertEqual(backend.loads(backend.dumps(doc)), doc)
+                self.assertEqual(json.loads(backend.dumps(doc)), doc)
+
+    def test_stdlib_fallback(self) -> None:
+        """Test that documents accepted by json module are accepted"""
+        for data in (b'\xef\xbb\xbf{"a": 1}',
+                     b'{"a": NaN}',
+                     b'{"a": "\\ud800"}'):
+            with self.subTest(data=data):
+                self.assertEqual(repr(jsoncodec.loads(data)),
+                                 repr(json.loads(data)))
+
+    def test_errors(self) -> None:
+        for backend in jsoncodec.BACKENDS:
+            with unittest.mock.patch('goose.jsoncodec.backend', backend):
+                with self.subTest(backend=backend.name):
+                    with self.assertRaisesRegex(Exception,
+                                                '^Malformed JSON$'):
+                        views.decode_json(b'{"foo"')
+                    with self.assertRaisesRegex(Exception,
+                                                '^Malformed data: .*utf-8'):
+                        views.decode_json(b'{"\xff": 1}')
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite',
+                     'tests the SQLite backend')
+class SQLiteBackendTests(TransactionTestCase):
+    def test_pragmas(self) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone(), (1,))
+
+    def test_begin_immediate(self) -> None:
+        with CaptureQueriesContext(connection) as ctx:
+            with transaction.atomic():
+                Epoch.get_current()
+        self.assertEqual(ctx.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_invalid_option(self) -> None:
+        wrapper = SQLiteDatabaseWrapper(
+            dict(connection.settings_dict,
+                 OPTIONS={'synchronous': 'sometimes'}))
+        with self.assertRaises(ImproperlyConfigured):
+            wrapper.option('synchronous')
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite',
+                     'tests the SQLite backend')
+class SQLiteConcurrencyTests(TransactionTestCase):
+    """Test concurrent writer processes using a SQLite file"""
+
+    # the data classes are needed by the submissions
+    serialized_rollback = True
+
+    WRITERS = 4
+    REPORTS = 10
+
+    def setUp(self) -> None:
+        super().setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = Path(tempdir.name) / 'db.sqlite3'
+
+        # the processes can not share the in-memory test database,
+        # so copy it into a file and use the copy for the test
+        connection.ensure_connection()
+        target = sqlite3.connect(self.path)
+        connection.connection.backup(target)
+        target.close()
+        # the connection keeps the in-memory database alive
+        memory = connection.connection
+        name = connection.settings_dict['NAME']
+        connection.connection = None
+        connection.settings_dict['NAME'] = str(self.path)
+
+        def restore() -> None:
+            connection.close()
+            connection.settings_dict['NAME'] = name
+            connection.connection = memory
+
+        self.addCleanup(restore)
+
+    def test_concurrent_writers(self) -> None:
+        workload = Workload(100)
+        benchmark_runner.preload(workload, 1, self.REPORTS)
+        batches = [[workload.report() for _ in range(self.REPORTS)]
+                   for _ in range(self.WRITERS)]
+
+        # the connection must not be shared with the forked processes
+        connection.close()
+        with multiprocessing.get_context('fork').Pool(self.WRITERS) as pool:
+            results = pool.starmap(benchmark_concurrency.writer,
+                                   [(x, 1) for x in batches],
+                                   chunksize=1)
+
+        self.assertEqual(results, [(self.REPORTS, 0)] * self.WRITERS)
+        self.assertEqual(SubmitterId.objects.count(),
+                         self.WRITERS * self.REPORTS)
+
+    def test_checkpoint(self) -> None:
+        wal = Path(f'{self.path}-wal')
+        Epoch.objects.update(current=models.F('current') + 1)
+        self.assertGreater(wal.stat().st_size, 0)
+        shiftdata.checkpoint('TRUNCATE')
+        self.assertEqual(wal.stat().st_size, 0)
+
+    def test_checkpoint_in_transaction(self) -> None:
+        """Test that checkpoint is skipped within a transaction"""
+        wal = Path(f'{self.path}-wal')
+        Epoch.objects.update(current=models.F('current') + 1)
+        with transaction.atomic():
+            shiftdata.checkpoint('TRUNCATE')
+        self.assertGreater(wal.stat().st_size, 0)
+
+
+@override_settings(GOOSE_DB_LOCK_RETRIES=2,
+                   GOOSE_DB_LOCK_RETRY_DELAY=0)
+class RetryTests(TransactionTestCase):
+    def failing(self, errors: typing.List[Exception]
+                ) -> typing.Callable[[], int]:
+        """Return a function raising `errors` in order, then counting"""
+        def func() -> int:
+            if errors:
+                raise errors.pop(0)
+            return Count.objects.count()
+        return func
+
+    def test_is_lock_error(self) -> None:
+        self.assertTrue(retry.is_lock_error(
+            OperationalError('database is locked')))
+        self.assertFalse(retry.is_lock_error(
+            OperationalError('no such table: foo')))
+        self.assertFalse(retry.is_lock_error(
+            ValueError('database is locked')))
+
+    def test_retried(self) -> None:
+        errors = [OperationalError('database is locked')] * 2
+        self.assertEqual(retry.atomic(self.failing(errors)), 0)
+        self.assertEqual(errors, [])
+
+    def test_exhausted(self) -> None:
+        errors = [OperationalError('database is locked')] * 3
+        with self.assertRaisesRegex(OperationalError, 'locked'):
+            retry.atomic(self.failing(errors))
+
+    def test_other_error(self) -> None:
+        errors = [OperationalError('no such table: foo')] * 2
+        with self.assertRaisesRegex(OperationalError, 'no such table'):
+            retry.atomic(self.failing(errors))
+        self.assertEqual(len(errors), 1)
+
+    def test_nested(self) -> None:
+        """Test that errors are not retried in inner transactions"""
+        errors = [OperationalError('database is locked')]
+        with transaction.atomic():
+            with self.assertRaisesRegex(OperationalError, 'locked'):
+                retry.atomic(self.failing(errors))
+
+
+class RegistryTests(TestCase):
+    def test_cached(self) -> None:
+        registry.data_classes()
+        with self.assertNumQueries(0):
+            stamp = registry.data_class('stamp')
+        self.assertEqual(stamp.name, 'stamp')
+        self.assertFalse(stamp.public)
+        self.assertEqual(registry.data_class('world').data_type,
+                         DataClass.DataClassType.STRING_ARRAY)
+
+    def test_validator(self) -> None:
+        validate = registry.validator()
+        self.assertIs(registry.validator(), validate)
+        self.assertEqual(
+            validate({'profile': 'foo', 'world': ['a', 'b', 'a']}),
+            {registry.data_class('profile'): collections.Counter(['foo']),
+             registry.data_class('world'): collections.Counter('aab')})
+        registry.invalidate()
+        self.assertIsNot(registry.validator(), validate)
+
+    def test_missing(self) -> None:
+        with self.assertRaises(DataClass.DoesNotExist):
+            registry.data_class('nonexistent')
+
+    def test_invalidation(self) -> None:
+        registry.data_classes()
+        new_cls = DataClass.objects.create(
+            name='test',
+            description='Test data class',
+            data_type=DataClass.DataClassType.STRING,
+            public=True)
+        self.assertEqual(registry.data_class('test'), new_cls)
+        new_cls.delete()
+        self.assertNotIn('test', registry.data_classes())
+
+    def test_check(self) -> None:
+        # changes made by another process do not send signals here
+        with self.settings(GOOSE_REGISTRY_TTL=0):
+            registry.invalidate()
+            self.assertTrue(registry.data_class('world').public)
+            with self.assertNumQueries(1):
+                registry.check()
+            DataClass.objects.filter(name='world').update(
+                public=False, updated=datetime.datetime.now())
+            with self.assertNumQueries(1):
+                registry.check()
+            self.assertFalse(registry.data_class('world').public)
+
+            DataClass.objects.bulk_create([DataClass(
+                name='test',
+                description='Test data class',
+                data_type=DataClass.DataClassType.STRING,
+                public=True)])
+            registry.check()
+            self.assertIn('test', registry.data_classes())
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM goose_dataclass '
+                               'WHERE name = %s', ['test'])
+            registry.check()
+            self.assertNotIn('test', registry.data_classes())
+
+    def test_check_ttl(self) -> None:
+        with self.settings(GOOSE_REGISTRY_TTL=3600):
+            registry.invalidate()
+            registry.data_classes()
+            DataClass.objects.filter(name='world').update(
+                public=False, updated=datetime.datetime.now())
+            with self.assertNumQueries(0):
+                registry.check()
+            self.assertTrue(registry.data_class('world').public)
+
+    def test_check_request(self) -> None:
+        with self.settings(GOOSE_REGISTRY_TTL=0):
+            registry.invalidate()
+            registry.data_classes()
+            DataClass.objects.filter(name='world').update(
+                public=False, updated=datetime.datetime.now())
+            self.client.get(reverse('index'))
+            self.assertFalse(registry.data_class('world').public)
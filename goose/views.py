@@ -1,39 +1,75 @@
 # (c) 2020 Michał Górny
 # 2-clause BSD license
 
-import itertools
+import calendar
+import ipaddress
 import json
 import random
+import typing
 
 from pathlib import Path
 
+import django
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import models, transaction
 from django.http import (
     HttpRequest,
     HttpResponse,
     HttpResponseBadRequest,
-    JsonResponse,
+    HttpResponseForbidden,
+    HttpResponseNotAllowed,
+    FileResponse,
+    Http404,
+    StreamingHttpResponse,
+    )
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
     )
+from django.utils.http import http_date
 from django.views.decorators import http as decorators_http
 
-from goose.models import DataClass, Value, Count
+from goose import (
+    compression,
+    jsoncodec,
+    metrics,
+    ratelimit,
+    registry,
+    retry,
+    spool,
+    stats,
+    )
+from goose.ingest import (
+    GooseDataError,
+    GooseLimitError,
+    GooseTooLargeError,
+    ReportCounts,
+    add_counts,
+    add_reports,
+    check_id_limit,
+    claim_id,
+    count_shard,
+    id_limit_error,
+    recent_ids,
+    )
+from goose.models import Epoch
 
 
-class HttpResponseUnsupportedMediaType(HttpResponse):
-    status_code = 415
+NDJSON = 'application/x-ndjson'
 
 
-class HttpResponseTooManyRequests(HttpResponse):
-    status_code = 429
+class HttpResponseUnsupportedMediaType(HttpResponse):
+    status_code = 415
 
 
-class GooseDataError(Exception):
-    pass
+class HttpResponsePayloadTooLarge(HttpResponse):
+    status_code = 413
 
 
-class GooseLimitError(Exception):
-    pass
+class HttpResponseTooManyRequests(HttpResponse):
+    status_code = 429
 
 
 @decorators_http.require_http_methods(['GET', 'HEAD'])
@@ -56,101 +92,611 @@ def index(request: HttpRequest) -> HttpResponse:
                         content_type='text/plain')
 
 
-def add_data(data_cls: DataClass, value: str) -> None:
-    xval, _ = Value.objects.get_or_create(
-        data_class=data_cls,
-        value=value)
-    count, created = Count.objects.get_or_create(
-        value=xval,
-        age=0,
-        defaults={'count': 1})
-    if not created:
-        count.count += 1
-        count.save()
+def client_network(request: HttpRequest) -> typing.Optional[int]:
+    """Get rate limiter key for the client, or None if unknown"""
+    return ratelimit.network_key(request.META.get('REMOTE_ADDR', ''))
+
+
+def submit_checks(network: typing.Optional[int]
+                  ) -> typing.Optional[HttpResponse]:
+    """
+    Check whether the submission can be accepted, prior to parsing it
+
+    Returns an error response if it can not be.  Also loads the data
+    classes, so that they can be used on the event loop afterwards.
+    """
+
+    registry.data_classes()
+    # reject abusive clients before doing any real work
+    if network is not None and ratelimit.limit_exceeded(network):
+        return HttpResponseTooManyRequests(
+            'Too many submissions from your network\n',
+            content_type='text/plain')
+    return None
+
+
+def decode_json(body: bytes) -> typing.Any:
+    """Decode JSON, raise GooseDataError if it is malformed"""
+    try:
+        return jsoncodec.loads(body)
+    except UnicodeDecodeError as e:
+        raise GooseDataError(f'Malformed data: {e}')
+    except json.JSONDecodeError:
+        raise GooseDataError('Malformed JSON')
+
+
+def validate_report(data: typing.Any) -> ReportCounts:
+    """Validate decoded report, return its counts"""
+    if not isinstance(data, dict):
+        raise GooseDataError('Malformed report')
+    if data.get('goose-version') != 1:
+        raise GooseDataError(
+            'Unsupported goose-version or missing')
+    if 'id' not in data:
+        raise GooseDataError('id field missing')
+
+    counts = registry.validator()(data)
+    metrics.observe('goose_report_world_atoms',
+                    len(data.get('world') or ()))
+    return counts
+
+
+def content_encoding(request: HttpRequest) -> typing.Optional[str]:
+    """Get content encoding of the body, or None if it is unsupported"""
+    encoding = (request.META.get('HTTP_CONTENT_ENCODING', '')
+                .strip().lower() or 'identity')
+    if encoding != 'identity' and encoding not in compression.DECODERS:
+        return None
+    return encoding
+
+
+def content_too_large(request: HttpRequest) -> bool:
+    """Check whether Content-Length exceeds the max report size"""
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return False
+    return length > settings.GOOSE_MAX_REPORT_SIZE
+
+
+def too_large() -> HttpResponse:
+    return HttpResponsePayloadTooLarge('Report too large\n',
+                                       content_type='text/plain')
+
+
+def request_body(request: HttpRequest, encoding: str) -> bytes:
+    """
+    Get the decompressed request body
+
+    Raises GooseTooLargeError if the report exceeds
+    settings.GOOSE_MAX_REPORT_SIZE.
+    """
+
+    limit = settings.GOOSE_MAX_REPORT_SIZE
+    body = request.body
+    if encoding == 'identity':
+        if len(body) > limit:
+            raise GooseTooLargeError('Report too large')
+        return body
+    limit = min(limit, len(body) * settings.GOOSE_MAX_COMPRESSION_RATIO)
+    try:
+        return compression.decompress(body, encoding, limit)
+    except compression.DecompressedTooLarge:
+        raise GooseTooLargeError('Report too large')
+    except ValueError as e:
+        raise GooseDataError(str(e))
+
+
+def parse_report(body: bytes
+                 ) -> typing.Tuple[typing.Dict[str, typing.Any],
+                                   ReportCounts]:
+    """Parse and validate the report, return (data, counts)"""
+    data = decode_json(body)
+    return (data, validate_report(data))
+
+
+def store_report(data: typing.Dict[str, typing.Any],
+                 counts: ReportCounts,
+                 network: typing.Optional[int]
+                 ) -> None:
+    """Add (or spool) a validated report"""
+    max_age = settings.GOOSE_MAX_PERIODS
+
+    if spool.spool_dir() is not None:
+        check_id_limit(data['id'], Epoch.get_current(), max_age)
+        spool.append(dict((cls.name, data[cls.name])
+                          for cls in counts))
+        if network is not None:
+            retry.atomic(lambda: ratelimit.record(network))
+        return
+
+    # ids are stored separately from the data
+    del counts[registry.data_class('id')]
+
+    def add() -> None:
+        epoch = Epoch.get_current(for_write=True)
+        claim_id(data['id'], epoch, max_age)
+        add_counts(counts, epoch, count_shard(data['id']))
+        if network is not None:
+            ratelimit.record(network)
+
+    retry.atomic(add)
+
+
+def submit_error(e: Exception) -> HttpResponse:
+    """Get the response for a submission error"""
+    if isinstance(e, GooseLimitError):
+        return HttpResponseTooManyRequests(f'{e}\n',
+                                           content_type='text/plain')
+    if isinstance(e, GooseTooLargeError):
+        return HttpResponsePayloadTooLarge(f'{e}\n',
+                                           content_type='text/plain')
+    return HttpResponseBadRequest(f'{e}\n',
+                                  content_type='text/plain')
+
+
+def submit_success() -> HttpResponse:
+    return HttpResponse('Thank you, data added!\n',
+                        content_type='text/plain')
 
 
 @decorators_http.require_http_methods(['PUT'])
 def submit(request: HttpRequest) -> HttpResponse:
-    if request.content_type != 'application/json':
+    encoding = content_encoding(request)
+    if request.content_type != 'application/json' or encoding is None:
         return HttpResponseUnsupportedMediaType()
+    # reject oversized reports before reading them
+    if content_too_large(request):
+        return too_large()
 
-    max_age = settings.GOOSE_MAX_PERIODS
+    network = client_network(request)
+    resp = submit_checks(network)
+    if resp is not None:
+        return resp
+
+    try:
+        data, counts = parse_report(request_body(request, encoding))
+        store_report(data, counts, network)
+    except (GooseDataError, GooseLimitError) as e:
+        return submit_error(e)
+    return submit_success()
+
+
+async def submit_async(request: HttpRequest) -> HttpResponse:
+    """
+    Async variant of submit()
+
+    The body is parsed and validated on the event loop, and only
+    the database operations are run in a thread.
+    """
+
+    if request.method != 'PUT':
+        return HttpResponseNotAllowed(['PUT'])
+    encoding = content_encoding(request)
+    if request.content_type != 'application/json' or encoding is None:
+        return HttpResponseUnsupportedMediaType()
+    # reject oversized reports before reading them
+    if content_too_large(request):
+        return too_large()
+
+    network = client_network(request)
+    resp = await sync_to_async(submit_checks)(network)
+    if resp is not None:
+        return resp
+
+    try:
+        data, counts = parse_report(request_body(request, encoding))
+        await sync_to_async(store_report)(data, counts, network)
+    except (GooseDataError, GooseLimitError) as e:
+        return submit_error(e)
+    return submit_success()
 
+
+def is_relay(request: HttpRequest) -> bool:
+    """Check whether the client is a trusted relay"""
     try:
+        addr = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(addr in ipaddress.ip_network(x)
+               for x in settings.GOOSE_RELAY_NETWORKS)
+
+
+# (decoded report, error message)
+BulkItem = typing.Tuple[typing.Any, typing.Optional[str]]
+# (index in statuses, decoded report, counts)
+BulkReport = typing.Tuple[int, typing.Dict[str, typing.Any], ReportCounts]
+
+
+def iter_bulk_reports(request: HttpRequest) -> typing.Iterator[BulkItem]:
+    """
+    Iterate over reports in a bulk submission
+
+    NDJSON bodies are read and decoded line by line, and malformed
+    lines yield an error for the respective report.  JSON arrays
+    are decoded at once, and GooseDataError is raised if the array
+    is malformed.  GooseTooLargeError is raised if the array exceeds
+    settings.GOOSE_MAX_BULK_ARRAY_SIZE.  In both cases, reports
+    exceeding settings.GOOSE_MAX_REPORT_SIZE yield an error.
+    """
+
+    limit = settings.GOOSE_MAX_REPORT_SIZE
+    if request.content_type != NDJSON:
+        array_limit = settings.GOOSE_MAX_BULK_ARRAY_SIZE
+        # request.body is limited by DATA_UPLOAD_MAX_MEMORY_SIZE
+        body = request.read(array_limit + 1)
+        if len(body) > array_limit:
+            raise GooseTooLargeError(
+                f'Bulk array too large (max {array_limit} bytes), '
+                f'use NDJSON for larger batches')
+        data = decode_json(body)
+        if not isinstance(data, list):
+            raise GooseDataError('Expected a list of reports')
+        for report in data:
+            # a report can exceed the limit only if the array does
+            if len(body) > limit and len(jsoncodec.dumps(report)) > limit:
+                yield (None, 'Report too large')
+            else:
+                yield (report, None)
+        return
+
+    while True:
+        line = request.readline(limit + 1)
+        if not line:
+            break
+        if len(line.rstrip(b'\n')) > limit:
+            # skip the remainder of the line
+            while line and not line.endswith(b'\n'):
+                line = request.readline(limit)
+            yield (None, 'Report too large')
+            continue
+        if not line.strip():
+            continue
         try:
-            data = json.loads(request.body)
-        except UnicodeDecodeError as e:
-            raise GooseDataError(f'Malformed data: {e}')
-        except json.JSONDecodeError:
-            raise GooseDataError('Malformed JSON')
-        if data.get('goose-version') != 1:
-            raise GooseDataError(
-                'Unsupported goose-version or missing')
-        if 'id' not in data:
-            raise GooseDataError('id field missing')
-
-        with transaction.atomic():
-            for cls in DataClass.objects.all():
-                if cls.name in data:
-                    val = data[cls.name]
-                else:
-                    continue
+            yield (decode_json(line), None)
+        except GooseDataError as e:
+            yield (None, str(e))
 
-                if cls.data_type == DataClass.DataClassType.STRING:
-                    if not isinstance(val, str):
-                        raise GooseDataError(
-                            f'Expected a single string for {cls.name}')
-                    if cls.name == 'id':
-                        try:
-                            xval = Value.objects.get(data_class=cls,
-                                                     value=val)
-                        except Value.DoesNotExist:
-                            pass
-                        else:
-                            if Count.objects.filter(value=xval,
-                                                    age__lt=max_age):
-                                raise GooseLimitError(
-                                    f'No more than one submission '
-                                    f'permitted per {cls.name}={val}')
-                    add_data(cls, val)
-                elif cls.data_type == DataClass.DataClassType.STRING_ARRAY:
-                    if (not isinstance(val, list)
-                            or not all(isinstance(x, str) for x in val)):
-                        raise GooseDataError(
-                            f'Expected a list of strings for {cls.name}')
-                    for x in val:
-                        add_data(cls, x)
-                else:
-                    assert False, 'incorrect data_type'
+
+def limit_status(id_: str) -> typing.Dict[str, typing.Any]:
+    """Get bulk submission status for a repeated id"""
+    return {'status': 429, 'error': str(id_limit_error(id_))}
+
+
+def store_bulk(reports: typing.List[BulkReport],
+               statuses: typing.List[typing.Dict[str, typing.Any]]
+               ) -> None:
+    """Add (or spool) a batch of validated reports in one transaction"""
+    if not reports:
+        return
+    max_age = settings.GOOSE_MAX_PERIODS
+    id_cls = registry.data_class('id')
+
+    if spool.spool_dir() is not None:
+        seen = recent_ids([data['id'] for _, data, _ in reports],
+                          Epoch.get_current(),
+                          max_age)
+        spooled = []
+        for index, data, counts in reports:
+            if data['id'] in seen:
+                statuses[index] = limit_status(data['id'])
+                continue
+            seen.add(data['id'])
+            spooled.append(dict((cls.name, data[cls.name])
+                                for cls in counts))
+        spool.append_many(spooled)
+        return
+
+    folded = []
+    for _, data, counts in reports:
+        del counts[id_cls]
+        folded.append((data['id'], counts))
+    results = retry.atomic(lambda: add_reports(
+        folded, Epoch.get_current(for_write=True), max_age))
+    for (index, data, _), accepted in zip(reports, results):
+        if not accepted:
+            statuses[index] = limit_status(data['id'])
+
+
+@decorators_http.require_http_methods(['PUT'])
+def submit_bulk(request: HttpRequest) -> HttpResponse:
+    """
+    Accept multiple reports from a trusted relay
+
+    The body is either a JSON array of reports, or NDJSON (one report
+    per line).  JSON arrays are limited
+    to settings.GOOSE_MAX_BULK_ARRAY_SIZE, larger batches need to be
+    sent as NDJSON.  Every report is validated separately, and the valid
+    reports are added in batches.  Returns a JSON list of per-report
+    statuses, using the same status codes as submit().
+    """
+
+    if not is_relay(request):
+        return HttpResponseForbidden(
+            'Bulk submissions are permitted only from trusted relays\n',
+            content_type='text/plain')
+    if request.content_type not in ('application/json', NDJSON):
+        return HttpResponseUnsupportedMediaType()
+
+    statuses: typing.List[typing.Dict[str, typing.Any]] = []
+    batch: typing.List[BulkReport] = []
+    try:
+        for data, error in iter_bulk_reports(request):
+            if error is None:
+                try:
+                    counts = validate_report(data)
+                except GooseDataError as e:
+                    error = str(e)
+            if error is not None:
+                statuses.append({'status': 400, 'error': error})
+                continue
+            statuses.append({'status': 200})
+            batch.append((len(statuses) - 1, data, counts))
+            if len(batch) >= settings.GOOSE_BULK_BATCH_SIZE:
+                store_bulk(batch, statuses)
+                batch = []
+        store_bulk(batch, statuses)
     except GooseDataError as e:
-        return HttpResponseBadRequest(f'{e}\n',
-                                      content_type='text/plain')
-    except GooseLimitError as e:
-        return HttpResponseTooManyRequests(f'{e}\n',
-                                           content_type='text/plain')
+        return submit_error(e)
 
-    return HttpResponse('Thank you, data added!\n',
-                        content_type='text/plain')
+    for status in statuses:
+        metrics.inc('goose_submissions_total',
+                    (('status', str(status['status'])),))
+    return HttpResponse(jsoncodec.dumps(statuses),
+                        content_type='application/json')
+
+
+def accepted_encodings(request: HttpRequest) -> typing.Set[str]:
+    """Get content encodings accepted by the client"""
+    ret = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        encoding, _, params = item.partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        ret.add(encoding.strip().lower())
+    return ret
+
+
+def preferred_encoding(request: HttpRequest) -> typing.Optional[str]:
+    """Get the preferred response encoding, or None to send it as-is"""
+    accepted = accepted_encodings(request)
+    for encoding, _, _ in compression.ENCODERS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def open_snapshot(request: HttpRequest,
+                  path: Path,
+                  stamp: typing.Optional[str]
+                  ) -> typing.Optional[typing.Tuple[typing.BinaryIO,
+                                                    typing.Optional[str]]]:
+    """
+    Open the stats snapshot, preferring a compressed variant
+
+    Returns a tuple of open file and content encoding, or None if
+    there is no snapshot matching `stamp`.
+    """
+
+    if not stats.snapshot_matches(path, stamp):
+        return None
+    accepted = accepted_encodings(request)
+    variants = [(encoding, path.with_name(path.name + suffix))
+                for encoding, suffix, _ in compression.ENCODERS
+                if encoding in accepted]
+    for encoding, variant in variants + [(None, path)]:
+        try:
+            return (open(variant, 'rb'), encoding)
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def stats_response(request: HttpRequest,
+                   streaming: bool = True
+                   ) -> HttpResponse:
+    """
+    Build stats.json response
+
+    If there is no snapshot, the live stats are compressed once
+    per stamp when the client accepts compression.  Otherwise, they
+    are streamed from the database, unless `streaming` is False.
+    """
+
+    stamp = stats.last_update()
+    snapshot = None
+    encoding = None
+    path = stats.snapshot_path()
+    if path is not None:
+        snapshot = open_snapshot(request, path, stamp)
+    if snapshot is not None:
+        encoding = snapshot[1]
+    elif stamp is not None:
+        encoding = preferred_encoding(request)
+
+    # the stats change only along with the stamp
+    etag = None
+    last_modified = None
+    if stamp is not None:
+        etag = (f'"{stamp}-{encoding}"' if encoding is not None
+                else f'"{stamp}"')
+        last_modified = calendar.timegm(
+            stats.parse_stamp(stamp).utctimetuple())
+
+    resp = get_conditional_response(request,
+                                    etag=etag,
+                                    last_modified=last_modified)
+    if resp is not None:
+        if snapshot is not None:
+            snapshot[0].close()
+    elif snapshot is not None:
+        resp = FileResponse(snapshot[0], content_type='application/json')
+        if encoding is not None:
+            resp['Content-Encoding'] = encoding
+    elif encoding is not None:
+        assert stamp is not None
+        resp = HttpResponse(stats.compressed_stats(stamp, encoding),
+                            content_type='application/json')
+        resp['Content-Encoding'] = encoding
+    elif streaming:
+        resp = StreamingHttpResponse(stats.iter_stats(stamp),
+                                     content_type='application/json')
+    else:
+        resp = HttpResponse(b''.join(stats.iter_stats(stamp)),
+                            content_type='application/json')
+
+    if etag is not None:
+        resp['ETag'] = etag
+        resp['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(resp,
+                        public=True,
+                        max_age=settings.GOOSE_STATS_MAX_AGE)
+    patch_vary_headers(resp, ('Accept-Encoding',))
+    return resp
 
 
 @decorators_http.require_http_methods(['GET', 'HEAD'])
 def stats_json(request: HttpRequest) -> HttpResponse:
-    counts = (
-        Value.objects
-        .select_related('data_class')
-        .filter(data_class__public=True)
-        .annotate(
-            total_count=models.Sum(
-                'count__count',
-                filter=models.Q(count__age__gt=0))))
-    ret = dict(
-        (g.name, dict((x.value, x.total_count) for x in vals
-                      if x.total_count))
-        for g, vals in itertools.groupby(counts,
-                                         key=lambda x: x.data_class))
-    stamp_cls = DataClass.objects.get(name='stamp')
-    ret['last-update'] = (Count.objects.filter(
-                              value__data_class=stamp_cls)
-                          .aggregate(models.Max('value__value'))
-                          ['value__value__max'])
-    return JsonResponse(ret)
+    return stats_response(request)
+
+
+# whether StreamingHttpResponse accepts async iterators
+ASYNC_STREAMING = django.VERSION >= (4, 2)
+
+
+async def iter_chunks_async(chunks: typing.Iterable[bytes]
+                            ) -> typing.AsyncIterator[bytes]:
+    """Iterate over `chunks` in the thread used for the database"""
+    iterator = iter(chunks)
+
+    def next_chunk() -> typing.Optional[bytes]:
+        return next(iterator, None)
+
+    while True:
+        chunk = await sync_to_async(next_chunk)()
+        if chunk is None:
+            break
+        yield chunk
+
+
+async def stats_json_async(request: HttpRequest) -> HttpResponse:
+    """
+    Async variant of stats_json()
+
+    The live stats are streamed via an async iterator generating every
+    chunk in a thread.  Older Django versions iterate the responses
+    on the event loop, where the database can not be used, so the stats
+    are generated in full there.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    resp = await sync_to_async(stats_response)(request,
+                                               streaming=ASYNC_STREAMING)
+    if resp.streaming and not isinstance(resp, FileResponse):
+        resp.streaming_content = iter_chunks_async(resp.streaming_content)
+    return resp
+
+
+def int_param(request: HttpRequest,
+              name: str,
+              default: typing.Optional[int],
+              max_value: typing.Optional[int] = None
+              ) -> typing.Optional[int]:
+    """Get positive integer query parameter, raise ValueError if invalid"""
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        ret = int(value)
+    except ValueError:
+        ret = 0
+    if ret <= 0 or (max_value is not None and ret > max_value):
+        raise ValueError(f'Invalid {name} value: {value}')
+    return ret
+
+
+@decorators_http.require_http_methods(['GET', 'HEAD'])
+def class_stats_json(request: HttpRequest, name: str) -> HttpResponse:
+    """
+    Published values of a single data class
+
+    Query parameters:
+    - order: 'count' (descending, default) or 'value'
+    - prefix: only values starting with the prefix
+    - top: max number of values returned over all pages
+    - limit: max number of values in a page
+      (up to settings.GOOSE_STATS_PAGE_SIZE)
+    - cursor: the 'next' cursor returned for the previous page
+
+    Returns a JSON document with list of [value, count] pairs
+    in 'values', and the cursor for the next page (or null)
+    in 'next'.
+    """
+
+    cls = registry.data_classes().get(name)
+    if cls is None or not cls.public:
+        raise Http404('No such data class')
+
+    order = request.GET.get('order', 'count')
+    try:
+        if order not in stats.CLASS_STATS_ORDERS:
+            raise ValueError(f'Invalid order value: {order}')
+        top = int_param(request, 'top', None)
+        limit = int_param(request, 'limit', settings.GOOSE_STATS_PAGE_SIZE,
+                          settings.GOOSE_STATS_PAGE_SIZE)
+    except ValueError as e:
+        return HttpResponseBadRequest(f'{e}\n', content_type='text/plain')
+    assert limit is not None
+
+    # the stats change only along with the stamp
+    stamp = stats.last_update()
+    etag = None
+    last_modified = None
+    if stamp is not None:
+        etag = f'"{stamp}"'
+        last_modified = calendar.timegm(
+            stats.parse_stamp(stamp).utctimetuple())
+    resp = get_conditional_response(request,
+                                    etag=etag,
+                                    last_modified=last_modified)
+    if resp is None:
+        try:
+            values, cursor = stats.class_stats_page(
+                cls,
+                stamp,
+                limit,
+                order=order,
+                prefix=request.GET.get('prefix', ''),
+                top=top,
+                cursor=request.GET.get('cursor'))
+        except ValueError as e:
+            return HttpResponseBadRequest(f'{e}\n',
+                                          content_type='text/plain')
+        body = jsoncodec.dumps({
+            'class': name,
+            'values': values,
+            'next': cursor,
+            'last-update': stamp,
+        })
+        resp = HttpResponse(body, content_type='application/json')
+
+    if etag is not None:
+        resp['ETag'] = etag
+        resp['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(resp,
+                        public=True,
+                        max_age=settings.GOOSE_STATS_MAX_AGE)
+    return resp
+
+
+@decorators_http.require_http_methods(['GET', 'HEAD'])
+def prometheus_metrics(request: HttpRequest) -> HttpResponse:
+    """Metrics of all worker processes, in Prometheus text format"""
+    if not metrics.enabled():
+        raise Http404('Metrics are disabled')
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)